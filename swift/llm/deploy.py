@@ -2,34 +2,46 @@
 import asyncio
 import inspect
 import logging
+import multiprocessing
+import os
 import random
+import re
 import time
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from copy import copy
 from dataclasses import asdict
+from functools import partial
 from http import HTTPStatus
-from threading import Thread
-from typing import List, Optional, Union
+from threading import Lock, Thread
+from typing import Callable, List, Optional, TypeVar, Union
 
+import aiohttp
 import json
 import torch
 from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from modelscope import GenerationConfig
 from packaging import version
 from peft import PeftModel
 
 from swift.utils import get_logger, get_main, seed_everything
+from swift.utils.torch_utils import _find_free_port
 from .agent import split_action_action_input
 from .infer import merge_lora, prepare_model_template
 from .utils import (TEMPLATE_MAPPING, ChatCompletionMessageToolCall, ChatCompletionRequest, ChatCompletionResponse,
                     ChatCompletionResponseChoice, ChatCompletionResponseStreamChoice, ChatCompletionStreamResponse,
                     ChatMessage, CompletionRequest, CompletionResponse, CompletionResponseChoice,
                     CompletionResponseStreamChoice, CompletionStreamResponse, DeltaMessage, DeployArguments, Function,
-                    Model, ModelList, Template, UsageInfo, compat_openai, decode_base64, inference, inference_stream,
-                    messages_join_observation, messages_to_history, random_uuid, set_generation_config)
+                    IncrementalDetokenizer, MetricsRegistry, Model, ModelList, PtEngine, Template, UsageInfo,
+                    compat_openai, decode_base64, inference, inference_stream, messages_join_observation,
+                    messages_to_history, random_uuid, set_generation_config)
+from .utils.metrics import CONTENT_TYPE_LATEST
 
 logger = get_logger()
 
+_T = TypeVar('_T')
+
 global_stats = {}
 default_global_stats = {
     'num_prompt_tokens': 0,
@@ -40,29 +52,124 @@ default_global_stats = {
     'tokens/s': 0.
 }
 
+_stats_lock = Lock()  # global_stats is updated by the requests and reset by the thread of _log_stats_hook
+
 
 async def _log_stats_hook(log_interval: int):
     global global_stats
-    while True:
+    with _stats_lock:
         global_stats = default_global_stats.copy()
+    while True:
         t = time.perf_counter()
         await asyncio.sleep(log_interval)
         runtime = time.perf_counter() - t
-        global_stats['runtime'] = runtime
-        global_stats['samples/s'] = global_stats['num_samples'] / runtime
-        global_stats['tokens/s'] = global_stats['num_generated_tokens'] / runtime
-        for k, v in global_stats.items():
-            global_stats[k] = round(v, 8)
-        logger.info(global_stats)
+        with _stats_lock:
+            stats = global_stats
+            global_stats = default_global_stats.copy()
+        stats['runtime'] = runtime
+        stats['samples/s'] = stats['num_samples'] / runtime
+        stats['tokens/s'] = stats['num_generated_tokens'] / runtime
+        for k, v in stats.items():
+            stats[k] = round(v, 8)
+        logger.info(stats)
 
 
 def _update_stats(response) -> None:
     if response is None:
         return
     usage_info = response.usage
-    global_stats['num_prompt_tokens'] += usage_info.prompt_tokens
-    global_stats['num_generated_tokens'] += usage_info.completion_tokens
-    global_stats['num_samples'] += 1
+    with _stats_lock:
+        if not global_stats:
+            return
+        global_stats['num_prompt_tokens'] += usage_info.prompt_tokens
+        global_stats['num_generated_tokens'] += usage_info.completion_tokens
+        global_stats['num_samples'] += 1
+
+
+metrics_registry = MetricsRegistry()
+_requests_total = metrics_registry.counter('swift_requests_total', 'The number of the finished requests.',
+                                           ['model', 'status'])
+_prompt_tokens_total = metrics_registry.counter('swift_prompt_tokens_total', 'The number of the prompt tokens.',
+                                                ['model'])
+_generation_tokens_total = metrics_registry.counter('swift_generation_tokens_total',
+                                                    'The number of the generated tokens.', ['model'])
+_requests_running = metrics_registry.gauge('swift_requests_running', 'The number of the requests in flight.', ['model'])
+_queue_time_seconds = metrics_registry.histogram('swift_request_queue_time_seconds',
+                                                 'The time waiting in the queue of the engine.', ['model'])
+_time_to_first_token_seconds = metrics_registry.histogram('swift_time_to_first_token_seconds',
+                                                          'The time from the arrival to the first generated token.',
+                                                          ['model'])
+_inter_token_latency_seconds = metrics_registry.histogram(
+    'swift_inter_token_latency_seconds',
+    'The latency between the generated tokens.', ['model'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.015, 0.02, 0.025, 0.03, 0.04, 0.05, 0.075, 0.1, 0.25, 0.5, 1.))
+_request_latency_seconds = metrics_registry.histogram('swift_request_latency_seconds',
+                                                      'The end-to-end latency of the requests.', ['model'])
+_gpu_memory_allocated_bytes = metrics_registry.gauge('swift_gpu_memory_allocated_bytes',
+                                                     'The GPU memory allocated by the tensors.', ['device'])
+_encode_queue_size = metrics_registry.gauge('swift_encode_queue_size',
+                                            'The number of the requests being encoded or waiting for the encoding.')
+_gpu_memory_reserved_bytes = metrics_registry.gauge('swift_gpu_memory_reserved_bytes',
+                                                    'The GPU memory reserved by the caching allocator.', ['device'])
+
+
+class _RequestMetrics:
+    """Record the metrics of a request (see `/metrics`), from the arrival to the end of the response."""
+
+    def __init__(self, model: str, arrival_time: float) -> None:
+        self.model = model
+        self.arrival_time = arrival_time
+        self.last_token_time: Optional[float] = None
+        self.num_generated_tokens = 0
+        self.engine_metrics = {}  # e.g. {'queue_time': 0.1}, filled by the engine
+        self.is_finished = False
+        _requests_running.inc(model=model)
+
+    def on_tokens(self, num_generated_tokens: int) -> None:
+        """Called at each step of the generation."""
+        num_new_tokens = num_generated_tokens - self.num_generated_tokens
+        if num_new_tokens <= 0:
+            return
+        now = time.perf_counter()
+        if self.last_token_time is None:
+            _time_to_first_token_seconds.observe(now - self.arrival_time, model=self.model)
+        else:
+            _inter_token_latency_seconds.observe(
+                (now - self.last_token_time) / num_new_tokens, count=num_new_tokens, model=self.model)
+        self.last_token_time = now
+        self.num_generated_tokens = num_generated_tokens
+
+    def finish(self, response=None) -> None:
+        """response: The last response with the usage; None if the request is aborted or failed."""
+        if self.is_finished:
+            return
+        self.is_finished = True
+        _requests_running.dec(model=self.model)
+        queue_time = self.engine_metrics.get('queue_time')
+        if queue_time is not None:
+            _queue_time_seconds.observe(queue_time, model=self.model)
+        if response is None:
+            _requests_total.inc(model=self.model, status='error')
+            return
+        _requests_total.inc(model=self.model, status='success')
+        _request_latency_seconds.observe(time.perf_counter() - self.arrival_time, model=self.model)
+        _prompt_tokens_total.inc(response.usage.prompt_tokens, model=self.model)
+        _generation_tokens_total.inc(response.usage.completion_tokens, model=self.model)
+
+
+async def _finish_full(coro, request_metrics: _RequestMetrics):
+    try:
+        return await coro
+    finally:
+        request_metrics.finish()  # no-op if finished
+
+
+async def _finish_stream(gen, request_metrics: _RequestMetrics):
+    try:
+        async for chunk in gen:
+            yield chunk
+    finally:
+        request_metrics.finish()
 
 
 def lifespan(app: FastAPI):
@@ -77,6 +184,7 @@ app = FastAPI(lifespan=lifespan)
 _args: Optional[DeployArguments] = None
 model = None
 llm_engine = None
+pt_engine: Optional[PtEngine] = None
 template: Optional[Template] = None
 
 
@@ -101,6 +209,20 @@ async def get_available_models():
     return ModelList(data=data)
 
 
+@app.get('/health')
+async def health():
+    return {'status': 'ok'}
+
+
+@app.get('/metrics')
+async def get_metrics():
+    if torch.cuda.is_available() and torch.cuda.is_initialized():
+        for i in range(torch.cuda.device_count()):
+            _gpu_memory_allocated_bytes.set(torch.cuda.memory_allocated(i), device=str(i))
+            _gpu_memory_reserved_bytes.set(torch.cuda.memory_reserved(i), device=str(i))
+    return Response(metrics_registry.render(), media_type=CONTENT_TYPE_LATEST)
+
+
 async def check_length(request: Union[ChatCompletionRequest, CompletionRequest], input_ids: List[int]) -> Optional[str]:
     global llm_engine, model, _args
     if _args.infer_backend in {'vllm', 'lmdeploy'}:
@@ -138,6 +260,42 @@ def is_generation_template(template_type: str) -> bool:
     return is_generation
 
 
+_encode_executor: Optional[ThreadPoolExecutor] = None
+_num_encoding = 0  # The number of the requests being encoded or waiting in the queue of the encode executor
+
+
+async def _run_encode_executor(func: Callable[[], _T]) -> _T:
+    """Run the blocking function (e.g. `template.encode`) in the process-wide encode executor."""
+    global _num_encoding
+    _num_encoding += 1
+    _encode_queue_size.set(_num_encoding)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_encode_executor, func)
+    finally:
+        _num_encoding -= 1
+        _encode_queue_size.set(_num_encoding)
+
+
+def _is_decode_base64() -> bool:
+    """The base64 medias are decoded in memory by the template (see `load_image`), except for the templates
+    which pass the paths of the medias to the model (e.g. qwen-vl), whose base64 medias are saved to files."""
+    return _args.infer_backend == 'pt' and not template.load_medias
+
+
+def _abbreviate_medias(text: str, max_len: int = 128) -> str:
+    """Abbreviate the base64 medias in the text for logging."""
+
+    def _abbreviate(m: re.Match) -> str:
+        media = m.group(2)
+        if len(media) > max_len:
+            media = f'{media[:max_len]}...({len(media)} chars)'
+        return f'<{m.group(1)}>{media}</{m.group(1)}>'
+
+    if not isinstance(text, str):
+        return text
+    return re.sub(r'<(img|audio|video)>(.+?)</\1>', _abbreviate, text)
+
+
 async def _prepare_request(request: Union[ChatCompletionRequest, CompletionRequest], raw_request: Request):
     global template, model, llm_engine, _args
     if _args.api_key is not None:
@@ -150,6 +308,9 @@ async def _prepare_request(request: Union[ChatCompletionRequest, CompletionReque
     else:
         model_or_engine = model
 
+    if 0 < _args.encode_queue_size <= _num_encoding - _args.encode_num_workers:
+        return create_error_response(HTTPStatus.SERVICE_UNAVAILABLE,
+                                     'The server is overloaded, please retry after a while.')
     error_msg = await check_model(request)
     if error_msg is not None:
         return create_error_response(HTTPStatus.BAD_REQUEST, error_msg)
@@ -168,8 +329,9 @@ async def _prepare_request(request: Union[ChatCompletionRequest, CompletionReque
         images = request.images
         if _args.is_multimodal:
             compat_openai(messages, images, template.template_type)
-            messages = decode_base64(messages=messages)['messages']
-            images = decode_base64(images=images)['images']
+            if _is_decode_base64():
+                res = await _run_encode_executor(partial(decode_base64, messages=messages, images=images))
+                messages, images = res['messages'], res['images']
         # For agent, check if response is endwith observations and join tool observation
         messages_join_observation(messages)
         example = messages_to_history(messages)
@@ -185,11 +347,9 @@ async def _prepare_request(request: Union[ChatCompletionRequest, CompletionReque
                 example['tools'] = [tool]
             elif request.tool_choice == 'auto':
                 example['tools'] = request.tools
-        executor = ThreadPoolExecutor(max_workers=1)
-        loop = asyncio.get_running_loop()
-        inputs = (await loop.run_in_executor(executor, template.encode, example))[0]
+        inputs = (await _run_encode_executor(partial(template.encode, example)))[0]
         request_id = f'chatcmpl-{random_uuid()}'
-        _request['messages'] = messages
+        _request['messages'] = [{**message, 'content': _abbreviate_medias(message['content'])} for message in messages]
     else:
         if not is_generation_template(template.template_type):
             return create_error_response(
@@ -198,17 +358,15 @@ async def _prepare_request(request: Union[ChatCompletionRequest, CompletionReque
                 'Please use the `chat.completions` API.')
         prompt = request.prompt
         images = request.images
-        if _args.is_multimodal:
-            prompt = decode_base64(prompt=prompt)['prompt']
-            images = decode_base64(images=images)['images']
+        if _args.is_multimodal and _is_decode_base64():
+            res = await _run_encode_executor(partial(decode_base64, prompt=prompt, images=images))
+            prompt, images = res['prompt'], res['images']
         example = {'query': prompt}
         if len(images) > 0:
             example['images'] = images
-        executor = ThreadPoolExecutor(max_workers=1)
-        loop = asyncio.get_running_loop()
-        inputs = (await loop.run_in_executor(executor, template.encode, example))[0]
+        inputs = (await _run_encode_executor(partial(template.encode, example)))[0]
         request_id = f'cmpl-{random_uuid()}'
-        _request['prompt'] = prompt
+        _request['prompt'] = _abbreviate_medias(prompt)
 
     request_info = {'request_id': request_id}
     request_info.update(_request)
@@ -222,11 +380,18 @@ async def _prepare_request(request: Union[ChatCompletionRequest, CompletionReque
     return request_info, inputs, example
 
 
+def _set_vllm_queue_time(result, request_metrics: _RequestMetrics) -> None:
+    time_in_queue = getattr(getattr(result, 'metrics', None), 'time_in_queue', None)
+    if time_in_queue is not None:
+        request_metrics.engine_metrics['queue_time'] = time_in_queue
+
+
 @torch.inference_mode()
 async def inference_vllm_async(request: Union[ChatCompletionRequest, CompletionRequest], raw_request: Request):
     global llm_engine, template, _args
     from .utils import VllmGenerationConfig
     created_time = int(time.time())
+    arrival_time = time.perf_counter()
 
     result = await _prepare_request(request, raw_request)
     if isinstance(result, JSONResponse):
@@ -292,7 +457,9 @@ async def inference_vllm_async(request: Union[ChatCompletionRequest, CompletionR
             if await raw_request.is_disconnected():
                 await llm_engine.abort(request_id)
                 return create_error_response(HTTPStatus.BAD_REQUEST, 'Client disconnected')
+            request_metrics.on_tokens(sum(len(output.token_ids) for output in result.outputs))
         assert result is not None
+        _set_vllm_queue_time(result, request_metrics)
         num_prompt_tokens = len(result.prompt_token_ids)
         num_generated_tokens = sum(len(output.token_ids) for output in result.outputs)
         usage_info = UsageInfo(
@@ -334,17 +501,22 @@ async def inference_vllm_async(request: Union[ChatCompletionRequest, CompletionR
                 choices.append(choice)
             response = CompletionResponse(
                 model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
+        request_metrics.finish(response)
         if _args.log_interval > 0:
             _update_stats(response)
         return response
 
     async def _generate_stream():
         print_idx_list = [[0] for _ in range(request.n)]
+        detokenizer_list = [IncrementalDetokenizer(template.tokenizer) for _ in range(request.n)]
         total_res = ['' for _ in range(request.n)]
         response = None
         async for result in result_generator:
             num_prompt_tokens = len(result.prompt_token_ids)
             num_generated_tokens = sum(len(output.token_ids) for output in result.outputs)
+            request_metrics.on_tokens(num_generated_tokens)
+            if result.finished:
+                _set_vllm_queue_time(result, request_metrics)
             usage_info = UsageInfo(
                 prompt_tokens=num_prompt_tokens,
                 completion_tokens=num_generated_tokens,
@@ -352,7 +524,11 @@ async def inference_vllm_async(request: Union[ChatCompletionRequest, CompletionR
             )
             for output in result.outputs:
                 output.delta_text = template.generate_ids_to_response(
-                    output.token_ids, output.finished(), return_delta=True, print_idx=print_idx_list[output.index])
+                    output.token_ids,
+                    output.finished(),
+                    return_delta=True,
+                    print_idx=print_idx_list[output.index],
+                    detokenizer=detokenizer_list[output.index])
                 total_res[output.index] += output.delta_text
             if isinstance(request, ChatCompletionRequest):
                 choices = []
@@ -383,20 +559,23 @@ async def inference_vllm_async(request: Union[ChatCompletionRequest, CompletionR
                 response = CompletionStreamResponse(
                     model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
             yield f'data:{json.dumps(asdict(response), ensure_ascii=False)}\n\n'
+        request_metrics.finish(response)
         if _args.log_interval > 0:
             _update_stats(response)
         yield 'data:[DONE]\n\n'
 
+    request_metrics = _RequestMetrics(request.model, arrival_time)
     if request.stream:
-        return StreamingResponse(_generate_stream())
+        return StreamingResponse(_finish_stream(_generate_stream(), request_metrics))
     else:
-        return await _generate_full()
+        return await _finish_full(_generate_full(), request_metrics)
 
 
 @torch.inference_mode()
 async def inference_lmdeploy_async(request: Union[ChatCompletionRequest, CompletionRequest], raw_request: Request):
     global llm_engine, template, _args
     created_time = int(time.time())
+    arrival_time = time.perf_counter()
     from .utils.lmdeploy_utils import LmdeployGenerationConfig, _add_stop_word
 
     result = await _prepare_request(request, raw_request)
@@ -479,6 +658,7 @@ async def inference_lmdeploy_async(request: Union[ChatCompletionRequest, Complet
             )]
             response = CompletionResponse(
                 model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
+        request_metrics.finish(response)
         if _args.log_interval > 0:
             _update_stats(response)
         return response
@@ -487,6 +667,7 @@ async def inference_lmdeploy_async(request: Union[ChatCompletionRequest, Complet
         num_prompt_tokens = len(inputs['input_ids'])
         total_response = ''
         print_idx = [0]
+        detokenizer = IncrementalDetokenizer(template.tokenizer)
         async with llm_engine.safe_run(session_id):
             async_iter = generator.async_stream_infer(
                 session_id=session_id, **inputs, stream_output=True, gen_config=generation_config).__aiter__()
@@ -498,13 +679,14 @@ async def inference_lmdeploy_async(request: Union[ChatCompletionRequest, Complet
                 except StopAsyncIteration:
                     is_finished = True
                 num_generated_tokens = len(output.token_ids)
+                request_metrics.on_tokens(num_generated_tokens)
                 usage_info = UsageInfo(
                     prompt_tokens=num_prompt_tokens,
                     completion_tokens=num_generated_tokens,
                     total_tokens=num_prompt_tokens + num_generated_tokens,
                 )
                 delta_text = template.generate_ids_to_response(
-                    output.token_ids, is_finished, return_delta=True, print_idx=print_idx)
+                    output.token_ids, is_finished, return_delta=True, print_idx=print_idx, detokenizer=detokenizer)
                 total_response += delta_text
 
                 finish_reason = None
@@ -535,14 +717,16 @@ async def inference_lmdeploy_async(request: Union[ChatCompletionRequest, Complet
                     response = CompletionStreamResponse(
                         model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
                 yield f'data:{json.dumps(asdict(response), ensure_ascii=False)}\n\n'
+            request_metrics.finish(response)
             if _args.log_interval > 0:
                 _update_stats(response)
             yield 'data:[DONE]\n\n'
 
+    request_metrics = _RequestMetrics(request.model, arrival_time)
     if request.stream:
-        return StreamingResponse(_generate_stream())
+        return StreamingResponse(_finish_stream(_generate_stream(), request_metrics))
     else:
-        return await _generate_full()
+        return await _finish_full(_generate_full(), request_metrics)
 
 
 class _GenerationConfig(GenerationConfig):
@@ -569,13 +753,14 @@ def _check_api_key(raw_request: Request, api_key: str) -> bool:
 
 @torch.inference_mode()
 async def inference_pt_async(request: Union[ChatCompletionRequest, CompletionRequest], raw_request: Request):
-    global model, template, _args
+    global model, pt_engine, template, _args
     created_time = int(time.time())
+    arrival_time = time.perf_counter()
     result = await _prepare_request(request, raw_request)
     if isinstance(result, JSONResponse):
         return result
 
-    request_info, _, example = result
+    request_info, inputs, example = result
     request_id = request_info['request_id']
 
     kwargs = {'max_new_tokens': request.max_tokens}
@@ -600,6 +785,7 @@ async def inference_pt_async(request: Union[ChatCompletionRequest, CompletionReq
         kwargs['top_k'] = 50
     else:
         kwargs['do_sample'] = True
+    kwargs['prompt_lookup_num_tokens'] = getattr(model.generation_config, 'prompt_lookup_num_tokens', None)
 
     generation_config = _GenerationConfig(**kwargs)
     _old_generation_config = model.generation_config
@@ -624,18 +810,38 @@ async def inference_pt_async(request: Union[ChatCompletionRequest, CompletionReq
         elif isinstance(model, PeftModel):
             adapter_kwargs['adapter_names'] = ['-']  # use base model
 
+    is_batchable = pt_engine.is_batchable(inputs, generation_config)
+    if is_batchable:
+        generation_config.eos_token_id = template.tokenizer.eos_token_id
+
     async def _generate_full():
-        generation_info = {}
-        response, _ = inference(
-            model,
-            template,
-            **example,
-            stop_words=stop,
-            generation_config=generation_config,
-            generation_info=generation_info,
-            **adapter_kwargs)
-        num_prompt_tokens = generation_info['num_prompt_tokens']
-        num_generated_tokens = generation_info['num_generated_tokens']
+        if is_batchable:
+            generate_ids = []
+            async for generate_ids, _ in pt_engine.generate(
+                    inputs['input_ids'],
+                    generation_config,
+                    stop,
+                    adapter_kwargs.get('adapter_names'),
+                    metrics=request_metrics.engine_metrics):
+                request_metrics.on_tokens(len(generate_ids))
+            response = template.generate_ids_to_response(generate_ids)
+            response = template.post_process_generate_response(response=response, example=example)
+            num_prompt_tokens = len(inputs['input_ids'])
+            num_generated_tokens = len(generate_ids)
+        else:
+            generation_info = {}
+            response, _ = await pt_engine.run(
+                lambda: inference(
+                    model,
+                    template,
+                    **example,
+                    stop_words=stop,
+                    generation_config=generation_config,
+                    generation_info=generation_info,
+                    **adapter_kwargs),
+                metrics=request_metrics.engine_metrics)
+            num_prompt_tokens = generation_info['num_prompt_tokens']
+            num_generated_tokens = generation_info['num_generated_tokens']
         usage_info = UsageInfo(
             prompt_tokens=num_prompt_tokens,
             completion_tokens=num_generated_tokens,
@@ -668,32 +874,51 @@ async def inference_pt_async(request: Union[ChatCompletionRequest, CompletionReq
             )]
             response = CompletionResponse(
                 model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
+        request_metrics.finish(response)
         if _args.log_interval > 0:
             _update_stats(response)
         return response
 
-    def _generate_stream():
+    async def _iter_response():
+        """yield: response, is_finished, num_prompt_tokens, num_generated_tokens"""
+        if is_batchable:
+            print_idx, first_num_space = [0], [-1]
+            detokenizer = IncrementalDetokenizer(template.tokenizer)
+            async for generate_ids, is_finished in pt_engine.generate(
+                    inputs['input_ids'],
+                    generation_config,
+                    stop,
+                    adapter_kwargs.get('adapter_names'),
+                    metrics=request_metrics.engine_metrics):
+                response = template.generate_ids_to_response(
+                    generate_ids,
+                    is_finished,
+                    print_idx=print_idx,
+                    first_num_space=first_num_space,
+                    detokenizer=detokenizer)
+                yield response, is_finished, len(inputs['input_ids']), len(generate_ids)
+            return
         generation_info = {}
-        gen = inference_stream(
-            model,
-            template,
-            **example,
-            stop_words=stop,
-            generation_config=generation_config,
-            generation_info=generation_info,
-            **adapter_kwargs)
+        gen = pt_engine.run_stream(
+            lambda: inference_stream(
+                model,
+                template,
+                **example,
+                stop_words=stop,
+                generation_config=generation_config,
+                generation_info=generation_info,
+                **adapter_kwargs),
+            metrics=request_metrics.engine_metrics)
+        response = ''
+        async for response, _ in gen:
+            yield response, False, generation_info['num_prompt_tokens'], generation_info['num_generated_tokens']
+        yield response, True, generation_info['num_prompt_tokens'], generation_info['num_generated_tokens']
 
+    async def _generate_stream():
         print_idx = 0
-        response = ''
-        is_finished = False
         resp = None
-        while not is_finished:
-            try:
-                response, _ = next(gen)
-            except StopIteration:
-                is_finished = True
-            num_prompt_tokens = generation_info['num_prompt_tokens']
-            num_generated_tokens = generation_info['num_generated_tokens']
+        async for response, is_finished, num_prompt_tokens, num_generated_tokens in _iter_response():
+            request_metrics.on_tokens(num_generated_tokens)
             usage_info = UsageInfo(
                 prompt_tokens=num_prompt_tokens,
                 completion_tokens=num_generated_tokens,
@@ -727,14 +952,16 @@ async def inference_pt_async(request: Union[ChatCompletionRequest, CompletionReq
                 resp = CompletionStreamResponse(
                     model=request.model, choices=choices, usage=usage_info, id=request_id, created=created_time)
             yield f'data:{json.dumps(asdict(resp), ensure_ascii=False)}\n\n'
+        request_metrics.finish(resp)
         if _args.log_interval > 0:
             _update_stats(resp)
         yield 'data:[DONE]\n\n'
 
+    request_metrics = _RequestMetrics(request.model, arrival_time)
     if request.stream:
-        return StreamingResponse(_generate_stream())
+        return StreamingResponse(_finish_stream(_generate_stream(), request_metrics))
     else:
-        return await _generate_full()
+        return await _finish_full(_generate_full(), request_metrics)
 
 
 @app.post('/v1/chat/completions')
@@ -765,16 +992,198 @@ async def create_completion(request: CompletionRequest, raw_request: Request):
         return await inference_pt_async(request, raw_request)
 
 
+class _Replica:
+    """A model worker of `swift deploy --replicas N`, which is a `swift deploy` process listening on localhost."""
+
+    def __init__(self, url: str, process: multiprocessing.Process) -> None:
+        self.url = url
+        self.process = process
+        self.is_healthy = False
+        self.num_outstanding = 0  # The number of the requests being processed by the replica
+        self.num_requests = 0
+
+
+_replicas: List[_Replica] = []
+_session: Optional[aiohttp.ClientSession] = None
+
+
+async def _health_check_hook(interval: float = 5.):
+    while True:
+        for i, replica in enumerate(_replicas):
+            is_healthy = False
+            if replica.process.is_alive():
+                try:
+                    async with _session.get(f'{replica.url}/health', timeout=aiohttp.ClientTimeout(total=5)) as resp:
+                        is_healthy = resp.status == 200
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    pass
+            if is_healthy != replica.is_healthy:
+                logger.info(f'replica {i} ({replica.url}): {"ready" if is_healthy else "unavailable"}')
+            replica.is_healthy = is_healthy
+        await asyncio.sleep(interval)
+
+
+@asynccontextmanager
+async def _balancer_lifespan(app: FastAPI):
+    global _session
+    # The generation may take longer than the default timeout of aiohttp (5 minutes).
+    _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None))
+    task = asyncio.create_task(_health_check_hook())
+    yield
+    task.cancel()
+    await _session.close()
+
+
+balancer_app = FastAPI(lifespan=_balancer_lifespan)
+
+
+def _select_replica() -> Optional[_Replica]:
+    """Route to the healthy replica with the least outstanding requests."""
+    replicas = [replica for replica in _replicas if replica.is_healthy]
+    if len(replicas) == 0:
+        return None
+    return min(replicas, key=lambda replica: (replica.num_outstanding, replica.num_requests))
+
+
+async def _forward(raw_request: Request, path: str) -> Response:
+    replica = _select_replica()
+    if replica is None:
+        return create_error_response(HTTPStatus.SERVICE_UNAVAILABLE, 'No replica is available.')
+    body = await raw_request.body()
+    headers = {k: v for k, v in raw_request.headers.items() if k.lower() in {'authorization', 'content-type'}}
+    replica.num_outstanding += 1
+    replica.num_requests += 1
+    try:
+        resp = await _session.post(f'{replica.url}{path}', data=body, headers=headers)
+    except aiohttp.ClientError as e:
+        replica.num_outstanding -= 1
+        replica.is_healthy = False
+        return create_error_response(HTTPStatus.BAD_GATEWAY, f'The replica ({replica.url}) is unavailable: {e}')
+
+    if resp.content_type == 'text/event-stream':
+
+        async def _stream():
+            try:
+                async for chunk in resp.content.iter_any():
+                    yield chunk
+            finally:
+                resp.release()
+                replica.num_outstanding -= 1
+
+        return StreamingResponse(_stream(), status_code=resp.status, media_type='text/event-stream')
+    try:
+        content = await resp.read()
+    finally:
+        resp.release()
+        replica.num_outstanding -= 1
+    return Response(content, status_code=resp.status, media_type=resp.content_type)
+
+
+@balancer_app.get('/health')
+async def balancer_health():
+    replicas = [{
+        'url': replica.url,
+        'is_healthy': replica.is_healthy,
+        'num_outstanding': replica.num_outstanding
+    } for replica in _replicas]
+    is_healthy = any(replica.is_healthy for replica in _replicas)
+    return JSONResponse({
+        'status': 'ok' if is_healthy else 'unavailable',
+        'replicas': replicas
+    }, HTTPStatus.OK if is_healthy else HTTPStatus.SERVICE_UNAVAILABLE)
+
+
+@balancer_app.get('/v1/models')
+async def balancer_get_available_models():
+    data = {}
+    for replica in _replicas:
+        if not replica.is_healthy:
+            continue
+        try:
+            async with _session.get(f'{replica.url}/v1/models') as resp:
+                model_list = await resp.json()
+        except (aiohttp.ClientError, json.JSONDecodeError):
+            continue
+        for model_info in model_list['data']:
+            data.setdefault(model_info['id'], model_info)
+    return ModelList(data=[Model(**model_info) for model_info in data.values()])
+
+
+@balancer_app.post('/v1/chat/completions')
+async def balancer_create_chat_completion(raw_request: Request):
+    return await _forward(raw_request, '/v1/chat/completions')
+
+
+@balancer_app.post('/v1/completions')
+async def balancer_create_completion(raw_request: Request):
+    return await _forward(raw_request, '/v1/completions')
+
+
+def _get_replica_devices(replicas: int) -> Optional[List[str]]:
+    """Split the visible GPUs evenly among the replicas, return: The CUDA_VISIBLE_DEVICES of each replica."""
+    visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible_devices is not None:
+        device_ids = [device_id for device_id in visible_devices.split(',') if device_id]
+    else:
+        device_ids = [str(i) for i in range(torch.cuda.device_count())]
+    if len(device_ids) == 0:
+        return None
+    if len(device_ids) < replicas:
+        logger.warning(f'The number of the GPUs ({len(device_ids)}) is less than the number of the replicas '
+                       f'({replicas}), some replicas will share the same GPU.')
+        return [device_ids[i % len(device_ids)] for i in range(replicas)]
+    n_devices = len(device_ids) // replicas
+    return [','.join(device_ids[i * n_devices:(i + 1) * n_devices]) for i in range(replicas)]
+
+
+def _run_replica(args: DeployArguments, devices: Optional[str]) -> None:
+    if devices is not None:
+        os.environ['CUDA_VISIBLE_DEVICES'] = devices
+    llm_deploy(args)
+
+
+def llm_deploy_replicas(args: DeployArguments) -> None:
+    """Start `args.replicas` model workers, and a load balancer listening on `args.host:args.port`."""
+    import uvicorn
+    devices_list = args.replica_devices or _get_replica_devices(args.replicas)
+    mp = multiprocessing.get_context('spawn')
+    for i in range(args.replicas):
+        replica_args = copy(args)
+        replica_args.replicas = 1
+        replica_args.replica_devices = None
+        replica_args.merge_lora = False  # merged by the load balancer
+        replica_args.host = '127.0.0.1'
+        replica_args.port = _find_free_port()
+        replica_args.ssl_keyfile = None
+        replica_args.ssl_certfile = None
+        devices = devices_list[i] if devices_list is not None else None
+        # Not daemonic: the replica may start its own processes (e.g. tensor parallelism of vllm).
+        process = mp.Process(target=_run_replica, args=(replica_args, devices))
+        process.start()
+        logger.info(f'replica {i}: port: {replica_args.port}, CUDA_VISIBLE_DEVICES: {devices}')
+        _replicas.append(_Replica(f'http://127.0.0.1:{replica_args.port}', process))
+    try:
+        uvicorn.run(
+            balancer_app, host=args.host, port=args.port, ssl_keyfile=args.ssl_keyfile, ssl_certfile=args.ssl_certfile)
+    finally:
+        for replica in _replicas:
+            replica.process.terminate()
+        for replica in _replicas:
+            replica.process.join()
+
+
 def llm_deploy(args: DeployArguments) -> None:
     logger.info(f'args: {args}')
     seed_everything(args.seed)
     logger_format = logging.Formatter('%(levelname)s: %(asctime)s %(filename)s:%(lineno)d] %(message)s')
     logger.handlers[0].setFormatter(logger_format)
     import uvicorn
-    global llm_engine, model, template, _args
+    global llm_engine, pt_engine, model, template, _args, _encode_executor
     _args = args
     if args.merge_lora:
         merge_lora(args, device_map=args.merge_device_map)
+    if args.replicas > 1:
+        return llm_deploy_replicas(args)
     if args.infer_backend == 'vllm':
         from .utils import prepare_vllm_engine_template
         llm_engine, template = prepare_vllm_engine_template(args, use_async=True)
@@ -785,6 +1194,8 @@ def llm_deploy(args: DeployArguments) -> None:
         template._is_lmdeploy = True
     else:
         model, template = prepare_model_template(args)
+        pt_engine = PtEngine(model, template, max_batch_size=args.max_batch_size)
+    _encode_executor = ThreadPoolExecutor(max_workers=args.encode_num_workers, thread_name_prefix='encode')
     uvicorn.run(app, host=args.host, port=args.port, ssl_keyfile=args.ssl_keyfile, ssl_certfile=args.ssl_certfile)
 
 
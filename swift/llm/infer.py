@@ -16,9 +16,9 @@ from transformers.utils import is_torch_npu_available
 from swift.tuners import Swift
 from swift.utils import (append_to_jsonl, get_logger, get_main, get_model_info, read_multi_line, seed_everything,
                          show_layers)
-from .utils import (DeployArguments, InferArguments, MediaTag, Template, get_additional_saved_files, get_dataset,
-                    get_model_tokenizer, get_template, inference, inference_stream, is_adapter, is_quant_model,
-                    sample_dataset, set_generation_config)
+from .utils import (DeployArguments, InferArguments, LoRAAdapterCache, MediaTag, PrefixCache, PtEngine, Template,
+                    get_additional_saved_files, get_dataset, get_model_tokenizer, get_template, inference, inference_pt,
+                    inference_stream, is_adapter, is_quant_model, sample_dataset, set_generation_config)
 
 logger = get_logger()
 
@@ -202,7 +202,8 @@ def prepare_model_template(args: InferArguments,
         repetition_penalty=args.repetition_penalty,
         num_beams=args.num_beams,
         pad_token_id=tokenizer.pad_token_id,
-        eos_token_id=tokenizer.eos_token_id)
+        eos_token_id=tokenizer.eos_token_id,
+        prompt_lookup_num_tokens=args.prompt_lookup_num_tokens)
     logger.info(f'generation_config: {generation_config}')
     set_generation_config(model, generation_config)
 
@@ -229,12 +230,33 @@ def prepare_model_template(args: InferArguments,
         else:
             model = Swift.from_pretrained(model, args.ckpt_dir, inference_mode=True)
         model = model.to(model.dtype)
+        if isinstance(args, DeployArguments) and args.lora_request_list is not None:
+            if LoRAAdapterCache.is_supported(model):
+                model.lora_cache = LoRAAdapterCache(model, args.max_loras)
+            else:
+                logger.warning('The LoRA adapters do not support the per-row routing, '
+                               'the requests of different adapters are run by the LoRA layers of peft.')
     model.requires_grad_(False)
-
+    if args.prefix_cache_size > 0:
+        model.prefix_cache = PrefixCache(args.prefix_cache_size * 1024**2)
     if verbose:
         show_layers(model)
         logger.info(model)
     logger.info(get_model_info(model))
+    if args.speculative_model is not None:
+        speculative_model, speculative_tokenizer = get_model_tokenizer(
+            args.speculative_model,
+            args.torch_dtype, {'device_map': device_map},
+            model_id_or_path=args.speculative_model_id_or_path)
+        if len(speculative_tokenizer) != len(tokenizer):
+            logger.warning(
+                'The draft model should share the tokenizer with the model. '
+                f'len(speculative_tokenizer): {len(speculative_tokenizer)}, len(tokenizer): {len(tokenizer)}')
+        speculative_model.requires_grad_(False)
+        speculative_model.generation_config.num_assistant_tokens = args.num_speculative_tokens
+        logger.info(f'speculative_model: {speculative_model.__class__.__name__}, '
+                    f'num_speculative_tokens: {args.num_speculative_tokens}')
+        model.speculative_model = speculative_model  # The assistant_model of `model.generate`
     template: Template = get_template(
         args.template_type,
         tokenizer,
@@ -470,11 +492,12 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
             else:
                 args.verbose = True
             logger.info(f'Setting args.verbose: {args.verbose}')
-        if not args.verbose and args.stream:
+        is_pt_batch = args.infer_backend not in {'vllm', 'lmdeploy'} and args.infer_batch_size > 1
+        if (not args.verbose or is_pt_batch) and args.stream:
             args.stream = False
             logger.info(f'Setting args.stream: {args.stream}')
 
-        if args.infer_backend in {'vllm', 'lmdeploy'} and not args.stream:
+        if (args.infer_backend in {'vllm', 'lmdeploy'} or is_pt_batch) and not args.stream:
             if args.verbose:
                 args.verbose = False
                 logger.info('Setting args.verbose: False')
@@ -497,9 +520,18 @@ def llm_infer(args: InferArguments) -> Dict[str, List[Dict[str, Any]]]:
                     media_files = data.get(media_key)
                     if media_files is not None:
                         request[media_key] = media_files
+                for key in ['tools', 'objects']:
+                    value = data.get(key)
+                    if value is not None:
+                        request[key] = value
                 request['truncation_strategy'] = args.truncation_strategy
                 request_list.append(request)
-            resp_list = inference_x(llm_engine, template, request_list, use_tqdm=True)
+            if is_pt_batch:
+                pt_engine = PtEngine(model, template, max_batch_size=args.infer_batch_size)
+                resp_list = inference_pt(
+                    pt_engine, template, request_list, stop_words=args.stop_words or None, use_tqdm=True)
+            else:
+                resp_list = inference_x(llm_engine, template, request_list, use_tqdm=True)
             result = []
             if label_list is not None:
                 for request, label in zip(request_list, label_list):
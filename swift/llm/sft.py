@@ -21,9 +21,9 @@ from swift.utils import (append_to_jsonl, check_json_format, compute_acc_metrics
                          preprocess_logits_for_metrics, seed_everything, show_layers, use_torchacc)
 from .accelerator import ta_accelerate
 from .tuner import prepare_model
-from .utils import (TEMPLATE_MAPPING, LazyLLMDataset, PtArguments, SftArguments, Template, dataset_map, get_dataset,
-                    get_model_tokenizer, get_template, get_time_info, print_example, set_generation_config,
-                    sort_by_max_length, stat_dataset)
+from .utils import (TEMPLATE_MAPPING, LazyLLMDataset, PackedLLMDataset, PtArguments, SftArguments, Template,
+                    dataset_map, get_dataset, get_model_tokenizer, get_template, get_template_fingerprint,
+                    get_time_info, print_example, set_generation_config, sort_by_max_length, stat_dataset)
 
 logger = get_logger()
 
@@ -303,11 +303,15 @@ def llm_sft(args: SftArguments) -> Dict[str, Any]:
     logger.info(f'args.lazy_tokenize: {args.lazy_tokenize}')
     if args.packing:
         from swift.llm.utils.utils import ConstantLengthDataset
-        train_dataset = ConstantLengthDataset.get_packed_dataset(
-            template, train_dataset, args.max_length, lazy_tokenize=args.lazy_tokenize)
+        packing_kwargs = {'lazy_tokenize': args.lazy_tokenize, 'num_proc': args.preprocess_num_proc}
+        if args.tokenized_cache_dir is not None:
+            packing_kwargs['cache_dir'] = args.tokenized_cache_dir
+            packing_kwargs['cache_key'] = get_template_fingerprint(template)
+        train_dataset = ConstantLengthDataset.get_packed_dataset(template, train_dataset, args.max_length,
+                                                                 **packing_kwargs)
         if val_dataset is not None:
-            val_dataset = ConstantLengthDataset.get_packed_dataset(
-                template, val_dataset, args.max_length, lazy_tokenize=args.lazy_tokenize)
+            val_dataset = ConstantLengthDataset.get_packed_dataset(template, val_dataset, args.max_length,
+                                                                   **packing_kwargs)
         dataset_info = {}
         if not args.lazy_tokenize:
             td0 = train_dataset[0]
@@ -319,9 +323,20 @@ def llm_sft(args: SftArguments) -> Dict[str, Any]:
         dataset_info = {}
         if not streaming:
             logger.info(f'Using num_proc: {args.preprocess_num_proc}')
-        train_dataset = dataset_map(train_dataset, template.encode, args.preprocess_num_proc, streaming=streaming)
+        cache_kwargs = {}
+        if args.tokenized_cache_dir is not None and not streaming:
+            cache_kwargs = {'cache_dir': args.tokenized_cache_dir, 'cache_key': get_template_fingerprint(template)}
+        if streaming:
+            encode_func = template.encode
+        else:
+            # Tokenize the texts of a batch by one tokenizer call
+            encode_func = template.encode_batch
+            cache_kwargs['batched'] = True
+        train_dataset = dataset_map(
+            train_dataset, encode_func, args.preprocess_num_proc, streaming=streaming, **cache_kwargs)
         if val_dataset is not None:
-            val_dataset = dataset_map(val_dataset, template.encode, args.preprocess_num_proc, streaming=streaming)
+            val_dataset = dataset_map(
+                val_dataset, encode_func, args.preprocess_num_proc, streaming=streaming, **cache_kwargs)
         if args.test_oom_error:
             train_dataset = sort_by_max_length(train_dataset, 20000)
         # Data analysis
@@ -332,7 +347,12 @@ def llm_sft(args: SftArguments) -> Dict[str, Any]:
             raise AttributeError('Failed to access dataset attributes,train_dataset is None. This might be because:\n'
                                  '(1) The dataset contains None for input or labels;\n'
                                  "(2) The 'max_length' setting is too short causing data truncation.")
-        td0, tkwargs0 = train_dataset.data[0] if not streaming else (next(iter(train_dataset)), {})
+        if streaming:
+            td0, tkwargs0 = next(iter(train_dataset)), {}
+        elif isinstance(train_dataset, PackedLLMDataset):
+            td0, tkwargs0 = train_dataset[0], {}
+        else:
+            td0, tkwargs0 = train_dataset.data[0]
         print_example(td0, tokenizer, tkwargs0)
         dataset_info['train_dataset'] = stat_dataset(train_dataset) if not streaming else None
         if val_dataset is not None:
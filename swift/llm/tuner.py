@@ -265,6 +265,10 @@ def prepare_model(model, args: SftArguments):
             galore_scale=args.galore_scale,
             proj_type=args.galore_proj_type,
             optim_per_parameter=args.galore_optim_per_parameter,
+            svd_type=args.galore_svd_type,
+            svd_niter=args.galore_svd_niter,
+            svd_warm_start=args.galore_svd_warm_start,
+            stagger_update=args.galore_stagger_update,
             quantize=args.galore_quantization,
             proj_quant=args.galore_proj_quant,
             proj_bits=args.galore_proj_bits,
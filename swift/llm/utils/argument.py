@@ -675,6 +675,10 @@ class SftArguments(ArgumentsBase):
     galore_scale: float = 1.0
     galore_proj_type: str = 'std'
     galore_optim_per_parameter: bool = False
+    galore_svd_type: Literal['full', 'randomized'] = 'full'
+    galore_svd_niter: int = 2
+    galore_svd_warm_start: bool = False
+    galore_stagger_update: bool = False
     galore_with_embedding: bool = False
     galore_quantization: bool = False
     galore_proj_quant: bool = False
@@ -734,12 +738,17 @@ class SftArguments(ArgumentsBase):
     eval_steps: Optional[int] = None  # full: 200, other: 50
     save_steps: Optional[int] = None
     save_only_model: Optional[bool] = None
+    # Write the checkpoints in the background thread
+    async_save: bool = False
     save_total_limit: int = 2  # save last and best. -1: all checkpoints
     logging_steps: int = 5
     acc_steps: int = 1
     dataloader_num_workers: Optional[int] = None
     dataloader_pin_memory: bool = True
     dataloader_drop_last: bool = False
+    group_by_length: bool = False
+    # If set, the batch size is decided by the number of tokens (group_by_length will be set to True)
+    max_tokens_per_batch: Optional[int] = None
 
     # push to ms hub
     push_to_hub: bool = False
@@ -762,6 +771,7 @@ class SftArguments(ArgumentsBase):
     disable_tqdm: bool = False
     lazy_tokenize: Optional[bool] = None
     preprocess_num_proc: int = 1
+    tokenized_cache_dir: Optional[str] = None
     use_flash_attn: Optional[bool] = None
     ignore_args_error: bool = False  # True: notebook compatibility
     check_model_is_latest: bool = True
@@ -769,6 +779,8 @@ class SftArguments(ArgumentsBase):
     logging_dir: Optional[str] = None
     report_to: List[str] = field(default_factory=lambda: ['tensorboard'])
     acc_strategy: Literal['token', 'sentence'] = 'token'
+    # > 0: compute the loss from the hidden states in chunks of tokens, without the full logits
+    loss_chunk_size: int = 0
     save_on_each_node: bool = False
     evaluation_strategy: Literal['steps', 'epoch', 'no'] = 'steps'
     save_strategy: Literal['steps', 'epoch', 'no'] = 'steps'
@@ -921,6 +933,9 @@ class SftArguments(ArgumentsBase):
             self.dataset_seed = self.seed
         self.set_model_type()
         self.check_flash_attn()
+        if self.packing and not self.use_flash_attn:
+            logger.warning('packing is used without flash attention (`--use_flash_attn true`), '
+                           'the packed samples attend to each other.')
         self.handle_generation_config()
         self.handle_lr_scheduler_kwargs()
         self.is_multimodal = self._is_multimodal(self.model_type)
@@ -1016,6 +1031,8 @@ class SftArguments(ArgumentsBase):
 
         self.prepare_ms_hub()
         self.train_sampler_random = not self.test_oom_error
+        if self.max_tokens_per_batch is not None:
+            self.group_by_length = True
         if self.eval_batch_size is None:
             if self.predict_with_generate:
                 self.eval_batch_size = 1
@@ -1157,6 +1174,7 @@ class SftArguments(ArgumentsBase):
             predict_with_generate=self.predict_with_generate,
             local_rank=self.local_rank,
             save_only_model=self.save_only_model,
+            async_save=self.async_save,
             train_sampler_random=self.train_sampler_random,
             report_to=self.report_to,
             deepspeed=self.deepspeed,
@@ -1164,12 +1182,15 @@ class SftArguments(ArgumentsBase):
             disable_tqdm=self.disable_tqdm,
             save_on_each_node=self.save_on_each_node,
             acc_strategy=self.acc_strategy,
+            loss_chunk_size=self.loss_chunk_size,
             save_safetensors=self.save_safetensors,
             logging_first_step=True,
             metric_warmup_step=self.metric_warmup_step,
             fsdp=self.fsdp,
             fsdp_config=self.fsdp_config,
             dataloader_drop_last=self.dataloader_drop_last,
+            group_by_length=self.group_by_length,
+            max_tokens_per_batch=self.max_tokens_per_batch,
             seed=self.seed,
             **kwargs)
 
@@ -1302,6 +1323,13 @@ class InferArguments(ArgumentsBase):
     use_flash_attn: Optional[bool] = None
     ignore_args_error: bool = False  # True: notebook compatibility
     stream: bool = True
+    infer_batch_size: int = 1  # The batch size of the dataset inference with the pt backend
+    prefix_cache_size: int = 0  # MiB, the memory budget of the prefix KV cache of the pt backend. 0: disabled
+    # speculative decoding of the pt backend
+    speculative_model: Optional[str] = None  # The model_type of the draft model, which shares the tokenizer
+    speculative_model_id_or_path: Optional[str] = None
+    num_speculative_tokens: int = 5  # The number of the draft tokens per step (adjusted dynamically)
+    prompt_lookup_num_tokens: Optional[int] = None  # The draft tokens are copied from the matched n-gram of the prompt
     merge_lora: bool = False
     merge_device_map: Optional[str] = None
     save_safetensors: bool = True
@@ -1421,9 +1449,10 @@ class InferArguments(ArgumentsBase):
         support_vllm = model_info.get('support_vllm', False)
         support_lmdeploy = model_info.get('support_lmdeploy', False)
         self.lora_request_list = None
+        is_speculative = self.speculative_model is not None or self.prompt_lookup_num_tokens is not None
         if self.infer_backend == 'AUTO':
             self.infer_backend = 'pt'
-            if is_vllm_available() and support_vllm and not self.is_multimodal:
+            if is_vllm_available() and support_vllm and not self.is_multimodal and not is_speculative:
                 if ((self.sft_type == 'full' or self.sft_type == 'lora' and self.merge_lora)
                         and self.quantization_bit == 0):
                     self.infer_backend = 'vllm'
@@ -1433,6 +1462,9 @@ class InferArguments(ArgumentsBase):
                 if ((self.sft_type == 'full' or self.sft_type == 'lora' and self.merge_lora)
                         and self.quantization_bit == 0):
                     self.infer_backend = 'lmdeploy'
+        if is_speculative:
+            assert self.infer_backend == 'pt', 'The speculative decoding only supports `--infer_backend pt`.'
+            assert self.num_beams == 1, 'The speculative decoding does not support beam search.'
         if self.infer_backend == 'vllm':
             require_version('vllm')
             if not support_vllm:
@@ -1501,9 +1533,22 @@ class DeployArguments(InferArguments):
     owned_by: str = 'swift'
     verbose: bool = True  # Whether to log request_info
     log_interval: int = 10  # Interval for printing global statistics
+    max_batch_size: int = 16  # The max number of requests in a continuous batch of the pt backend
+    encode_num_workers: int = 4  # The number of threads encoding the requests
+    encode_queue_size: int = 0  # The requests beyond the queue of the encoding are rejected, 0: no limit
+    # The max number of the LoRA adapters on the GPU of the pt backend (swapped with the CPU in the LRU order), 0: all
+    max_loras: int = 0
+    # Start multiple model workers behind a load balancer
+    replicas: int = 1
+    replica_devices: Optional[List[str]] = None  # The CUDA_VISIBLE_DEVICES of each replica, e.g. `0,1 2,3`
 
     def __post_init__(self):
         super().__post_init__()
+        if self.replica_devices is not None:
+            if self.replicas == 1:
+                self.replicas = len(self.replica_devices)
+            assert len(self.replica_devices) == self.replicas, (
+                f'replica_devices: {self.replica_devices}, replicas: {self.replicas}')
 
 
 @dataclass
@@ -22,7 +22,7 @@ from transformers import AutoConfig, AutoTokenizer, GenerationConfig
 from swift.utils import get_logger
 from .argument import InferArguments
 from .model import get_model_tokenizer
-from .template import Template, get_template
+from .template import IncrementalDetokenizer, Template, get_template
 from .utils import get_max_model_len
 
 logger = get_logger()
@@ -151,6 +151,18 @@ def _add_stop_word(stop_words: List[int], token: Union[List[int], int, str, None
         stop_words.append(token[0])
 
 
+def _prepare_lmdeploy_generation_config(lmdeploy_engine: Union[AsyncEngine, VLAsyncEngine], template: Template,
+                                        generation_config: LmdeployGenerationConfig) -> None:
+    if hasattr(lmdeploy_engine, 'vl_encoder'):
+        lmdeploy_engine.vl_encoder._loop_task = None
+
+    template.model = lmdeploy_engine
+    tokenizer = template.tokenizer
+
+    _add_stop_word(generation_config.stop_words, tokenizer.eos_token_id, tokenizer=tokenizer)
+    _add_stop_word(generation_config.stop_words, template.suffix[-1], tokenizer=tokenizer)
+
+
 def _prepare_lmdeploy_request(lmdeploy_engine: Union[AsyncEngine, VLAsyncEngine],
                               template: Template,
                               request_list: List[Dict[str, Any]],
@@ -163,15 +175,7 @@ def _prepare_lmdeploy_request(lmdeploy_engine: Union[AsyncEngine, VLAsyncEngine]
         if key not in generation_info:
             generation_info[key] = 0
 
-    if hasattr(lmdeploy_engine, 'vl_encoder'):
-        lmdeploy_engine.vl_encoder._loop_task = None
-
-    template.model = lmdeploy_engine
-    tokenizer = template.tokenizer
-
-    _add_stop_word(generation_config.stop_words, tokenizer.eos_token_id, tokenizer=tokenizer)
-    _add_stop_word(generation_config.stop_words, template.suffix[-1], tokenizer=tokenizer)
-
+    _prepare_lmdeploy_generation_config(lmdeploy_engine, template, generation_config)
     resp_list: List[Optional[Dict[str, Any]]] = [None] * len(request_list)
     generators = []
     is_multimodal = getattr(lmdeploy_engine, 'is_multimodal', False)
@@ -195,8 +199,8 @@ def _prepare_lmdeploy_request(lmdeploy_engine: Union[AsyncEngine, VLAsyncEngine]
         inputs_list = [future.result() for future in futures]
     prog_bar.close()
 
+    truncation_strategy = kwargs.pop('truncation_strategy', 'delete')
     for i, (inputs, request) in enumerate(zip(inputs_list, request_list)):
-        truncation_strategy = kwargs.pop('truncation_strategy', 'delete')
         if len(inputs) == 0 and truncation_strategy == 'delete':
             # input_ids exceeds `max_length`. Please increase the value of `max_length`.
             resp_list[i] = {'response': '', 'history': request['history']}
@@ -245,6 +249,7 @@ def inference_stream_lmdeploy(lmdeploy_engine: Union[AsyncEngine, VLAsyncEngine]
 
     n_finished = 0
     print_idx_list = [[0] for _ in range(len(request_list))]
+    detokenizer_list = [IncrementalDetokenizer(template.tokenizer) for _ in range(len(request_list))]
     outputs = [None] * len(request_list)
     num_generated_tokens = [0] * len(request_list)
     prog_bar = tqdm(total=len(generators), dynamic_ncols=True, disable=not use_tqdm)
@@ -280,7 +285,8 @@ def inference_stream_lmdeploy(lmdeploy_engine: Union[AsyncEngine, VLAsyncEngine]
             output = outputs[i]  # old value
         outputs[i] = output
         request = request_list[i]
-        safe_response = template.generate_ids_to_response(output.token_ids, is_finished, print_idx=print_idx_list[i])
+        safe_response = template.generate_ids_to_response(
+            output.token_ids, is_finished, print_idx=print_idx_list[i], detokenizer=detokenizer_list[i])
         query = request['query']
         history = request['history']
         if resp_list[i] is None:
@@ -315,76 +321,63 @@ def inference_lmdeploy(lmdeploy_engine: Union[AsyncEngine, VLAsyncEngine],
     """
     request_list: e.g. [{'query': 'hello!'}].
         The keys that can be included are: 'query', 'history', 'system', 'images'.
+    max_batch_size: The max number of the requests being encoded or generated at the same time.
+        The requests are encoded in the background while the engine is generating.
     """
     if len(request_list) == 0:
         return []
     runtime = time.perf_counter()
 
     is_multimodal = getattr(lmdeploy_engine, 'is_multimodal', False)
-    if is_multimodal and max_batch_size is None:
-        max_batch_size = 512
-
-    _inner_call = kwargs.get('_inner_call', False)
+    if max_batch_size is None:
+        max_batch_size = 512 if is_multimodal else len(request_list)
     if generation_info is None:
         generation_info = {}
-    elif not _inner_call:
+    else:
         generation_info.clear()
-    if max_batch_size is not None and len(request_list) > max_batch_size:
-        i = 0
-        resp_list = []
-        kwargs['_inner_call'] = True
-        while i < len(request_list):
-            resp_list += inference_lmdeploy(
-                lmdeploy_engine,
-                template,
-                request_list[i:i + max_batch_size],
-                generation_config=generation_config,
-                generation_info=generation_info,
-                max_batch_size=max_batch_size,
-                use_tqdm=use_tqdm,
-                verbose=verbose,
-                prompt_prefix=prompt_prefix,
-                output_prefix=output_prefix,
-                **kwargs)
-            i += max_batch_size
-        runtime = time.perf_counter() - runtime
-        generation_info['runtime'] = runtime
-        generation_info['samples/s'] = generation_info['num_samples'] / runtime
-        generation_info['tokens/s'] = generation_info['num_generated_tokens'] / runtime
-        return resp_list
+    for key in ['num_prompt_tokens', 'num_generated_tokens', 'num_samples']:
+        generation_info[key] = 0
 
     if generation_config is None:
         generation_config = getattr(lmdeploy_engine, 'generation_config', LmdeployGenerationConfig())
     assert isinstance(generation_config, LmdeployGenerationConfig)
     request_list = deepcopy(request_list)
     generation_config = deepcopy(generation_config)
-
-    resp_list, generators = _prepare_lmdeploy_request(
-        lmdeploy_engine,
-        template,
-        request_list,
-        generation_config=generation_config,
-        generation_info=generation_info,
-        use_tqdm=use_tqdm,
-        **kwargs)
+    _prepare_lmdeploy_generation_config(lmdeploy_engine, template, generation_config)
+    truncation_strategy = kwargs.pop('truncation_strategy', 'delete')
 
     tokenizer = template.tokenizer
     if use_tqdm:
         assert verbose is False
-    prog_bar = tqdm(total=len(generators), dynamic_ncols=True, disable=not use_tqdm)
+    resp_list: List[Optional[Dict[str, Any]]] = [None] * len(request_list)
+    max_workers = os.cpu_count() if is_multimodal else 1
+    prog_bar = tqdm(total=len(request_list), dynamic_ncols=True, disable=not use_tqdm)
 
-    async def _inner_infer(i: int, inputs: Dict[str, Any], generator) -> None:
-        generator = await generator
-        images = inputs.pop('images', None) or []
-        if len(images) > 0:
-            inputs['images'] = await lmdeploy_engine.vl_encoder.async_infer(images)
-            await template.prepare_lmdeploy_inputs(inputs)
-        generation_info['num_prompt_tokens'] += len(inputs['input_ids'])
-        async with lmdeploy_engine.safe_run(i):
-            async for output in generator.async_stream_infer(
-                    session_id=i, **inputs, stream_output=False, gen_config=generation_config):
-                pass
-        request = request_list[i]
+    def _prepare_inputs(request: Dict[str, Any]) -> Dict[str, Any]:
+        request['history'] = request.get('history') or []
+        return template.encode(request)[0]
+
+    async def _inner_infer(i: int, executor: concurrent.futures.Executor, semaphore: asyncio.Semaphore) -> None:
+        # The semaphore is acquired in the order of the requests, which bounds the look-ahead of the encoding.
+        async with semaphore:
+            request = request_list[i]
+            inputs = await asyncio.get_running_loop().run_in_executor(executor, _prepare_inputs, request)
+            if len(inputs) == 0 and truncation_strategy == 'delete':
+                # input_ids exceeds `max_length`. Please increase the value of `max_length`.
+                resp_list[i] = {'response': '', 'history': request['history']}
+                prog_bar.update()
+                return
+            generation_info['num_samples'] += 1
+            generator = await lmdeploy_engine.get_generator(False, i)
+            images = inputs.pop('images', None) or []
+            if len(images) > 0:
+                inputs['images'] = await lmdeploy_engine.vl_encoder.async_infer(images)
+                await template.prepare_lmdeploy_inputs(inputs)
+            generation_info['num_prompt_tokens'] += len(inputs['input_ids'])
+            async with lmdeploy_engine.safe_run(i):
+                async for output in generator.async_stream_infer(
+                        session_id=i, **inputs, stream_output=False, gen_config=generation_config):
+                    pass
         input_ids = inputs['input_ids']
         response = template.generate_ids_to_response(output.token_ids)
         query = request['query']
@@ -399,10 +392,13 @@ def inference_lmdeploy(lmdeploy_engine: Union[AsyncEngine, VLAsyncEngine],
         prog_bar.update()
 
     async def _batch_infer() -> None:
-        tasks = [_inner_infer(i, inputs, generator) for i, inputs, generator in generators]
-        await asyncio.gather(*tasks)
+        semaphore = asyncio.Semaphore(max_batch_size)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(request_list))) as executor:
+            tasks = [_inner_infer(i, executor, semaphore) for i in range(len(request_list))]
+            await asyncio.gather(*tasks)
 
-    asyncio.run(_batch_infer())
+    with lmdeploy_context(template):
+        asyncio.run(_batch_infer())
     prog_bar.close()
     runtime = time.perf_counter() - runtime
     generation_info['runtime'] = runtime
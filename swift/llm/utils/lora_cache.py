@@ -0,0 +1,171 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+from collections import OrderedDict
+from types import MethodType
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from peft.tuners.lora import Linear as LoraLinear
+from peft.tuners.lora import LoraLayer
+from torch import Tensor, nn
+
+from swift.utils import get_logger
+
+logger = get_logger()
+
+
+class LoRAAdapterCache:
+    """The multi-LoRA serving of the PeftModel (in the style of punica/S-LoRA): the requests targeting different
+    adapters are batched together, and each row of the batch is routed to its adapter inside the LoRA Linear layers.
+
+    The weights of the adapters are kept in the (pinned) CPU memory, and at most `max_loras` adapters are loaded into
+    the slots on the GPU, which are swapped in the LRU order. Each LoRA Linear layer gathers the A/B matrices
+    (zero-padded to the max rank, with the scaling folded into B) of the slot of each row, and computes the LoRA output
+    of the whole batch in two batched matmuls. The rows of the unknown adapters (e.g. '-') use the base model.
+
+    Args:
+        model: The PeftModel with the LoRA adapters (see `is_supported`).
+        max_loras: The max number of the adapters on the GPU. 0: all the adapters.
+    """
+
+    def __init__(self, model: nn.Module, max_loras: int = 0) -> None:
+        self.layers: List[LoraLinear] = [module for module in model.modules() if isinstance(module, LoraLayer)]
+        adapter_names = dict.fromkeys(name for layer in self.layers for name in layer.lora_A.keys())
+        self.adapter_names: List[str] = list(adapter_names)
+        self._adapter_name_set = set(adapter_names)
+        if max_loras <= 0 or max_loras > len(self.adapter_names):
+            max_loras = len(self.adapter_names)
+        self.max_loras = max_loras
+        self.base_slot = max_loras  # The last slot is all zeros.
+        self._slots: 'OrderedDict[str, int]' = OrderedDict()  # adapter_name -> slot, in the LRU order
+        self._free_slots = list(range(max_loras))[::-1]
+        self.num_swaps = 0
+        # The slot indices of the rows of the last forward.
+        self._row_adapter_names: Optional[List[str]] = None
+        self._row_slots: List[int] = []
+        self._shared_slot: Optional[int] = None
+        self._row_slot_tensors: Dict[torch.device, Tensor] = {}
+
+        for layer in self.layers:
+            self._init_layer(layer)
+        self.load(self.adapter_names[:max_loras])
+        logger.info(f'LoRAAdapterCache: {len(self.adapter_names)} adapters, max_loras: {max_loras}')
+
+    @staticmethod
+    def is_supported(model: nn.Module) -> bool:
+        """Only the (unmerged, non-DoRA) LoRA Linear layers support the per-row routing."""
+        has_lora = False
+        for module in model.modules():
+            if not isinstance(module, LoraLayer):
+                continue
+            if not isinstance(module, LoraLinear) or module.merged or any(module.use_dora.values()):
+                return False
+            has_lora = True
+        return has_lora
+
+    def _init_layer(self, layer: LoraLinear) -> None:
+        adapter_names = list(layer.lora_A.keys())
+        weight = layer.lora_A[adapter_names[0]].weight
+        device, dtype = weight.device, weight.dtype
+        max_rank = max(layer.r[name] for name in adapter_names)
+        layer._lora_A_slots = torch.zeros((self.max_loras + 1, max_rank, layer.in_features), device=device, dtype=dtype)
+        layer._lora_B_slots = torch.zeros((self.max_loras + 1, layer.out_features, max_rank),
+                                          device=device,
+                                          dtype=dtype)
+        # Move the weights of the adapters to the CPU, which are copied to the slots when loaded.
+        pin_memory = device.type == 'cuda'
+        for name in adapter_names:
+            for lora in [layer.lora_A[name], layer.lora_B[name]]:
+                data = lora.weight.data.cpu()
+                lora.weight.data = data.pin_memory() if pin_memory else data
+        layer.lora_cache = self
+        layer.forward = MethodType(_lora_cache_forward, layer)
+
+    def _copy_to_slot(self, layer: LoraLinear, adapter_name: str, slot: int) -> None:
+        lora_A_slot, lora_B_slot = layer._lora_A_slots[slot], layer._lora_B_slots[slot]
+        if adapter_name not in layer.lora_A:
+            lora_A_slot.zero_()
+            lora_B_slot.zero_()
+            return
+        rank = layer.r[adapter_name]
+        lora_A_slot[:rank].copy_(layer.lora_A[adapter_name].weight, non_blocking=True)
+        lora_A_slot[rank:].zero_()
+        lora_B_slot[:, :rank].copy_(layer.lora_B[adapter_name].weight, non_blocking=True)
+        lora_B_slot[:, :rank].mul_(layer.scaling[adapter_name])
+        lora_B_slot[:, rank:].zero_()
+
+    def load(self, adapter_names: Iterable[str]) -> None:
+        """Make sure that the adapters are on the GPU, the least recently used ones of the others are evicted."""
+        adapter_names = [name for name in dict.fromkeys(adapter_names) if name in self._adapter_name_set]
+        if len(adapter_names) > self.max_loras:
+            raise ValueError(f'The number of the adapters in a batch exceeds max_loras: {self.max_loras}, '
+                             f'adapter_names: {adapter_names}')
+        for name in adapter_names:
+            if name in self._slots:
+                self._slots.move_to_end(name)
+        for name in adapter_names:
+            if name in self._slots:
+                continue
+            if self._free_slots:
+                slot = self._free_slots.pop()
+            else:
+                evicted = next(key for key in self._slots.keys() if key not in adapter_names)
+                slot = self._slots.pop(evicted)
+                self.num_swaps += 1
+            for layer in self.layers:
+                self._copy_to_slot(layer, name, slot)
+            self._slots[name] = slot
+
+    def count_adapters(self, adapter_names: Iterable[str]) -> int:
+        """The number of the slots needed by the adapter_names."""
+        return len(self._adapter_name_set.intersection(adapter_names))
+
+    def get_row_slots(self, adapter_names: List[str], device: torch.device) -> Tuple[Optional[int], Optional[Tensor]]:
+        """return: The slot shared by all the rows (or None), the slot of each row (if not shared).
+
+        The result is computed once per forward (all the layers receive the same adapter_names object).
+        """
+        if adapter_names is not self._row_adapter_names:
+            self.load(adapter_names)
+            self._row_adapter_names = adapter_names
+            self._row_slots = [self._slots.get(name, self.base_slot) for name in adapter_names]
+            self._shared_slot = self._row_slots[0] if len(set(self._row_slots)) == 1 else None
+            self._row_slot_tensors = {}
+        if self._shared_slot is not None:
+            return self._shared_slot, None
+        row_slots = self._row_slot_tensors.get(device)
+        if row_slots is None:
+            row_slots = self._row_slot_tensors[device] = torch.tensor(self._row_slots, device=device)
+        return None, row_slots
+
+
+def _lora_cache_forward(self: LoraLinear, x: Tensor, *args: Any, **kwargs: Any) -> Tensor:
+    """The forward of the LoRA Linear layers managed by the LoRAAdapterCache."""
+    adapter_names = kwargs.pop('adapter_names', None)
+    result = self.base_layer(x, *args, **kwargs)
+    if self.disable_adapters:
+        return result
+    lora_cache: LoRAAdapterCache = self.lora_cache
+    lora_A_slots, lora_B_slots = self._lora_A_slots, self._lora_B_slots
+    x = x.to(lora_A_slots.dtype)
+    if adapter_names is None:
+        adapter_names = [name for name in self.active_adapters if name in self.lora_A]
+        lora_cache.load(adapter_names)
+        for name in adapter_names:
+            slot = lora_cache._slots[name]
+            result = result + F.linear(F.linear(x, lora_A_slots[slot]), lora_B_slots[slot]).to(result.dtype)
+        return result
+    if len(x) != len(adapter_names):
+        raise ValueError('Length of `adapter_names` should be the same as the number of inputs, but got '
+                         f'{len(adapter_names)} and {len(x)} respectively.')
+    slot, row_slots = lora_cache.get_row_slots(adapter_names, x.device)
+    if slot == lora_cache.base_slot:
+        return result
+    if slot is not None:
+        lora_output = F.linear(F.linear(x, lora_A_slots[slot]), lora_B_slots[slot])
+    else:
+        # Gather the A/B matrices of each row: [batch_size, rank, in_features], [batch_size, out_features, rank]
+        lora_A, lora_B = lora_A_slots[row_slots], lora_B_slots[row_slots]
+        h = x.reshape(x.shape[0], -1, x.shape[-1])
+        lora_output = torch.bmm(torch.bmm(h, lora_A.transpose(1, 2)), lora_B.transpose(1, 2))
+    return result + lora_output.reshape(result.shape).to(result.dtype)
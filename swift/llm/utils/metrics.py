@@ -0,0 +1,162 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import math
+import threading
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# The Content-Type of the Prometheus text exposition format
+CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1., 2.5, 5., 7.5, 10., 30., 60., 120.)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if len(names) == 0:
+        return ''
+    labels = []
+    for name, value in zip(names, values):
+        value = value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        labels.append(f'{name}="{value}"')
+    return '{' + ','.join(labels) + '}'
+
+
+class _Metric:
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _get_key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        assert set(labels.keys()) == set(self.label_names), f'labels: {labels}, label_names: {self.label_names}'
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _collect_samples(self) -> List[str]:
+        with self._lock:
+            return [
+                f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+                for key, value in self._values.items()
+            ]
+
+    def collect(self) -> List[str]:
+        header = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type_name}']
+        return header + self._collect_samples()
+
+
+class Counter(_Metric):
+    type_name = 'counter'
+
+    def inc(self, value: float = 1., **labels: str) -> None:
+        assert value >= 0, f'value: {value}'
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.) + value
+
+
+class Gauge(_Metric):
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, value: float = 1., **labels: str) -> None:
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.) + value
+
+    def dec(self, value: float = 1., **labels: str) -> None:
+        self.inc(-value, **labels)
+
+
+class Histogram(_Metric):
+    type_name = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, count: int = 1, **labels: str) -> None:
+        """Observe the value `count` times."""
+        key = self._get_key(labels)
+        idx = bisect_left(self.buckets, value)  # the first bucket with value <= upper bound; len(buckets): +Inf
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                # [the (non-cumulative) count of each bucket (with +Inf), sum]
+                values = self._values[key] = [[0] * (len(self.buckets) + 1), 0.]
+            values[0][idx] += count
+            values[1] += value * count
+
+    def _collect_samples(self) -> List[str]:
+        res = []
+        with self._lock:
+            for key, (bucket_counts, total) in self._values.items():
+                cumulative_count = 0
+                for upper_bound, count in zip(self.buckets + (math.inf, ), bucket_counts):
+                    cumulative_count += count
+                    labels = _format_labels(self.label_names + ('le', ), key + (_format_value(upper_bound), ))
+                    res.append(f'{self.name}_bucket{labels} {cumulative_count}')
+                labels = _format_labels(self.label_names, key)
+                res.append(f'{self.name}_sum{labels} {_format_value(total)}')
+                res.append(f'{self.name}_count{labels} {cumulative_count}')
+        return res
+
+
+class MetricsRegistry:
+    """A minimal thread-safe registry of the metrics, rendered in the Prometheus text exposition format.
+
+    Example:
+        >>> registry = MetricsRegistry()
+        >>> counter = registry.counter('requests_total', 'The number of the requests.', ['model'])
+        >>> counter.inc(model='qwen')
+        >>> registry.render()
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            assert metric.name not in self._metrics, f'The metric `{metric.name}` has been registered.'
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(self,
+                  name: str,
+                  documentation: str,
+                  label_names: Sequence[str] = (),
+                  buckets: Optional[Sequence[float]] = None) -> Histogram:
+        return self._register(Histogram(name, documentation, label_names, buckets or DEFAULT_BUCKETS))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.collect()
+        return '\n'.join(lines) + '\n'
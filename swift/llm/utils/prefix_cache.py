@@ -0,0 +1,222 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+import transformers
+from packaging import version
+from torch import Tensor
+from transformers import GenerationConfig, PreTrainedModel
+
+from swift.utils import get_logger
+
+try:
+    from transformers.cache_utils import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+logger = get_logger()
+
+# layers of (key, value): [1, num_heads, seq_len, head_dim]
+PastKeyValues = Tuple[Tuple[Tensor, Tensor], ...]
+
+
+class _Node:
+    """The node of the radix tree, whose edge from the parent is labeled with `key` (a tuple of token ids)."""
+
+    def __init__(self, key: Tuple[int, ...] = (), parent: Optional['_Node'] = None) -> None:
+        self.key = key
+        self.parent = parent
+        self.children: Dict[int, '_Node'] = {}
+        # The KV cache of all the tokens from the root to this node.
+        self.past_key_values: Optional[PastKeyValues] = None
+        self.nbytes = 0
+
+
+class PrefixCache:
+    """The prefix KV cache of the PyTorch models, which reuses the KV cache of the shared prefixes
+    (e.g. the long system prompt and the tools prompt of the agents) and only prefills the suffix.
+
+    The KV caches are stored in a radix tree keyed by the token ids (one tree per adapter). A KV cache of n tokens
+    serves all the prompts sharing a prefix with it (the prefix is sliced without copying). When a sequence is stored,
+    the KV caches of its prefixes become redundant and are released. The KV caches are evicted in the LRU order
+    to keep the total size within `max_size` bytes.
+
+    Args:
+        max_size: The memory budget of the KV caches, in bytes.
+        min_prefix_len: The prefix shorter than it is not reused.
+    """
+
+    def __init__(self, max_size: int, min_prefix_len: int = 16) -> None:
+        self.max_size = max_size
+        self.min_prefix_len = min_prefix_len
+        self.size = 0
+        self._roots: Dict[Hashable, _Node] = {}
+        self._lru: 'OrderedDict[int, _Node]' = OrderedDict()  # the nodes with the KV cache
+        self._lock = threading.Lock()
+        self.num_hit_tokens = 0
+        self.num_prompt_tokens = 0
+
+    @staticmethod
+    def is_supported(model: PreTrainedModel, inputs: Dict[str, Any], generation_config: GenerationConfig) -> bool:
+        """Whether `model.generate` can continue from a DynamicCache of the prefix (cache_position is required)."""
+        if DynamicCache is None or version.parse(transformers.__version__) < version.parse('4.38'):
+            return False
+        if not getattr(model, '_supports_cache_class', False) or getattr(model.config, 'is_encoder_decoder', False):
+            return False
+        if 'input_ids' not in inputs or set(inputs.keys()) - {'input_ids', 'attention_mask', 'labels'}:
+            return False  # e.g. multimodal
+        if getattr(generation_config, 'prompt_lookup_num_tokens', None) is not None:
+            return False  # speculative decoding
+        return generation_config.num_beams == 1 and inputs['input_ids'].shape[0] == 1
+
+    @staticmethod
+    def _get_root_key(adapter_names: Optional[List[str]]) -> Hashable:
+        return tuple(adapter_names) if adapter_names is not None else None
+
+    def _walk(self, root: _Node, token_ids: List[int]) -> Tuple[_Node, int, int]:
+        """return: The deepest node reached, the number of the matched tokens, and the number of the matched tokens
+            on the edge of the node (< len(node.key) if the match ends inside the edge)."""
+        node, num_matched, edge_matched = root, 0, 0
+        while num_matched < len(token_ids):
+            child = node.children.get(token_ids[num_matched])
+            if child is None:
+                break
+            key = child.key
+            i = 1
+            while i < len(key) and num_matched + i < len(token_ids) and key[i] == token_ids[num_matched + i]:
+                i += 1
+            node, num_matched, edge_matched = child, num_matched + i, i
+            if i < len(key):
+                break
+        return node, num_matched, edge_matched
+
+    def match(self, token_ids: List[int], adapter_names: Optional[List[str]] = None) -> Optional[PastKeyValues]:
+        """Get the KV cache of the longest cached prefix of the token_ids (at least one token is left to prefill)."""
+        with self._lock:
+            self.num_prompt_tokens += len(token_ids)
+            root = self._roots.get(self._get_root_key(adapter_names))
+            if root is None:
+                return None
+            node, num_matched, _ = self._walk(root, token_ids[:-1])
+            if num_matched < self.min_prefix_len:
+                return None
+            # All the KV caches in the subtree share the matched prefix.
+            while node.past_key_values is None:
+                node = next(iter(node.children.values()))
+            self._lru.move_to_end(id(node))
+            self.num_hit_tokens += num_matched
+            return tuple((k[:, :, :num_matched], v[:, :, :num_matched]) for k, v in node.past_key_values)
+
+    def insert(self,
+               token_ids: List[int],
+               past_key_values: PastKeyValues,
+               adapter_names: Optional[List[str]] = None) -> None:
+        """Store the KV cache of the token_ids (past_key_values[i][j].shape[2] == len(token_ids))."""
+        if len(token_ids) < self.min_prefix_len:
+            return
+        past_key_values = tuple((self._detach(k), self._detach(v)) for k, v in past_key_values)
+        nbytes = sum(k.nbytes + v.nbytes for k, v in past_key_values)
+        if nbytes > self.max_size:
+            return
+        with self._lock:
+            root_key = self._get_root_key(adapter_names)
+            root = self._roots.get(root_key)
+            if root is None:
+                root = self._roots[root_key] = _Node()
+            node, num_matched, edge_matched = self._walk(root, token_ids)
+            if num_matched == len(token_ids) and (edge_matched < len(node.key) or node.past_key_values is None):
+                return  # A longer sequence has been cached.
+            if node is not root and edge_matched < len(node.key):
+                node = self._split(node, edge_matched)
+            if num_matched < len(token_ids):
+                key = tuple(token_ids[num_matched:])
+                child = _Node(key, node)
+                node.children[key[0]] = child
+                node = child
+            self._set(node, past_key_values, nbytes)
+            # The KV caches of the prefixes are covered by the new one.
+            parent = node.parent
+            while parent is not None:
+                if parent.past_key_values is not None:
+                    self._release(parent)
+                parent = parent.parent
+            while self.size > self.max_size and len(self._lru) > 1:
+                self._evict(next(iter(self._lru.values())))
+
+    @staticmethod
+    def _detach(t: Tensor) -> Tensor:
+        t = t.detach()
+        if t.untyped_storage().nbytes() > t.nbytes:
+            t = t.clone()  # e.g. the row of a batch, avoid holding the whole storage
+        return t
+
+    @staticmethod
+    def _split(node: _Node, edge_len: int) -> _Node:
+        """Split the edge of the node at edge_len, and return the new middle node."""
+        parent = node.parent
+        middle = _Node(node.key[:edge_len], parent)
+        parent.children[middle.key[0]] = middle
+        node.key = node.key[edge_len:]
+        node.parent = middle
+        middle.children[node.key[0]] = node
+        return middle
+
+    def _set(self, node: _Node, past_key_values: PastKeyValues, nbytes: int) -> None:
+        if node.past_key_values is not None:
+            self._release(node)
+        node.past_key_values = past_key_values
+        node.nbytes = nbytes
+        self.size += nbytes
+        self._lru[id(node)] = node
+
+    def _release(self, node: _Node) -> None:
+        node.past_key_values = None
+        self.size -= node.nbytes
+        node.nbytes = 0
+        self._lru.pop(id(node), None)
+
+    def _evict(self, node: _Node) -> None:
+        self._release(node)
+        # Remove the leaves without the KV cache, and merge the nodes with only one child.
+        while node.parent is not None and node.past_key_values is None and len(node.children) <= 1:
+            parent = node.parent
+            if len(node.children) == 0:
+                parent.children.pop(node.key[0])
+            else:
+                child = next(iter(node.children.values()))
+                child.key = node.key + child.key
+                child.parent = parent
+                parent.children[child.key[0]] = child
+            node = parent
+
+    def get_past_key_values(self, token_ids: List[int], adapter_names: Optional[List[str]] = None) -> Any:
+        """The (possibly empty) DynamicCache to be passed to `model.generate`."""
+        return DynamicCache.from_legacy_cache(self.match(token_ids, adapter_names))
+
+    def update(self, token_ids: List[int], past_key_values: Any, adapter_names: Optional[List[str]] = None) -> None:
+        """Store the KV cache after the generation. token_ids: The prompt and the generated tokens."""
+        if DynamicCache is not None and isinstance(past_key_values, DynamicCache):
+            past_key_values = past_key_values.to_legacy_cache()
+        if not past_key_values:
+            return
+        seq_len = past_key_values[0][0].shape[2]
+        if seq_len > len(token_ids):
+            logger.warning('The length of the KV cache does not match the token_ids, skip the prefix cache.')
+            return
+        self.insert(token_ids[:seq_len], past_key_values, adapter_names)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._roots.clear()
+            self._lru.clear()
+            self.size = 0
+
+
+def get_prefix_cache(model: PreTrainedModel, inputs: Dict[str, Any],
+                     generation_config: GenerationConfig) -> Optional[PrefixCache]:
+    """The prefix cache of the model (see `InferArguments.prefix_cache_size`), if the inputs are supported."""
+    prefix_cache: Optional[PrefixCache] = getattr(model, 'prefix_cache', None)
+    if prefix_cache is None or not prefix_cache.is_supported(model, inputs, generation_config):
+        return None
+    return prefix_cache
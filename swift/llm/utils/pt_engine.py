@@ -0,0 +1,601 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import asyncio
+import threading
+import time
+from collections import deque
+from copy import deepcopy
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterator, List, Optional, Tuple, TypeVar, Union
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor
+from tqdm import tqdm
+from transformers import GenerationConfig, PreTrainedModel
+
+from swift.utils import get_logger
+from .lora_cache import LoRAAdapterCache
+from .prefix_cache import PrefixCache
+from .template import StopWords, StopWordsMatcher, Template
+from .utils import _prepare_generation_config, inference
+
+try:
+    from transformers.cache_utils import DynamicCache
+except ImportError:
+    DynamicCache = None
+
+logger = get_logger()
+
+_T = TypeVar('_T')
+# layers of (key, value): [batch_size, num_heads, seq_len, head_dim]
+PastKeyValues = Tuple[Tuple[Tensor, Tensor], ...]
+
+
+@dataclass
+class _PtRequest:
+    input_ids: List[int]
+    generation_config: GenerationConfig
+    stop_words: StopWords
+    adapter_names: Optional[List[str]]
+    tokenizer_kwargs: Dict[str, Any]
+    loop: asyncio.AbstractEventLoop
+    queue: asyncio.Queue
+    stop_matcher: Optional[StopWordsMatcher] = None
+    generate_ids: List[int] = field(default_factory=list)
+    is_aborted: bool = False
+    # e.g. {'queue_time': 0.1}, filled by the engine
+    metrics: Optional[Dict[str, float]] = None
+    arrival_time: float = field(default_factory=time.perf_counter)
+
+
+@dataclass
+class _PtJob:
+    """A blocking function (e.g. `inference`) run in the worker thread, whose outputs are sent to the queue."""
+    func: Callable[[], Any]
+    loop: asyncio.AbstractEventLoop
+    queue: asyncio.Queue
+    is_stream: bool = False
+    is_aborted: bool = False
+    metrics: Optional[Dict[str, float]] = None
+    arrival_time: float = field(default_factory=time.perf_counter)
+
+
+_STOP = object()
+
+
+class PtEngine:
+    """The continuous batching engine of the native PyTorch models, used by `swift deploy --infer_backend pt`.
+
+    The requests are scheduled at the iteration level by a dedicated worker thread: the new requests are prefilled
+    (left-padded) and merged into the running batch, whose KV cache is shared and decoded one token per step.
+    The finished requests leave the batch immediately, and the tokens are streamed back to each request.
+    The requests targeting different LoRA adapters share the batch, each row is routed to its adapter
+    (see `LoRAAdapterCache`).
+
+    The models whose KV cache is not in the standard format (layers of [batch_size, num_heads, seq_len, head_dim])
+    and the requests that cannot be batched (e.g. beam search, multimodal, speculative decoding) are run by
+    the blocking `inference` functions as jobs in the same worker thread (see `run`, `run_stream`).
+    """
+
+    def __init__(self, model: PreTrainedModel, template: Template, max_batch_size: int = 16) -> None:
+        self.model = model
+        self.template = template
+        self.tokenizer = template.tokenizer
+        self.max_batch_size = max_batch_size
+        self.device = next(model.parameters()).device
+        self.supports_batching = self._check_kv_cache()
+        if not self.supports_batching:
+            logger.warning('The KV cache of the model is not in the standard format, '
+                           'the requests will be generated one by one.')
+
+        self._waiting: Deque[Union[_PtRequest, _PtJob]] = deque()
+        self._cond = threading.Condition()
+        # The running batch.
+        self._requests: List[_PtRequest] = []
+        self._past_key_values: Optional[PastKeyValues] = None
+        self._attention_mask: Optional[Tensor] = None
+        self._next_input_ids: Optional[Tensor] = None
+        self._seen_tokens: Optional[Tensor] = None  # [batch_size, vocab_size] for the repetition_penalty
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _to_cache(self, past_key_values: Optional[PastKeyValues]) -> Any:
+        if DynamicCache is not None and getattr(self.model, '_supports_cache_class', False):
+            return DynamicCache.from_legacy_cache(past_key_values)
+        return past_key_values
+
+    @staticmethod
+    def _from_cache(past_key_values: Any) -> Optional[PastKeyValues]:
+        if DynamicCache is not None and isinstance(past_key_values, DynamicCache):
+            past_key_values = past_key_values.to_legacy_cache()
+        if not isinstance(past_key_values, (tuple, list)):
+            return None
+        return tuple(tuple(layer) for layer in past_key_values)
+
+    @torch.inference_mode()
+    def _check_kv_cache(self) -> bool:
+        if getattr(self.model.config, 'is_encoder_decoder', False) or self.template.is_multimodal:
+            return False
+        seq_len = 3
+        input_ids = torch.full((1, seq_len), self.tokenizer.eos_token_id or 0, device=self.device)
+        try:
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                position_ids=torch.arange(seq_len, device=self.device)[None],
+                past_key_values=self._to_cache(None),
+                use_cache=True)
+        except Exception as e:  # e.g. position_ids is not supported
+            logger.info(f'The check of the KV cache failed: {e}')
+            return False
+        past_key_values = self._from_cache(getattr(outputs, 'past_key_values', None))
+        if not past_key_values:
+            return False
+        for layer in past_key_values:
+            if len(layer) != 2 or any(t.dim() != 4 or t.shape[0] != 1 or t.shape[2] != seq_len for t in layer):
+                return False
+        return True
+
+    def is_batchable(self, inputs: Dict[str, Any], generation_config: GenerationConfig) -> bool:
+        """Whether the request can be generated in the continuous batch."""
+        if not self.supports_batching or 'input_ids' not in inputs or set(inputs.keys()) - {'input_ids', 'labels'}:
+            return False
+        if getattr(self.model, 'speculative_model', None) is not None or getattr(
+                generation_config, 'prompt_lookup_num_tokens', None) is not None:
+            return False  # The speculative decoding is run by `inference` (see `_prepare_speculative_decoding`).
+        return generation_config.num_beams == 1 and not getattr(generation_config, 'no_repeat_ngram_size', None)
+
+    def _put(self, item: Union[_PtRequest, _PtJob]) -> None:
+        with self._cond:
+            self._waiting.append(item)
+            self._cond.notify()
+
+    async def generate(self,
+                       input_ids: List[int],
+                       generation_config: GenerationConfig,
+                       stop_words: Optional[StopWords] = None,
+                       adapter_names: Optional[List[str]] = None,
+                       tokenizer_kwargs: Optional[Dict[str, Any]] = None,
+                       metrics: Optional[Dict[str, float]] = None) -> AsyncIterator[Tuple[List[int], bool]]:
+        """Generate in the continuous batch. yield: generate_ids, is_finished
+
+        metrics: If not None, the time waiting in the queue (seconds) is set to metrics['queue_time'].
+        """
+        stop_words = list(stop_words or [])
+        if self.template.suffix[-1] not in stop_words:
+            stop_words.append(self.template.suffix[-1])
+        loop = asyncio.get_running_loop()
+        tokenizer_kwargs = tokenizer_kwargs or {}
+        stop_matcher = StopWordsMatcher(self.tokenizer, stop_words, **tokenizer_kwargs)
+        stop_matcher.add_context(input_ids)
+        request = _PtRequest(
+            input_ids,
+            generation_config,
+            stop_words,
+            adapter_names,
+            tokenizer_kwargs,
+            loop,
+            asyncio.Queue(),
+            stop_matcher,
+            metrics=metrics)
+        self._put(request)
+        generate_ids = []
+        try:
+            while True:
+                token_list, is_finished = await request.queue.get()
+                # skip the outdated outputs
+                while not is_finished and not request.queue.empty():
+                    generate_ids += token_list
+                    token_list, is_finished = request.queue.get_nowait()
+                if isinstance(token_list, Exception):
+                    raise token_list
+                generate_ids += token_list
+                yield generate_ids, is_finished
+                if is_finished:
+                    break
+        finally:
+            request.is_aborted = True
+
+    async def run(self, func: Callable[[], _T], metrics: Optional[Dict[str, float]] = None) -> _T:
+        """Run the blocking function in the worker thread."""
+        job = _PtJob(func, asyncio.get_running_loop(), asyncio.Queue(), metrics=metrics)
+        self._put(job)
+        try:
+            res = await job.queue.get()
+        finally:
+            job.is_aborted = True
+        if isinstance(res, Exception):
+            raise res
+        return res
+
+    async def run_stream(self,
+                         func: Callable[[], Iterator[_T]],
+                         metrics: Optional[Dict[str, float]] = None) -> AsyncIterator[_T]:
+        """Run the blocking generator function in the worker thread, and yield its outputs."""
+        job = _PtJob(func, asyncio.get_running_loop(), asyncio.Queue(), is_stream=True, metrics=metrics)
+        self._put(job)
+        try:
+            while True:
+                res = await job.queue.get()
+                if res is _STOP:
+                    break
+                if isinstance(res, Exception):
+                    raise res
+                yield res
+        finally:
+            job.is_aborted = True
+
+    @staticmethod
+    def _set_queue_time(request: Union[_PtRequest, _PtJob]) -> None:
+        if request.metrics is not None:
+            request.metrics['queue_time'] = time.perf_counter() - request.arrival_time
+
+    @staticmethod
+    def _send(request: Union[_PtRequest, _PtJob], item: Any) -> None:
+        request.loop.call_soon_threadsafe(request.queue.put_nowait, item)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while len(self._waiting) == 0 and len(self._requests) == 0:
+                    self._cond.wait()
+                new_requests = []
+                job = None
+                while len(self._waiting) > 0 and len(self._requests) + len(new_requests) < self.max_batch_size:
+                    item = self._waiting[0]
+                    if isinstance(item, _PtJob):
+                        # The job waits for the running batch to finish.
+                        if len(self._requests) + len(new_requests) == 0:
+                            job = self._waiting.popleft()
+                            self._set_queue_time(job)
+                        break
+                    if not self._is_compatible(item, self._requests + new_requests):
+                        break
+                    new_requests.append(self._waiting.popleft())
+                    self._set_queue_time(new_requests[-1])
+            try:
+                if job is not None:
+                    self._run_job(job)
+                    continue
+                new_requests = [request for request in new_requests if not request.is_aborted]
+                with torch.inference_mode():
+                    if len(new_requests) > 0:
+                        self._prefill(new_requests)
+                    elif len(self._requests) > 0:
+                        self._decode()
+            except Exception as e:
+                logger.error(f'PtEngine error: {e}')
+                for request in self._requests + new_requests:
+                    self._send(request, (e, True))
+                self._requests = []
+                self._past_key_values = None
+
+    def _is_compatible(self, request: _PtRequest, requests: List[_PtRequest]) -> bool:
+        """Whether the request can join the batch. The requests targeting different adapters are batched together
+        (routed per row), within the number of the adapters on the GPU (see `LoRAAdapterCache`)."""
+        if len(requests) == 0:
+            return True
+        if (request.adapter_names is None) != (requests[0].adapter_names is None):
+            return False
+        lora_cache: Optional[LoRAAdapterCache] = getattr(self.model, 'lora_cache', None)
+        if request.adapter_names is None or lora_cache is None:
+            return True
+        adapter_names = [name for r in requests + [request] for name in r.adapter_names]
+        return lora_cache.count_adapters(adapter_names) <= lora_cache.max_loras
+
+    @staticmethod
+    def _get_adapter_names(requests: List[_PtRequest]) -> Optional[List[str]]:
+        """The adapter of each row of the batch."""
+        if requests[0].adapter_names is None:
+            return None
+        return [name for request in requests for name in request.adapter_names]
+
+    def _run_job(self, job: _PtJob) -> None:
+        if job.is_aborted:
+            return
+        try:
+            if not job.is_stream:
+                self._send(job, job.func())
+                return
+            gen = job.func()
+            for res in gen:
+                if job.is_aborted:
+                    gen.close()
+                    break
+                self._send(job, res)
+        except Exception as e:
+            self._send(job, e)
+            return
+        if job.is_stream:
+            self._send(job, _STOP)
+
+    def _forward(self, input_ids: Tensor, attention_mask: Tensor, position_ids: Tensor,
+                 past_key_values: Optional[PastKeyValues], adapter_names: Optional[List[str]]) -> Tuple[Tensor, Any]:
+        kwargs = {}
+        if adapter_names is not None:
+            kwargs['adapter_names'] = adapter_names
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._to_cache(past_key_values),
+            use_cache=True,
+            **kwargs)
+        return outputs.logits[:, -1].float(), self._from_cache(outputs.past_key_values)
+
+    def _prefill(self, requests: List[_PtRequest]) -> None:
+        prefix_cache: Optional[PrefixCache] = getattr(self.model, 'prefix_cache', None)
+        if prefix_cache is None:
+            self._prefill_batch(requests)
+            return
+        uncached_requests = []
+        for request in requests:
+            past_key_values = prefix_cache.match(request.input_ids, request.adapter_names)
+            if past_key_values is None:
+                uncached_requests.append(request)
+            else:
+                # Only prefill the tokens after the cached prefix.
+                self._prefill_batch([request], past_key_values)
+        if len(uncached_requests) > 0:
+            self._prefill_batch(uncached_requests)
+
+    def _prefill_batch(self, requests: List[_PtRequest], past_key_values: Optional[PastKeyValues] = None) -> None:
+        num_cached = 0
+        if past_key_values is not None:
+            assert len(requests) == 1
+            num_cached = past_key_values[0][0].shape[2]
+        max_len = max(len(request.input_ids) for request in requests)
+        input_ids = torch.full((len(requests), max_len), self.tokenizer.pad_token_id or 0, dtype=torch.int64)
+        attention_mask = torch.zeros((len(requests), max_len), dtype=torch.int64)
+        for i, request in enumerate(requests):
+            seq_len = len(request.input_ids)
+            input_ids[i, max_len - seq_len:] = torch.tensor(request.input_ids)
+            attention_mask[i, max_len - seq_len:] = 1
+        input_ids, attention_mask = input_ids.to(self.device), attention_mask.to(self.device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp_(min=0)
+        logits, past_key_values = self._forward(input_ids[:, num_cached:], attention_mask, position_ids[:, num_cached:],
+                                                past_key_values, self._get_adapter_names(requests))
+        seen_tokens = torch.zeros((len(requests), logits.shape[-1]), dtype=torch.int64, device=logits.device)
+        seen_tokens = seen_tokens.scatter_add_(1, input_ids.to(logits.device), attention_mask.to(logits.device)) > 0
+        self._merge_batch(requests, past_key_values, attention_mask, seen_tokens)
+        self._sample_and_update(logits, len(self._requests) - len(requests))
+
+    def _merge_batch(self, requests: List[_PtRequest], past_key_values: PastKeyValues, attention_mask: Tensor,
+                     seen_tokens: Tensor) -> None:
+        """Merge the prefilled requests into the running batch, the KV cache is left-padded to the same length."""
+        if len(self._requests) == 0:
+            self._requests = requests
+            self._past_key_values = past_key_values
+            self._attention_mask = attention_mask
+            self._seen_tokens = seen_tokens
+            self._next_input_ids = None
+            return
+        old_len, new_len = self._attention_mask.shape[1], attention_mask.shape[1]
+        max_len = max(old_len, new_len)
+
+        def _left_pad(x: Tensor, pad_len: int, dim: int) -> Tensor:
+            if pad_len == 0:
+                return x
+            return F.pad(x, (0, 0) * (x.dim() - 1 - dim) + (pad_len, 0))
+
+        self._past_key_values = tuple(
+            tuple(
+                torch.cat([_left_pad(old, max_len - old_len, 2),
+                           _left_pad(new, max_len - new_len, 2)]) for old, new in zip(old_layer, new_layer))
+            for old_layer, new_layer in zip(self._past_key_values, past_key_values))
+        self._attention_mask = torch.cat(
+            [_left_pad(self._attention_mask, max_len - old_len, 1),
+             _left_pad(attention_mask, max_len - new_len, 1)])
+        self._seen_tokens = torch.cat([self._seen_tokens, seen_tokens])
+        # The pending tokens of the old requests, and the placeholders of the new requests (filled by sampling).
+        self._next_input_ids = torch.cat([self._next_input_ids, self._next_input_ids.new_zeros((len(requests), 1))])
+        self._requests = self._requests + requests
+
+    def _decode(self) -> None:
+        self._attention_mask = F.pad(self._attention_mask, (0, 1), value=1)
+        position_ids = self._attention_mask.sum(-1, keepdim=True) - 1
+        logits, self._past_key_values = self._forward(self._next_input_ids, self._attention_mask, position_ids,
+                                                      self._past_key_values, self._get_adapter_names(self._requests))
+        self._sample_and_update(logits)
+
+    def _sample_and_update(self, logits: Tensor, start_idx: int = 0) -> None:
+        """Sample the next tokens of the requests[start_idx:], and remove the finished requests from the batch."""
+        requests = self._requests[start_idx:]
+        next_tokens = self._sample(logits, requests, self._seen_tokens[start_idx:])
+        self._seen_tokens[start_idx:].scatter_(1, next_tokens[:, None], True)
+        next_input_ids = next_tokens[:, None].to(self.device)
+        if start_idx == 0:
+            self._next_input_ids = next_input_ids
+        else:
+            self._next_input_ids[start_idx:] = next_input_ids
+
+        keep_idx = list(range(start_idx))
+        prefix_cache: Optional[PrefixCache] = getattr(self.model, 'prefix_cache', None)
+        for i, (request, token) in enumerate(zip(requests, next_tokens.tolist())):
+            request.generate_ids.append(token)
+            is_aborted = request.is_aborted  # set by the consumer after receiving the last token
+            is_finished = is_aborted or self._is_finished(request)
+            self._send(request, ([token], is_finished))
+            if not is_finished:
+                keep_idx.append(start_idx + i)
+            elif prefix_cache is not None and not is_aborted:
+                self._update_prefix_cache(prefix_cache, start_idx + i)
+        if len(keep_idx) == len(self._requests):
+            return
+        self._requests = [self._requests[i] for i in keep_idx]
+        if len(self._requests) == 0:
+            self._past_key_values = None
+            return
+        idx = torch.tensor(keep_idx, device=self.device)
+        self._attention_mask = self._attention_mask[idx]
+        self._next_input_ids = self._next_input_ids[idx]
+        self._seen_tokens = self._seen_tokens[idx.to(self._seen_tokens.device)]
+        # Remove the padding columns shared by all the requests.
+        num_pad = int((self._attention_mask.cumsum(-1) == 0).all(0).sum())
+        self._attention_mask = self._attention_mask[:, num_pad:]
+        self._past_key_values = tuple(
+            tuple(t[idx.to(t.device), :, num_pad:] for t in layer) for layer in self._past_key_values)
+
+    def _update_prefix_cache(self, prefix_cache: PrefixCache, idx: int) -> None:
+        """Store the KV cache of the finished request (without the left padding) in the prefix cache."""
+        request = self._requests[idx]
+        num_pad = int((self._attention_mask[idx] == 0).sum())
+        past_key_values = tuple(tuple(t[idx:idx + 1, :, num_pad:] for t in layer) for layer in self._past_key_values)
+        # The KV cache of the last sampled token is not computed.
+        prefix_cache.update(request.input_ids + request.generate_ids[:-1], past_key_values, request.adapter_names)
+
+    @staticmethod
+    def _sample(logits: Tensor, requests: List[_PtRequest], seen_tokens: Tensor) -> Tensor:
+        """Sample the next tokens with the generation_config of each request
+        (repetition_penalty, temperature, top_k, top_p in the order of the logits processors of transformers)."""
+        device = logits.device
+        configs = [request.generation_config for request in requests]
+        repetition_penalty = torch.tensor([c.repetition_penalty or 1. for c in configs], device=device)[:, None]
+        if (repetition_penalty != 1.).any():
+            penalized = torch.where(logits < 0, logits * repetition_penalty, logits / repetition_penalty)
+            logits = torch.where(seen_tokens, penalized, logits)
+        next_tokens = logits.argmax(-1)
+        do_sample = torch.tensor([bool(c.do_sample) for c in configs], device=device)
+        if not do_sample.any():
+            return next_tokens
+        temperature = torch.tensor([c.temperature or 1. for c in configs], device=device)[:, None]
+        top_k = torch.tensor([c.top_k or logits.shape[-1] for c in configs], device=device)[:, None]
+        top_p = torch.tensor([1. if c.top_p is None else c.top_p for c in configs], device=device)[:, None]
+        sorted_logits, sorted_idx = (logits / temperature).sort(-1, descending=True)
+        ranks = torch.arange(logits.shape[-1], device=device)[None]
+        sorted_logits = sorted_logits.masked_fill(ranks >= top_k, float('-inf'))
+        probs = sorted_logits.softmax(-1)
+        to_remove = probs.cumsum(-1) - probs >= top_p
+        to_remove[:, 0] = False
+        probs = sorted_logits.masked_fill(to_remove, float('-inf')).softmax(-1)
+        sampled_tokens = sorted_idx.gather(1, torch.multinomial(probs, 1)).squeeze(1)
+        return torch.where(do_sample, sampled_tokens, next_tokens)
+
+    def _is_finished(self, request: _PtRequest) -> bool:
+        generate_ids = request.generate_ids
+        eos_token_id = request.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = self.tokenizer.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        if generate_ids[-1] in (eos_token_id or []):
+            return True
+        max_new_tokens = request.generation_config.max_new_tokens
+        if max_new_tokens is not None and len(generate_ids) >= max_new_tokens:
+            return True
+        return request.stop_matcher.update(generate_ids[-1:])
+
+
+@torch.inference_mode()
+def inference_pt(pt_engine: PtEngine,
+                 template: Template,
+                 request_list: List[Dict[str, Any]],
+                 *,
+                 generation_config: Optional[GenerationConfig] = None,
+                 generation_info: Optional[Dict[str, Any]] = None,
+                 stop_words: Optional[StopWords] = None,
+                 adapter_names: Optional[List[str]] = None,
+                 use_tqdm: bool = False,
+                 **kwargs) -> List[Dict[str, Any]]:
+    """Batched inference with the continuous batching of the `pt_engine`.
+
+    The requests are submitted in the descending order of the prompt lengths to reduce the padding, and each sequence
+    stops independently (eos, max_new_tokens, stop_words). The requests that cannot be batched
+    (e.g. multimodal, beam search) are generated one by one by `inference`.
+
+    request_list: e.g. [{'query': 'hello!'}].
+        The keys that can be included are: 'query', 'history', 'system', 'images', 'tools', 'objects'.
+    generation_config: Priority: generation_config > model.generation_config.
+    return: e.g. [{'response': 'hi!', 'history': [('hello!', 'hi!')]}], in the order of the request_list.
+        The keys to be included will be: 'response', 'history'.
+    """
+    if len(request_list) == 0:
+        return []
+    runtime = time.perf_counter()
+    model = pt_engine.model
+    tokenizer = template.tokenizer
+    if generation_config is None:
+        generation_config = getattr(model, 'generation_config')
+    if generation_info is None:
+        generation_info = {}
+    else:
+        generation_info.clear()
+    generation_info.update({'num_prompt_tokens': 0, 'num_generated_tokens': 0, 'num_samples': len(request_list)})
+    request_list = deepcopy(request_list)
+    resp_list: List[Optional[Dict[str, Any]]] = [None] * len(request_list)
+    for request in request_list:
+        request['history'] = request.get('history') or []
+
+    prog_bar = tqdm(total=len(request_list), dynamic_ncols=True, disable=not use_tqdm)
+    batch_list = []  # idx, inputs, tokenizer_kwargs, generation_config
+    if pt_engine.supports_batching and generation_config.num_beams == 1:
+        template.model = model
+        for i, (inputs, tokenizer_kwargs) in enumerate(template.encode_batch(request_list)):
+            if len(inputs) == 0:
+                # input_ids exceeds `max_length`. Please increase the value of `max_length`.
+                resp_list[i] = {'response': '', 'history': request_list[i]['history']}
+                prog_bar.update()
+                continue
+            if not pt_engine.is_batchable(inputs, generation_config):
+                continue
+            request_config = deepcopy(generation_config)
+            _prepare_generation_config(model, tokenizer, request_config, len(inputs['input_ids']))
+            batch_list.append((i, inputs, tokenizer_kwargs, request_config))
+        batch_list.sort(key=lambda x: len(x[1]['input_ids']), reverse=True)
+
+    generate_ids_list: List[Optional[List[int]]] = [None] * len(request_list)
+
+    async def _generate(i: int, inputs: Dict[str, Any], tokenizer_kwargs: Dict[str, Any],
+                        request_config: GenerationConfig) -> None:
+        generate_ids = []
+        async for generate_ids, _ in pt_engine.generate(inputs['input_ids'], request_config, stop_words, adapter_names,
+                                                        tokenizer_kwargs):
+            pass
+        generate_ids_list[i] = generate_ids
+        prog_bar.update()
+
+    async def _generate_all() -> None:
+        # The tasks are started (and queued in the engine) in the order of the batch_list.
+        await asyncio.gather(*[_generate(*item) for item in batch_list])
+
+    if len(batch_list) > 0:
+        asyncio.run(_generate_all())
+    for i, inputs, tokenizer_kwargs, _ in batch_list:
+        request = request_list[i]
+        generate_ids = generate_ids_list[i]
+        response = template.generate_ids_to_response(generate_ids, tokenizer_kwargs=tokenizer_kwargs)
+        response = template.post_process_generate_response(response=response, example=request)
+        history = request['history']
+        # agent support
+        is_observation = history[-1][-1].endswith('Observation:') if history and history[-1][-1] else False
+        if not is_observation:
+            history.append([request['query'], response])
+        else:
+            history[-1][-1] = history[-1][-1] + request['query'] + response
+        generation_info['num_prompt_tokens'] += len(inputs['input_ids'])
+        generation_info['num_generated_tokens'] += len(generate_ids)
+        resp_list[i] = {'response': response, 'history': history}
+
+    request_info = {}
+    for i, request in enumerate(request_list):
+        if resp_list[i] is not None:
+            continue
+        response, history = inference(
+            model,
+            template,
+            **request,
+            generation_config=generation_config,
+            generation_info=request_info,
+            stop_words=deepcopy(stop_words),
+            adapter_names=adapter_names,
+            **kwargs)
+        generation_info['num_prompt_tokens'] += request_info.get('num_prompt_tokens', 0)
+        generation_info['num_generated_tokens'] += request_info.get('num_generated_tokens', 0)
+        resp_list[i] = {'response': response, 'history': history}
+        prog_bar.update()
+    prog_bar.close()
+    runtime = time.perf_counter() - runtime
+    generation_info['runtime'] = runtime
+    generation_info['samples/s'] = generation_info['num_samples'] / runtime
+    generation_info['tokens/s'] = generation_info['num_generated_tokens'] / runtime
+    return resp_list
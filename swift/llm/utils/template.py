@@ -1,9 +1,12 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
+import itertools
 import re
+import threading
+from collections import OrderedDict, deque
 from copy import deepcopy
 from functools import partial
 from types import MethodType
-from typing import Any, Dict, List, Literal, Optional, Tuple, TypeVar, Union
+from typing import Any, Dict, Hashable, List, Literal, Optional, Sequence, Tuple, TypeVar, Union
 
 import json
 import numpy as np
@@ -28,6 +31,10 @@ Prompt = List[Union[str, List[int], List[str]]]
 StopWords = Prompt
 Context = Union[str, List[int]]
 TEMPLATE_MAPPING: Dict[str, Dict[str, Any]] = {}
+# Guards the LRU cache of the rounds of the templates (`_round_cache`), which is shared by the threads of the
+# deployment.
+# (A module-level lock, so the templates can still be deepcopied and pickled.)
+_cache_lock = threading.Lock()
 
 
 class TemplateType:
@@ -125,30 +132,194 @@ class TemplateType:
         return res
 
 
+class _AhoCorasick:
+    """The Aho-Corasick automaton, which matches multiple patterns (sequences of chars or token ids) in a stream."""
+
+    def __init__(self, patterns: List[Sequence[Hashable]]) -> None:
+        self.goto: List[Dict[Hashable, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.is_end: List[bool] = [False]
+        for pattern in patterns:
+            node = 0
+            for x in pattern:
+                next_node = self.goto[node].get(x)
+                if next_node is None:
+                    next_node = len(self.goto)
+                    self.goto[node][x] = next_node
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.is_end.append(False)
+                node = next_node
+            self.is_end[node] = True
+        # BFS
+        queue = deque(self.goto[0].values())
+        while len(queue) > 0:
+            node = queue.popleft()
+            for x, next_node in self.goto[node].items():
+                fail = self.fail[node]
+                while fail > 0 and x not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_node] = self.goto[fail].get(x, 0)
+                self.is_end[next_node] = self.is_end[next_node] or self.is_end[self.fail[next_node]]
+                queue.append(next_node)
+        self.state = 0
+
+    def feed(self, seq: Sequence[Hashable]) -> bool:
+        """Feed the new elements, return whether a pattern ends in them."""
+        goto, fail, node = self.goto, self.fail, self.state
+        is_matched = False
+        for x in seq:
+            while node > 0 and x not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(x, 0)
+            is_matched = is_matched or self.is_end[node]
+        self.state = node
+        return is_matched
+
+
+class IncrementalDetokenizer:
+    """Decode the growing token ids incrementally, with the prefix offsets as `detokenize_incrementally` in vLLM.
+
+    Each call only decodes a window of the last few tokens instead of the whole sequence. The text of the incomplete
+    characters (ending with '\ufffd') is held back until the following tokens arrive. The final text is decoded
+    as a whole, because `clean_up_tokenization_spaces` may change the text across the windows.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, **tokenizer_kwargs) -> None:
+        self.tokenizer = tokenizer
+        self.tokenizer_kwargs = tokenizer_kwargs
+        self.reset()
+
+    def reset(self) -> None:
+        self.text = ''
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self._num_tokens = 0
+        self._last_token = None
+
+    def decode(self, token_ids: List[int], is_finished: bool = False) -> str:
+        """token_ids: All the token ids, which extend the token ids of the last call
+            (otherwise the text is decoded from scratch).
+        return: The text of the token_ids.
+        """
+        num_tokens = self._num_tokens
+        if len(token_ids) < num_tokens or num_tokens > 0 and token_ids[num_tokens - 1] != self._last_token:
+            self.reset()
+        self._num_tokens = len(token_ids)
+        self._last_token = token_ids[-1] if len(token_ids) > 0 else None
+        if is_finished:
+            self.text = self.tokenizer.decode(token_ids, **self.tokenizer_kwargs)
+            self.prefix_offset = self.read_offset = len(token_ids)
+            return self.text
+        if len(token_ids) == self.read_offset:
+            return self.text
+        prefix_text = self.tokenizer.decode(token_ids[self.prefix_offset:self.read_offset], **self.tokenizer_kwargs)
+        new_text = self.tokenizer.decode(token_ids[self.prefix_offset:], **self.tokenizer_kwargs)
+        if len(new_text) > len(prefix_text) and not new_text.endswith('\ufffd'):
+            self.text += new_text[len(prefix_text):]
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(token_ids)
+        return self.text
+
+
+class StopWordsMatcher:
+    """Match the stop words incrementally, by the Aho-Corasick automatons on the new token ids (for the stop words
+    of List[int]) and on the new text of the `IncrementalDetokenizer` (for the stop words of str)."""
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, stop_words: StopWords, **tokenizer_kwargs) -> None:
+        token_stop_words = [tuple(stop_word) for stop_word in stop_words if isinstance(stop_word, list)]
+        token_stop_words = [stop_word for stop_word in token_stop_words if len(stop_word) > 0]
+        str_stop_words = [stop_word for stop_word in stop_words if isinstance(stop_word, str) and len(stop_word) > 0]
+        self.max_token_len = max([len(stop_word) for stop_word in token_stop_words], default=0)
+        self._token_automaton = _AhoCorasick(token_stop_words) if len(token_stop_words) > 0 else None
+        self._str_automaton = None
+        if len(str_stop_words) > 0:
+            self._str_automaton = _AhoCorasick(str_stop_words)
+            self._detokenizer = IncrementalDetokenizer(tokenizer, **tokenizer_kwargs)
+            self._generate_ids: List[int] = []
+            self._text_len = 0
+
+    def add_context(self, input_ids: List[int]) -> None:
+        """The stop words of List[int] can start in the input_ids."""
+        if self._token_automaton is not None and self.max_token_len > 1:
+            self._token_automaton.feed(input_ids[-(self.max_token_len - 1):])
+
+    def update(self, token_ids: List[int]) -> bool:
+        """token_ids: The new generated token ids. return: whether a stop word is matched."""
+        is_matched = False
+        if self._token_automaton is not None:
+            is_matched = self._token_automaton.feed(token_ids)
+        if self._str_automaton is not None:
+            self._generate_ids += token_ids
+            text = self._detokenizer.decode(self._generate_ids)
+            is_matched = self._str_automaton.feed(text[self._text_len:]) or is_matched
+            self._text_len = len(text)
+        return is_matched
+
+    def get_state(self) -> Tuple[Any, ...]:
+        """The state of the matching, which can be restored by `set_state` (e.g. to match the tentative tokens)."""
+        state = (self._token_automaton and self._token_automaton.state, )
+        if self._str_automaton is not None:
+            detokenizer = self._detokenizer
+            state += (self._str_automaton.state, len(self._generate_ids), self._text_len, detokenizer.text,
+                      detokenizer.prefix_offset, detokenizer.read_offset, detokenizer._num_tokens,
+                      detokenizer._last_token)
+        return state
+
+    def set_state(self, state: Tuple[Any, ...]) -> None:
+        if self._token_automaton is not None:
+            self._token_automaton.state = state[0]
+        if self._str_automaton is not None:
+            detokenizer = self._detokenizer
+            (self._str_automaton.state, num_tokens, self._text_len, detokenizer.text, detokenizer.prefix_offset,
+             detokenizer.read_offset, detokenizer._num_tokens, detokenizer._last_token) = state[1:]
+            del self._generate_ids[num_tokens:]
+
+
 class StopWordsCriteria(StoppingCriteria):
+    """start_idx: The index of the first generated token in the input_ids.
+        -1: The first call has only one generated token (the input_ids may not include the prompt).
+
+    The calls with the candidate tokens of the speculative decoding (e.g. `assistant_model`,
+    `prompt_lookup_num_tokens`) are supported: if the input_ids do not extend the ones of the last call
+    (some of the candidate tokens are rejected), the matching is restarted from the state before the last call.
+    """
+
     # The returned sentence includes stop words.
-    def __init__(self, tokenizer: PreTrainedTokenizerBase, stop_words: StopWords, **tokenizer_kwargs) -> None:
+    def __init__(self,
+                 tokenizer: PreTrainedTokenizerBase,
+                 stop_words: StopWords,
+                 *,
+                 start_idx: int = -1,
+                 **tokenizer_kwargs) -> None:
         self.tokenizer = tokenizer
         self.stop_words = stop_words
         self.tokenizer_kwargs = tokenizer_kwargs
-        self.start_idx = -1
-
-    def __call__(self, input_ids: Tensor, scores: Tensor, **kwargs) -> bool:
-        if self.start_idx == -1:
-            self.start_idx = len(input_ids[0]) - 1
-        tokenizer = self.tokenizer
-        stop_words = self.stop_words
-        # [-20:]: Assuming the end tokens do not exceed 20 tokens,
-        #   to avoid input_ids being too long and affecting efficiency.
-        text = tokenizer.decode(input_ids[0, self.start_idx:][-20:], **self.tokenizer_kwargs)
-        for stop_word in stop_words:
-            if isinstance(stop_word, str):
-                if stop_word in text:
-                    return True
-            else:  # list
-                if len(stop_word) > 0 and input_ids[0].tolist()[-len(stop_word):] == stop_word:
-                    return True
-        return False
+        self.start_idx = start_idx
+        self.matcher = StopWordsMatcher(tokenizer, stop_words, **tokenizer_kwargs)
+        self._num_tokens = -1  # The checkpoint: the number of the matched tokens before the last call
+        self._state = None  # The state of the matcher at the checkpoint
+        self._token_ids: List[int] = []  # The new token ids of the last call
+
+    def __call__(self, input_ids: Tensor, scores: Optional[Tensor], **kwargs) -> bool:
+        if self._num_tokens == -1:
+            if self.start_idx == -1:
+                self.start_idx = input_ids.shape[1] - 1
+            self.matcher.add_context(input_ids[0, max(self.start_idx
+                                                      - self.matcher.max_token_len, 0):self.start_idx].tolist())
+            self._num_tokens = self.start_idx
+            self._state = self.matcher.get_state()
+        # Only the new tokens are matched.
+        token_ids = input_ids[0, self._num_tokens:].tolist()
+        num_last_tokens = len(self._token_ids)
+        if token_ids[:num_last_tokens] == self._token_ids:
+            self._num_tokens += num_last_tokens
+            self._state = self.matcher.get_state()
+            token_ids = token_ids[num_last_tokens:]
+        else:
+            self.matcher.set_state(self._state)
+        self._token_ids = token_ids
+        return self.matcher.update(token_ids)
 
 
 class Template:
@@ -175,6 +346,7 @@ class Template:
     grounding_type = 'norm_1000'
     image_placeholder = ['<image>']
     load_medias = True
+    round_cache_size = 1024
 
     def __init__(self,
                  prefix: Prompt,
@@ -214,6 +386,12 @@ class Template:
         self._is_vllm = False
         self._is_lmdeploy = False
         self.padding_side = padding_side
+        self._fragment_pattern = None
+        self._fragment_cache: Dict[str, List[int]] = {}
+        self._fragment_prefixes: List[str] = []
+        self._round_cache: Dict[tuple, List[int]] = OrderedDict()
+        # thread_id -> the texts tokenized by `encode_batch`
+        self._batch_tokens: Dict[int, Dict[str, List[int]]] = {}
 
     @staticmethod
     def _replace_system(prefix: Prompt) -> Prompt:
@@ -284,6 +462,96 @@ class Template:
 
         if self.model:
             self.model.register_forward_pre_hook(self._pre_forward_hook, with_kwargs=True)
+        self._round_cache.clear()
+        self._init_fragment_cache()
+
+    def _is_separable(self, token: str) -> bool:
+        """Whether the text around the token can be tokenized separately without changing the result."""
+        for left, right in itertools.product(['', 'a', ' a', '\n', 'a\n', '你好'], repeat=2):
+            token_list = self._tokenize(left) + self._tokenize(token) + self._tokenize(right)
+            if self._tokenize(left + token + right) != token_list:
+                return False
+        return True
+
+    def _is_prefix_separable(self, prefix: str) -> bool:
+        """Whether the text after the prefix can be tokenized separately without changing the result."""
+        for right in ['a', ' a', 'A', '1', '\n', 'a\n', '你好', '(a)', '<a>']:
+            if self._tokenize(prefix + right) != self._tokenize(prefix) + self._tokenize(right):
+                return False
+        return True
+
+    def _init_fragment_cache(self) -> None:
+        """Split the template strings at the placeholders (e.g. `{{QUERY}}`) and the special tokens of the template
+        (e.g. `<|im_start|>`), so that the constant fragments (e.g. `assistant\n`, the default system) are tokenized
+        only once. The cache only holds these constant fragments, the text of the examples is never cached.
+        The constant fragments followed by a placeholder (e.g. `user\n` of `user\n{{QUERY}}`) are split from the
+        text of the example when the tokenization allows it (see `_fragment_prefixes`).
+        """
+        self._fragment_cache = {}
+        self._fragment_prefixes = []
+        self._fragment_pattern = None
+        added_tokens_decoder = getattr(self.tokenizer, 'added_tokens_decoder', None)
+        if not added_tokens_decoder:
+            return
+        constant_contexts = [self.default_system or '']
+        for key in ['prefix', 'prompt', 'chat_sep', 'suffix', 'system_prefix', 'tool_prompt']:
+            constant_contexts += [context for context in getattr(self, key) or [] if isinstance(context, str)]
+        template_str = '\n'.join(constant_contexts)
+        special_tokens = [
+            token.content for token in added_tokens_decoder.values()
+            if token.content in template_str and not (token.lstrip or token.rstrip or token.single_word)
+            and not token.normalized and self._is_separable(token.content)
+        ]
+        if len(special_tokens) == 0:
+            return
+        special_tokens.sort(key=len, reverse=True)
+        self._fragment_pattern = re.compile('(' + '|'.join(re.escape(token) for token in special_tokens) + ')')
+        if self.default_system:
+            # e.g. `system\nYou are a helpful assistant.`
+            constant_contexts += [
+                context.replace('{{SYSTEM}}', self.default_system) for context in constant_contexts
+                if '{{SYSTEM}}' in context
+            ]
+        fragment_cache = {}
+        fragment_prefixes = set()
+        for context in constant_contexts:
+            parts = re.split(r'(\{\{[A-Z0-9]+\}\})', context)
+            for i in range(0, len(parts), 2):
+                fragments = [fragment for fragment in self._fragment_pattern.split(parts[i]) if fragment]
+                for fragment in fragments:
+                    fragment_cache[fragment] = self._tokenize(fragment)
+                # The text before a placeholder, which is not a special token.
+                if i + 1 < len(parts) and fragments and self._fragment_pattern.fullmatch(fragments[-1]) is None:
+                    fragment_prefixes.add(fragments[-1])
+        self._fragment_prefixes = sorted([prefix for prefix in fragment_prefixes if self._is_prefix_separable(prefix)],
+                                         key=len,
+                                         reverse=True)
+        self._fragment_cache = fragment_cache
+
+    def _split_fragments(self, context: str) -> List[Union[str, List[int]]]:
+        """Split the context into the token ids of the cached fragments and the texts to be tokenized."""
+        if self._fragment_pattern is None:
+            return [context]
+        res = []
+        for fragment in self._fragment_pattern.split(context):
+            if len(fragment) == 0:
+                continue
+            fragment_tokens = self._fragment_cache.get(fragment)
+            if fragment_tokens is not None:
+                res.append(fragment_tokens)
+                continue
+            prefix = next((prefix for prefix in self._fragment_prefixes if fragment.startswith(prefix)), None)
+            if prefix is not None:
+                res.append(self._fragment_cache[prefix])
+                fragment = fragment[len(prefix):]
+            res.append(fragment)
+        return res
+
+    def _tokenize_fragments(self, context: str) -> List[int]:
+        token_list = []
+        for fragment in self._split_fragments(context):
+            token_list += self._tokenize(fragment) if isinstance(fragment, str) else fragment
+        return token_list
 
     def check_example(self, example: Dict[str, Any]) -> None:
         pass
@@ -444,6 +712,70 @@ class Template:
             _encode = MethodType(Template._encode, self)
         return _encode(example) if not streaming else _encode(example)[0]
 
+    def encode_batch(self, examples: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """Encode the examples with the same results as `encode`.
+
+        The texts of the context lists of the examples are tokenized by one tokenizer call (making use of the batch
+        parallelism of the fast tokenizers), and looked up by `encode`. The multimodal examples are tokenized one
+        by one.
+        """
+        encode = MethodType(type(self).encode, self)  # `encode` may be wrapped with `streaming=True`
+        texts: List[str] = []
+        for example in examples:
+            if any([example.get(key) for key in Template.special_keys]):
+                continue
+            example = self.preprocess(example)
+            history: History = example.get('history') or []
+            history = history + [[example.get('query') or '', example.get('response')]]
+            history_roles = example['history_roles'] + [[example.get('query_role') or 'user', 'assistant']]
+            system = example['system']
+            efficient_eos = self._is_efficient_eos()
+            res_context_list, loss_scale_list, prompt = self._get_prefix_context_list(system, self.auto_add_bos)
+            res_context_list, _ = self._concat_rounds(
+                res_context_list,
+                loss_scale_list,
+                prompt,
+                history,
+                history_roles,
+                system,
+                efficient_eos,
+                example=example)
+            for context in res_context_list:
+                if isinstance(context, str) and len(self._get_tokenizer_kwargs(context)) == 0:
+                    texts += [fragment for fragment in self._split_fragments(context) if isinstance(fragment, str)]
+        texts = list(dict.fromkeys(texts))
+        if len(texts) == 0:
+            return [encode(example) for example in examples]
+        input_ids = self.tokenizer(texts, return_attention_mask=False, add_special_tokens=False)['input_ids']
+        thread_id = threading.get_ident()
+        self._batch_tokens[thread_id] = dict(zip(texts, input_ids))
+        try:
+            return [encode(example) for example in examples]
+        finally:
+            self._batch_tokens.pop(thread_id, None)
+
+    def encode_rounds(self, example: Dict[str, Any]) -> Optional[List[List[int]]]:
+        """Encode the inference inputs of the example round by round (see `_encode_rounds`).
+
+        return: the token ids of [prefix, *history, query], None if not supported (e.g. multimodal).
+        """
+        example = self.preprocess(example)
+        if any([example.get(key) for key in Template.special_keys]):
+            return None
+        system = example.get('system')
+        res_context_list, loss_scale_list, prompt = self._get_prefix_context_list(system, self.auto_add_bos)
+        history = (example.get('history') or []) + [[example.get('query') or '', None]]
+        history_roles = example['history_roles'] + [[example.get('query_role') or 'user', 'assistant']]
+        return self._encode_rounds(
+            res_context_list,
+            loss_scale_list,
+            prompt,
+            history,
+            history_roles,
+            system,
+            self._is_efficient_eos(),
+            example=example)
+
     async def prepare_lmdeploy_inputs(self, inputs: Dict[str, Any]) -> None:
         images = inputs.pop('images', None) or []
         if len(images) == 0:
@@ -581,6 +913,12 @@ class Template:
         return res, loss_scale_res
 
     def _tokenize(self, context, **tokenizer_kwargs):
+        batch_tokens = self._batch_tokens.get(threading.get_ident())
+        if batch_tokens is not None and isinstance(context, str) and len(tokenizer_kwargs) == 0:
+            # see `encode_batch`
+            token_list = batch_tokens.get(context)
+            if token_list is not None:
+                return token_list.copy()
         return self.tokenizer(
             context, return_attention_mask=False, add_special_tokens=False, **tokenizer_kwargs)['input_ids']
 
@@ -702,7 +1040,10 @@ class Template:
                 # while curr_tokenizer_kwargs is the tokenizer_kwargs for the current context.
                 curr_tokenizer_kwargs = self._get_tokenizer_kwargs(context)
                 self._concat_tokenizer_kwargs(tokenizer_kwargs, curr_tokenizer_kwargs)
-                token_list = self._tokenize(context, **curr_tokenizer_kwargs)
+                if self._fragment_pattern is not None and len(curr_tokenizer_kwargs) == 0:
+                    token_list = self._tokenize_fragments(context)
+                else:
+                    token_list = self._tokenize(context, **curr_tokenizer_kwargs)
             else:
                 token_list = context
             input_ids += token_list
@@ -713,21 +1054,10 @@ class Template:
             loss_scale.extend([loss_weight] * len(token_list))
         return input_ids, labels, loss_scale, tokenizer_kwargs
 
-    def _concat_and_tokenize(self,
-                             query: str,
-                             query_role: str,
-                             response: Optional[str],
-                             history: History,
-                             history_roles: History,
-                             system: Optional[str],
-                             truncation_strategy: str,
-                             auto_add_bos: bool = False,
-                             **kwargs) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-        """
-        return: inputs, tokenizer_kwargs
-        """
-        history = history.copy()
-
+    def _get_prefix_context_list(self,
+                                 system: Optional[str],
+                                 auto_add_bos: bool = False) -> Tuple[List[Context], List[float], Prompt]:
+        """return: res_context_list, loss_scale_list, prompt"""
         res_context_list: List[Context] = []
         loss_scale_list: List[float] = []
         if auto_add_bos:
@@ -743,39 +1073,138 @@ class Template:
         else:
             prefix = self.system_prefix
         self._concat_context_list(prefix, res_context_list, loss_scale_list, system=system)
+        return res_context_list, loss_scale_list, prompt
 
-        history.append([query, response])
-        history_roles.append([query_role, 'assistant'])
-
-        # Set the loss_scale of chat_sep or suffix to 1 if efficient_eos.
-        efficient_eos = False
+    def _is_efficient_eos(self) -> bool:
         if self.chat_sep is not None and len(self.chat_sep) > 0:
             if isinstance(self.chat_sep[0], str) and isinstance(self.suffix[0], str) and self.chat_sep[0].startswith(
                     self.suffix[0]):
-                efficient_eos = True
+                return True
             elif isinstance(self.chat_sep[0], list) and self.chat_sep[0] == self.suffix[0]:
-                efficient_eos = True
+                return True
+        return False
 
+    def _get_round_context_list(self, prompt: Prompt, history: History, history_roles: History,
+                                i: int) -> Tuple[Prompt, Prompt]:
+        """return: context_list, extra_context_list of the i-th round"""
+        r = history[i][1]
+        context_list = self.tool_prompt.copy() if history_roles[i][0] == 'tool' else prompt.copy()
+        extra_context_list = []
+        if i < len(history) - 1:
+            context_list = [context for context in context_list if '{{SYSTEM}}' not in context]
+            context_list.append('{{RESPONSE}}')
+            if history[i + 1][0]:
+                extra_context_list = self.chat_sep
+        elif r is not None:
+            # last response
+            context_list.append('{{RESPONSE}}')
+            extra_context_list = self.suffix
+        return context_list, extra_context_list
+
+    def _encode_rounds(self, prefix_context_list: List[Context], prefix_loss_scale_list: List[float], prompt: Prompt,
+                       history: History, history_roles: History, system: Optional[str], efficient_eos: bool,
+                       **kwargs) -> Optional[List[List[int]]]:
+        """Encode the inference inputs round by round. The token ids of the history rounds are looked up in a LRU
+        cache, so that a new turn of the conversation only tokenizes the new query.
+
+        The rounds are tokenized separately, which only gives the same result when each round starts with a special
+        token of `_fragment_pattern` (e.g. `<|im_start|>`), where the tokenization is split anyway.
+
+        return: the token ids of [prefix, *history, query], None if the rounds cannot be tokenized separately.
+        """
+        if (self._fragment_pattern is None or self.round_cache_size <= 0
+                or type(self)._get_tokenizer_kwargs is not Template._get_tokenizer_kwargs):
+            return None
+        round_dependent = any(['{{ROUND' in context for context in prompt + self.tool_prompt])
+        context_list, loss_scale_list = self._simplify_context_list(prefix_context_list, prefix_loss_scale_list,
+                                                                    **kwargs)
+        res = [self._encode_context_list(context_list, loss_scale_list)[0]]
+        for i, ((q, r), (qr, _)) in enumerate(zip(history, history_roles)):
+            is_last = i == len(history) - 1
+            key = (i if round_dependent else None, qr, q, r, system, not is_last and bool(history[i + 1][0]))
+            token_list = None
+            if not is_last:
+                with _cache_lock:
+                    token_list = self._round_cache.get(key)
+                    if token_list is not None:
+                        self._round_cache.move_to_end(key)
+            if token_list is not None:
+                res.append(token_list)
+                continue
+            token_list = []
+            if q or r:
+                context_list, extra_context_list = self._get_round_context_list(prompt, history, history_roles, i)
+                res_context_list, loss_scale_list = [], []
+                self._concat_context_list(
+                    context_list, res_context_list, loss_scale_list, query=q, response=r, system=system, round0=i)
+                res_context_list += extra_context_list
+                loss_scale_list += ([1.] if efficient_eos else [0.]) * len(extra_context_list)
+                context = res_context_list[0] if len(res_context_list) > 0 else []
+                if isinstance(context, str) and self._fragment_pattern.match(context) is None:
+                    return None
+                res_context_list, loss_scale_list = self._simplify_context_list(res_context_list, loss_scale_list,
+                                                                                **kwargs)
+                token_list = self._encode_context_list(res_context_list, loss_scale_list)[0]
+            if not is_last:
+                with _cache_lock:
+                    self._round_cache[key] = token_list
+                    while len(self._round_cache) > self.round_cache_size:
+                        self._round_cache.popitem(last=False)
+            res.append(token_list)
+        return res
+
+    def _concat_rounds(self, res_context_list: List[Context], loss_scale_list: List[float], prompt: Prompt,
+                       history: History, history_roles: History, system: Optional[str], efficient_eos: bool,
+                       **kwargs) -> Tuple[List[Context], List[float]]:
+        """Concat the rounds to the prefix context list.
+
+        return: res_context_list, loss_scale_list
+        """
         for i, ((q, r), (qr, rr)) in enumerate(zip(history, history_roles)):
-            context_list = self.tool_prompt.copy() if qr == 'tool' else prompt.copy()
-            extra_context_list = []
-            if i < len(history) - 1:
-                context_list = [context for context in context_list if '{{SYSTEM}}' not in context]
-                context_list.append('{{RESPONSE}}')
-                if history[i + 1][0]:
-                    extra_context_list = self.chat_sep
-            elif r is not None:
-                # last response
-                context_list.append('{{RESPONSE}}')
-                extra_context_list = self.suffix
+            context_list, extra_context_list = self._get_round_context_list(prompt, history, history_roles, i)
+            if i == len(history) - 1 and r is not None:
                 efficient_eos = True
             if q or r:
                 self._concat_context_list(
                     context_list, res_context_list, loss_scale_list, query=q, response=r, system=system, round0=i)
                 res_context_list += extra_context_list
                 loss_scale_list += ([1.] if efficient_eos else [0.]) * len(extra_context_list)
-        res_context_list, loss_scale_list = self._simplify_context_list(res_context_list, loss_scale_list, **kwargs)
-        input_ids, labels, loss_scale, tokenizer_kwargs = self._encode_context_list(res_context_list, loss_scale_list)
+        return self._simplify_context_list(res_context_list, loss_scale_list, **kwargs)
+
+    def _concat_and_tokenize(self,
+                             query: str,
+                             query_role: str,
+                             response: Optional[str],
+                             history: History,
+                             history_roles: History,
+                             system: Optional[str],
+                             truncation_strategy: str,
+                             auto_add_bos: bool = False,
+                             **kwargs) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """
+        return: inputs, tokenizer_kwargs
+        """
+        history = history.copy()
+
+        res_context_list, loss_scale_list, prompt = self._get_prefix_context_list(system, auto_add_bos)
+
+        history.append([query, response])
+        history_roles.append([query_role, 'assistant'])
+
+        # Set the loss_scale of chat_sep or suffix to 1 if efficient_eos.
+        efficient_eos = self._is_efficient_eos()
+        round_tokens = None
+        if response is None and not kwargs.get('is_multi_modal', False):
+            round_tokens = self._encode_rounds(res_context_list, loss_scale_list, prompt, history, history_roles,
+                                               system, efficient_eos, **kwargs)
+        if round_tokens is not None:
+            input_ids = list(itertools.chain.from_iterable(round_tokens))
+            labels, loss_scale, tokenizer_kwargs = None, [0.] * len(input_ids), {}
+        else:
+            res_context_list, loss_scale_list = self._concat_rounds(res_context_list, loss_scale_list, prompt, history,
+                                                                    history_roles, system, efficient_eos, **kwargs)
+            input_ids, labels, loss_scale, tokenizer_kwargs = self._encode_context_list(
+                res_context_list, loss_scale_list)
 
         if response is None:
             labels = None
@@ -805,6 +1234,23 @@ class Template:
     def _concat_tokenizer_kwargs(self, tokenizer_kwargs: Dict[str, Any], curr_tokenizer_kwargs: Dict[str, Any]) -> None:
         assert len(tokenizer_kwargs) == 0
 
+    def _pad_batch(self,
+                   sequences: List[Union[List[Union[int, float]], np.ndarray]],
+                   padding_value: Union[int, float],
+                   dtype: torch.dtype,
+                   padding_to: Optional[int] = None) -> Tensor:
+        """Pad the sequences into a preallocated [bs, max_len] tensor."""
+        max_len = max(max(len(seq) for seq in sequences), padding_to or 0)
+        res = torch.full((len(sequences), max_len), padding_value, dtype=dtype)
+        res_np = res.numpy()  # shares the memory with `res`
+        padding_right = self.padding_side == 'right'
+        for i, seq in enumerate(sequences):
+            if padding_right:
+                res_np[i, :len(seq)] = seq
+            else:
+                res_np[i, max_len - len(seq):] = seq
+        return res
+
     @staticmethod
     def pad_sequence(sequences: List[Tensor],
                      padding_value: float = 0.,
@@ -831,6 +1277,10 @@ class Template:
     def pre_forward(self, args, kwargs):
         pass
 
+    def _is_flash_attn_2(self) -> bool:
+        config = getattr(self.model, 'config', None)
+        return getattr(config, '_attn_implementation', None) == 'flash_attention_2'
+
     def data_collator(self, batch: List[Dict[str, Any]], padding_to: Optional[int] = None) -> Dict[str, Any]:
         """
         Args:
@@ -841,39 +1291,35 @@ class Template:
         tokenizer = self.tokenizer
         assert tokenizer.pad_token_id is not None
         inputs_embeds, input_ids = None, None
+        loss_scale, position_ids = None, None
+        padding_right = self.padding_side == 'right'
         if 'inputs_embeds' in batch[0]:
+            assert padding_to is None, 'inputs_embeds not support padding_to'
             inputs_embeds = [b['inputs_embeds'] for b in batch]
             attention_mask = [
                 torch.ones((inputs_embeds[i].shape[0]), dtype=torch.int64) for i in range(len(inputs_embeds))
             ]
-        else:
-            input_ids = [torch.tensor(b['input_ids']) for b in batch]
-            attention_mask = [torch.ones(len(input_ids[i]), dtype=torch.int64) for i in range(len(input_ids))]
-        labels = [torch.tensor(b['labels']) for b in batch]
-        loss_scale = [torch.tensor(b['loss_scale']) for b in batch] if 'loss_scale' in batch[0] else None
-        padding_right = self.padding_side == 'right'
-
-        if padding_to is not None:
-            assert input_ids is not None  # inputs_embeds not support padding_to
-            padding_len = padding_to - input_ids[0].shape[-1]
-            if padding_len > 0:
-                input_ids[0] = F.pad(input_ids[0], (0, padding_len) if padding_right else (padding_len, 0), 'constant',
-                                     tokenizer.pad_token_id)
-                attention_mask[0] = F.pad(attention_mask[0], (0, padding_len) if padding_right else (padding_len, 0),
-                                          'constant', 0)
-                labels[0] = F.pad(labels[0], (0, padding_len) if padding_right else (padding_len, 0), 'constant', -100)
-                if loss_scale:
-                    loss_scale[0] = F.pad(loss_scale[0], (0, padding_to - labels[0].shape[-1]) if padding_right else
-                                          (padding_to - labels[0].shape[-1], 0), 'constant', 0.)
-
-        if input_ids is None:
             inputs_embeds = self.pad_sequence(inputs_embeds, 0, self.padding_side)
+            attention_mask = self.pad_sequence(attention_mask, 0, self.padding_side)
+            labels = self.pad_sequence([torch.tensor(b['labels']) for b in batch], -100, self.padding_side)
+            if 'loss_scale' in batch[0]:
+                loss_scale = self.pad_sequence([torch.tensor(b['loss_scale']) for b in batch], 0., self.padding_side)
         else:
-            input_ids = self.pad_sequence(input_ids, tokenizer.pad_token_id, self.padding_side)
-        attention_mask = self.pad_sequence(attention_mask, 0, self.padding_side)
-        if loss_scale:
-            loss_scale = self.pad_sequence(loss_scale, 0., self.padding_side)
-        labels = self.pad_sequence(labels, -100, self.padding_side)
+            # Allocate the padded tensors once, and copy the samples (lists or numpy arrays) into them.
+            input_ids = self._pad_batch([b['input_ids'] for b in batch], tokenizer.pad_token_id, torch.int64,
+                                        padding_to)
+            seq_lens = torch.tensor([len(b['input_ids']) for b in batch], dtype=torch.int64)
+            seq_range = torch.arange(input_ids.shape[1])[None]
+            if padding_right:
+                attention_mask = (seq_range < seq_lens[:, None]).long()
+            else:
+                attention_mask = (seq_range >= input_ids.shape[1] - seq_lens[:, None]).long()
+            labels = self._pad_batch([b['labels'] for b in batch], -100, torch.int64, padding_to)
+            if 'loss_scale' in batch[0]:
+                loss_scale = self._pad_batch([b['loss_scale'] for b in batch], 0., torch.float32, padding_to)
+            if 'position_ids' in batch[0]:
+                # packed samples (see `ConstantLengthDataset`)
+                position_ids = self._pad_batch([b['position_ids'] for b in batch], 0, torch.int64, padding_to)
 
         if use_torchacc():
             rank, _, world_size, _ = get_dist_setting()
@@ -888,9 +1334,13 @@ class Template:
                 rank,
                 world_size,
                 padding_right=padding_right)
+        # The packed samples are split by the restarts of `position_ids` only with flash attention, otherwise the
+        # positions are contiguous and the packed samples attend to each other (as if they were one sample).
+        packed = position_ids is not None and not use_torchacc() and self._is_flash_attn_2()
         if input_ids is not None:
             bs, seq_len = input_ids.shape
-            position_ids = torch.arange(seq_len).unsqueeze(0).long().repeat(bs, 1)
+            if not packed:
+                position_ids = torch.arange(seq_len).unsqueeze(0).long().repeat(bs, 1)
 
             if self.sequence_parallel_size > 1:
                 assert padding_right or bs == 1, 'Sequence parallel only support padding_side=right'
@@ -909,6 +1359,12 @@ class Template:
             res['inputs_embeds'] = inputs_embeds
         else:
             res['input_ids'] = input_ids
+        if packed:
+            # The flash attention of transformers splits the packed samples by the restarts of `position_ids`
+            # (i.e. cu_seqlens) when `attention_mask` is None.
+            res['position_ids'] = position_ids
+            if padding_right:
+                res.pop('attention_mask')
         # multimodal
         pixel_values = [b['pixel_values'] for b in batch if b.get('pixel_values') is not None]
         if len(pixel_values) > 0:
@@ -961,6 +1417,7 @@ class Template:
         return_delta: bool = False,
         print_idx: Optional[List[int]] = None,
         first_num_space: Optional[List[int]] = None,
+        detokenizer: Optional[IncrementalDetokenizer] = None,
     ):
         if tokenizer_kwargs is None:
             tokenizer_kwargs = {}
@@ -971,7 +1428,11 @@ class Template:
             generate_ids = generate_ids[:-len(self.suffix[-1])]
         if not is_finished or is_finished and generate_ids[-1:] == [self.tokenizer.eos_token_id]:
             generate_ids = generate_ids[:-1]
-        response = tokenizer.decode(generate_ids, **tokenizer_kwargs)
+        if detokenizer is None:
+            response = tokenizer.decode(generate_ids, **tokenizer_kwargs)
+        else:
+            # stream: only decode the new tokens
+            response = detokenizer.decode(generate_ids, is_finished)
         if first_num_space is not None:
             # Avoid the occurrence of repeated words in sentence.
             res_fns = first_num_space  # res_first_num_space
@@ -1,20 +1,26 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
 # Part of the implementation is borrowed from huggingface/transformers.
+import hashlib
 import heapq
 import importlib.util
+import itertools
+import math
 import os
 import shutil
 import time
 from copy import deepcopy
 from functools import partial, wraps
-from queue import Empty, Queue
+from queue import Queue
 from tempfile import TemporaryDirectory
-from threading import Thread
+from threading import Thread, local
+from types import MethodType
 from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional, Sequence, Set, Tuple, Union
 
 import accelerate
+import json
 import multiprocess
 import numpy as np
+import pyarrow as pa
 import requests
 import torch
 import torch.distributed as dist
@@ -36,7 +42,8 @@ from swift.hub import ModelScopeConfig
 from swift.utils import (get_dist_setting, get_logger, is_ddp_plus_mp, safe_ddp_context, stat_array, upper_bound,
                          use_torchacc)
 from swift.utils.module_mapping import MODEL_KEYS_MAPPING
-from .template import History, StopWords, StopWordsCriteria, Template
+from .prefix_cache import get_prefix_cache
+from .template import History, IncrementalDetokenizer, StopWords, StopWordsCriteria, Template
 
 DATASET_TYPE = Union[HfDataset, HfIterableDataset]
 
@@ -153,12 +160,188 @@ class LLMDataset(Dataset):
         data = [self.data[i] for i in idx_list]
         return self.__class__(data)
 
+    def get_lengths(self, key: str = 'input_ids') -> np.ndarray:
+        return np.array([len(d[0][key]) for d in self.data], dtype=np.int64)
+
     def __len__(self) -> int:
         return len(self.data)
 
 
+Block = Dict[str, Tuple[np.ndarray, np.ndarray]]  # key -> (flat buffer, offsets)
+
+
+def _get_block_len(block: Block) -> int:
+    if len(block) == 0:
+        return 0
+    return len(next(iter(block.values()))[1]) - 1
+
+
+class PackedLLMDataset(Dataset):
+    """The columnar version of LLMDataset.
+
+    Each key (e.g. input_ids, labels, loss_scale) is stored as a flat int32/float32 buffer plus int64 offsets
+    instead of python lists, which takes much less memory and is not duplicated by the copy-on-write
+    of the dataloader workers. The buffers can be memory-mapped from disk (e.g. the tokenized dataset cache).
+    """
+
+    def __init__(self, blocks: List[Block], idx_list: Optional[np.ndarray] = None) -> None:
+        self.blocks = [block for block in blocks if _get_block_len(block) > 0]
+        self.cu_block_lens = np.cumsum([0] + [_get_block_len(block) for block in self.blocks])
+        self.idx_list = idx_list
+
+    def _get_row(self, idx: int) -> Tuple[Block, int]:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f'idx: {idx}, len(dataset): {len(self)}')
+        if self.idx_list is not None:
+            idx = int(self.idx_list[idx])
+        block_idx = int(np.searchsorted(self.cu_block_lens, idx, side='right')) - 1
+        return self.blocks[block_idx], idx - int(self.cu_block_lens[block_idx])
+
+    def __getitem__(self, idx: Union[int, str]) -> Dict[str, Any]:
+        if isinstance(idx, (int, np.integer)):
+            block, row = self._get_row(int(idx))
+            return {key: flat[offsets[row]:offsets[row + 1]].tolist() for key, (flat, offsets) in block.items()}
+        elif isinstance(idx, str):
+            res = []
+            for i in range(len(self)):
+                block, row = self._get_row(i)
+                flat, offsets = block[idx]
+                res.append(flat[offsets[row]:offsets[row + 1]].tolist())
+            return res
+        else:
+            raise ValueError(f'idx: {idx}')
+
+    def __getitems__(self, idx_list: List[int]) -> List[Dict[str, np.ndarray]]:
+        # Used by the DataLoader to fetch a batch: the rows are the views of the buffers (without copying),
+        # which are copied into the padded tensors by `Template.data_collator`.
+        res = []
+        for idx in idx_list:
+            block, row = self._get_row(int(idx))
+            res.append({key: flat[offsets[row]:offsets[row + 1]] for key, (flat, offsets) in block.items()})
+        return res
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def select(self, idx_list: List[int]) -> 'PackedLLMDataset':
+        idx_list = np.asarray(idx_list, dtype=np.int64)
+        if self.idx_list is not None:
+            idx_list = self.idx_list[idx_list]
+        return self.__class__(self.blocks, idx_list)
+
+    def get_lengths(self, key: str = 'input_ids') -> np.ndarray:
+        """The length of each row, computed from the offsets without touching the buffers."""
+        if len(self.blocks) == 0:
+            return np.zeros(0, dtype=np.int64)
+        lengths = np.concatenate([np.diff(block[key][1]) for block in self.blocks])
+        if self.idx_list is not None:
+            lengths = lengths[self.idx_list]
+        return lengths
+
+    def __len__(self) -> int:
+        if self.idx_list is None:
+            return int(self.cu_block_lens[-1])
+        return len(self.idx_list)
+
+
+def _best_fit_decreasing(lengths: np.ndarray, max_length: int) -> List[List[int]]:
+    """Pack the sequences into bins of `max_length` tokens with the best-fit-decreasing heuristic.
+
+    A segment tree over the remaining capacities finds the tightest bin in O(log(max_length)),
+    so the whole packing takes O(n log n).
+
+    return: the sequence indices of each bin.
+    """
+    size = 1
+    while size < max_length + 1:
+        size *= 2
+    tree = [0] * (2 * size)  # The number of bins of each remaining capacity.
+    cap_bins = [[] for _ in range(max_length + 1)]
+    bins = []
+
+    def _update(cap: int, delta: int) -> None:
+        node = cap + size
+        while node >= 1:
+            tree[node] += delta
+            node //= 2
+
+    def _find(length: int) -> int:
+        # The smallest remaining capacity >= length, or -1.
+        node = length + size
+        if tree[node] > 0:
+            return length
+        while node > 1:
+            if node % 2 == 0 and tree[node + 1] > 0:
+                node += 1
+                break
+            node //= 2
+        else:
+            return -1
+        while node < size:
+            node = 2 * node if tree[2 * node] > 0 else 2 * node + 1
+        return node - size
+
+    for i in np.argsort(-np.asarray(lengths), kind='stable').tolist():
+        length = int(lengths[i])
+        if length > max_length:
+            bins.append([i])
+            continue
+        cap = _find(length)
+        if cap == -1:
+            bin_id, cap = len(bins), max_length
+            bins.append([])
+        else:
+            bin_id = cap_bins[cap].pop()
+            _update(cap, -1)
+        bins[bin_id].append(i)
+        cap -= length
+        cap_bins[cap].append(bin_id)
+        _update(cap, 1)
+    return bins
+
+
+def _pack_block(dataset: PackedLLMDataset, bins: List[List[int]]) -> Block:
+    """Concatenate the samples of each bin into one row, and add the `position_ids` restarting from 0 per sample."""
+    rows = [dataset._get_row(i) for i in itertools.chain.from_iterable(bins)]
+    values = {key: [] for key in rows[0][0].keys()}
+    for block, row in rows:
+        for key, (flat, offsets) in block.items():
+            values[key].append(flat[offsets[row]:offsets[row + 1]])
+    seq_lens = np.array([len(v) for v in values['input_ids']], dtype=np.int64)
+    cu_seqlens = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(seq_lens, out=cu_seqlens[1:])
+    offsets = cu_seqlens[np.cumsum([0] + [len(b) for b in bins])]
+    res = {}
+    for key, value in values.items():
+        flat = np.concatenate(value)
+        if len(flat) != offsets[-1]:
+            raise ValueError(f'The length of `{key}` does not match the length of `input_ids`.')
+        res[key] = (flat, offsets)
+    position_ids = np.arange(offsets[-1], dtype=np.int32) - np.repeat(cu_seqlens[:-1], seq_lens).astype(np.int32)
+    res['position_ids'] = (position_ids, offsets)
+    return res
+
+
+def _get_block_hash(block: Block) -> str:
+    hash_ = hashlib.sha256()
+    for key, (flat, offsets) in block.items():
+        hash_.update(key.encode('utf-8'))
+        hash_.update(np.ascontiguousarray(flat).tobytes())
+        hash_.update(offsets.tobytes())
+    return hash_.hexdigest()
+
+
 # Code borrowed from trl
 class ConstantLengthDataset(IterableDataset):
+    """Pack the samples into sequences of `seq_length` tokens.
+
+    The packed rows contain `position_ids` restarting from 0 for each sample, so that the packed samples
+    do not attend to each other with flash attention (the `cu_seqlens` are derived from the `position_ids`).
+    They are only used with flash_attention_2 (see `Template.data_collator`), otherwise the positions are contiguous.
+    """
 
     def __init__(
         self,
@@ -175,7 +358,7 @@ class ConstantLengthDataset(IterableDataset):
         self.concat_token_id = self.template.tokenizer.eos_token_id
         self.dataset = dataset
         self.seq_length = seq_length
-        self.max_buffer_size = seq_length * chars_per_token * num_of_sequences
+        self.num_of_sequences = num_of_sequences
         self.append_concat_token = append_concat_token
         self.add_special_tokens = add_special_tokens
 
@@ -187,58 +370,78 @@ class ConstantLengthDataset(IterableDataset):
                            chars_per_token=3.6,
                            append_concat_token=True,
                            add_special_tokens=True,
-                           lazy_tokenize=False):
+                           lazy_tokenize=False,
+                           *,
+                           num_proc: int = 1,
+                           cache_dir: Optional[str] = None,
+                           cache_key: Optional[str] = None,
+                           shard_size: int = 10000):
+        """
+        lazy_tokenize: If True, the samples are encoded and packed on the fly, `num_of_sequences` samples at a time.
+            Otherwise the whole dataset is encoded with `num_proc` processes and packed globally.
+        cache_dir: If not None, the encoded samples are cached (see `dataset_map`), and the packed rows are
+            written to `cache_dir/cache_key` in shards of `shard_size` rows and memory-mapped.
+        """
         constant_length_iterator = ConstantLengthDataset(template, dataset, seq_length, num_of_sequences,
                                                          chars_per_token, append_concat_token, add_special_tokens)
 
         if lazy_tokenize:
             return constant_length_iterator
 
-        dataset_list = []
-        for item in constant_length_iterator:
-            dataset_list.append(item)
-        return HfDataset.from_list(dataset_list)
+        cache_kwargs = {}
+        if cache_dir is not None:
+            cache_kwargs = {'cache_dir': cache_dir, 'cache_key': cache_key}
+        encoded_dataset = dataset_map(dataset, template.encode_batch, num_proc, batched=True, **cache_kwargs)
+        if encoded_dataset is None:
+            return None
+        encoded_dataset = constant_length_iterator._to_packed_llm_dataset(encoded_dataset)
+        bins = _best_fit_decreasing(encoded_dataset.get_lengths(), seq_length)
+        # Keep the bins in the order of their first sample, which is deterministic.
+        bins.sort(key=lambda b: b[0])
+        if cache_dir is None:
+            blocks = [_pack_block(encoded_dataset, bins[i:i + shard_size]) for i in range(0, len(bins), shard_size)]
+            return PackedLLMDataset(blocks)
+
+        # Stream the packed shards to disk, so that only one shard is kept in memory.
+        packed_dir = os.path.join(cache_dir, cache_key, 'packed')
+        os.makedirs(packed_dir, exist_ok=True)
+        blocks = []
+        for i in tqdm(range(0, len(bins), shard_size), desc='Packing the dataset'):
+            block = _pack_block(encoded_dataset, bins[i:i + shard_size])
+            block_dir = os.path.join(packed_dir, _get_block_hash(block))
+            if not os.path.exists(block_dir):
+                _save_block(block_dir, block)
+            blocks.append(_load_block(block_dir))
+        return PackedLLMDataset(blocks)
+
+    @staticmethod
+    def _to_packed_llm_dataset(dataset: Union[LLMDataset, PackedLLMDataset]) -> PackedLLMDataset:
+        if isinstance(dataset, PackedLLMDataset):
+            return dataset
+        block = _pack_rows(dataset.data)
+        if block is None:
+            raise ValueError('Packing only supports the text datasets.')
+        return PackedLLMDataset([block])
 
     def __len__(self):
         return len(self.dataset)
 
-    def calculate_matched_group(self, sequences: Dict[str, List[int]]):
-        # https://arxiv.org/pdf/2404.10830
-        import binpacking
-        binpacked = binpacking.to_constant_volume(sequences, self.seq_length, weight_pos=1)
-        packed_sequence = []
-        for sequence in binpacked:
-            packed = {}
-            for key in sequence[0][0].keys():
-                packed[key] = np.concatenate([s[0][key] for s in sequence])
-            packed_sequence.append(packed)
-        return packed_sequence
-
     def __iter__(self):
         iterator = iter(self.dataset)
         more_examples = True
         while more_examples:
-            buffer, buffer_len = [], 0
-            while True:
-                if buffer_len >= self.max_buffer_size:
-                    break
-                try:
-                    example = next(iterator)
-                    lens = sum([len(value) if value else 0 for value in example.values()])
-                    buffer.append(next(iterator))
-                    buffer_len += lens
-                except StopIteration:
-                    more_examples = False
-                    break
-
-            sequences = []
+            buffer = list(itertools.islice(iterator, self.num_of_sequences))
+            more_examples = len(buffer) == self.num_of_sequences
+            data = []
             for example in buffer:
-                input, _ = self.template.encode(example)
-                sequences.append((input, len(input['input_ids'])))
-
-            packed_sequences = self.calculate_matched_group(sequences)
-            for sequence in packed_sequences:
-                yield sequence
+                inputs, tokenizer_kwargs = self.template.encode(example)
+                if len(inputs) > 0:
+                    data.append((inputs, tokenizer_kwargs))
+            if len(data) == 0:
+                continue
+            dataset = self._to_packed_llm_dataset(LLMDataset(data))
+            bins = _best_fit_decreasing(dataset.get_lengths(), self.seq_length)
+            yield from PackedLLMDataset([_pack_block(dataset, bins)])
 
 
 class LazyLLMDataset(Dataset):
@@ -275,70 +478,309 @@ class LazyLLMDataset(Dataset):
 MapFunc = Callable[[Dict[str, Any]], Tuple[Dict[str, Any], Dict[str, Any]]]
 
 
-def _single_map(d: Dict[str, Any], map_func: MapFunc) -> Optional[Dict[str, Any]]:
-    d = map_func(d)
-    if len(d[0]) == 0:
-        return None
-    return d
+def _batch_map(rows: List[Dict[str, Any]],
+               map_func: Callable,
+               batched: bool = False) -> List[Optional[Tuple[Dict[str, Any], Dict[str, Any]]]]:
+    res = map_func(rows) if batched else [map_func(row) for row in rows]
+    return [None if len(d[0]) == 0 else d for d in res]
 
 
-def _map_mp_single(subset: HfDataset, map_func: MapFunc, queue: Queue, start_idx: int):
-    for i, d in enumerate(subset, start=start_idx):
-        queue.put((i, map_func(d)))  # idx, result
+def _single_from_batch_map(row: Dict[str, Any], map_func: Callable) -> Any:
+    return map_func([row])[0]
 
 
-def _map_mp_i(dataset: HfDataset, map_func: MapFunc, num_proc: int) -> Iterator[Tuple[int, Dict[str, Any]]]:
-    with multiprocess.Pool(num_proc) as pool, multiprocess.Manager() as manager:
-        queue = manager.Queue()
-        async_results = []
-        split_idx = np.linspace(0, len(dataset), num_proc + 1, dtype=np.int32)
-        for i in range(num_proc):
-            subset = dataset.select(range(split_idx[i], split_idx[i + 1]))
-            async_results.append(pool.apply_async(_map_mp_single, args=(subset, map_func, queue, split_idx[i])))
-        while True:
-            try:
-                yield queue.get(timeout=0.05)
-            except Empty:
-                if all(async_result.ready() for async_result in async_results) and queue.empty():
-                    break
+def _iter_batches(dataset: HfDataset, batch_size: int = 1000) -> Iterator[List[Dict[str, Any]]]:
+    iterator = iter(dataset)
+    while True:
+        rows = list(itertools.islice(iterator, batch_size))
+        if len(rows) == 0:
+            break
+        yield rows
+
+
+def _pack_rows(data: List[Tuple[Dict[str, Any], Dict[str, Any]]]) -> Optional[Block]:
+    """Pack the encoded rows into a flat buffer + offsets for each key. return None if the rows cannot be packed."""
+    keys = list(data[0][0].keys()) if len(data) > 0 else []
+    for d, tokenizer_kwargs in data:
+        if len(tokenizer_kwargs) > 0 or list(d.keys()) != keys:
+            return None
+    block = {}
+    for key in keys:
+        values = [d[key] for d, _ in data]
+        if not all(isinstance(v, (list, tuple)) for v in values):
+            return None
+        lengths = np.array([len(v) for v in values], dtype=np.int64)
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        flat = list(itertools.chain.from_iterable(values))
+        # The dtype is decided by all the elements, e.g. the loss_scale [1, 2.5, 0.5] is float.
+        types = set(map(type, flat))
+        if all(issubclass(t, (int, np.integer)) for t in types):
+            dtype = np.int32
+        elif all(issubclass(t, (int, float, np.integer, np.floating)) for t in types):
+            dtype = np.float32
+        else:
+            return None
+        flat = np.array(flat, dtype=dtype)
+        block[key] = (flat, offsets)
+    return block
+
+
+def _unpack_block(block: Block) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    return [({key: flat[offsets[i]:offsets[i + 1]].tolist()
+              for key, (flat, offsets) in block.items()}, {}) for i in range(_get_block_len(block))]
+
+
+def _concat_blocks(blocks: List[Block]) -> Block:
+    blocks = [block for block in blocks if _get_block_len(block) > 0]
+    if len(blocks) <= 1:
+        return blocks[0] if blocks else {}
+    res = {}
+    for key in blocks[0].keys():
+        flat = np.concatenate([block[key][0] for block in blocks])
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for block in blocks:
+            block_offsets = block[key][1]
+            offsets.append(block_offsets[1:] + offsets[-1][-1])
+        res[key] = (flat, np.concatenate(offsets))
+    return res
+
+
+def _save_block(block_dir: str, block: Block) -> None:
+    tmp_dir = f'{block_dir}.tmp-{os.getpid()}'
+    os.makedirs(tmp_dir, exist_ok=True)
+    for key, (flat, offsets) in block.items():
+        np.save(os.path.join(tmp_dir, f'{key}.npy'), flat)
+        np.save(os.path.join(tmp_dir, f'{key}.offsets.npy'), offsets)
+    # meta.json is written last, so its existence means the block is complete.
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'keys': list(block.keys()), 'num_rows': _get_block_len(block)}, f)
+    try:
+        os.rename(tmp_dir, block_dir)
+    except OSError:
+        # Another process has already written the same block.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _load_block(block_dir: str, mmap: bool = True) -> Block:
+    with open(os.path.join(block_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    block = {}
+    for key in meta['keys']:
+        flat = np.load(os.path.join(block_dir, f'{key}.npy'), mmap_mode='r' if mmap else None)
+        offsets = np.load(os.path.join(block_dir, f'{key}.offsets.npy'))
+        block[key] = (flat, offsets)
+    return block
+
+
+def _map_mp_single(subset: HfDataset, batch_map: Callable, tmp_dir: str,
+                   start_idx: int) -> Union[str, List[Tuple[Dict[str, Any], Dict[str, Any]]]]:
+    data = [d for rows in _iter_batches(subset) for d in batch_map(rows) if d is not None]
+    block = _pack_rows(data)
+    if block is None:
+        return data
+    # Return the packed arrays through the file system to avoid pickling the rows one by one.
+    block_dir = os.path.join(tmp_dir, str(start_idx))
+    _save_block(block_dir, block)
+    return block_dir
+
+
+def _map_chunks(dataset: HfDataset, batch_map: Callable, num_proc: int,
+                chunks: List[Tuple[int, int]]) -> Iterator[Union[Block, List[Tuple[Dict[str, Any], Dict[str, Any]]]]]:
+    """Map the contiguous chunks of the dataset and yield the results in order.
+
+    The non-empty rows of each chunk are packed into a Block if possible, otherwise a list of rows is yielded.
+    """
+    prog_bar = tqdm(total=sum(end - start for start, end in chunks))
+    if num_proc == 1:
+        for start, end in chunks:
+            data = []
+            for rows in _iter_batches(dataset.select(range(start, end))):
+                data += [d for d in batch_map(rows) if d is not None]
+                prog_bar.update(len(rows))
+            block = _pack_rows(data)
+            yield data if block is None else block
+    else:
+        assert num_proc > 1
+        with TemporaryDirectory() as tmp_dir, multiprocess.Pool(num_proc) as pool:
+            async_results = [
+                pool.apply_async(_map_mp_single, args=(dataset.select(range(start, end)), batch_map, tmp_dir, start))
+                for start, end in chunks
+            ]
+            for (start, end), async_result in zip(chunks, async_results):
+                res = async_result.get()
+                yield _load_block(res, mmap=False) if isinstance(res, str) else res
+                prog_bar.update(end - start)
+    prog_bar.close()
+
+
+def _split_chunks(start: int, end: int, num_proc: int) -> List[Tuple[int, int]]:
+    # Several contiguous chunks per worker, for load balancing and to bound the memory of unpacked rows.
+    chunk_size = max(min(math.ceil((end - start) / (num_proc * 4)), 100000), 1)
+    return [(i, min(i + chunk_size, end)) for i in range(start, end, chunk_size)]
+
+
+def _get_tokenizer_fingerprint(tokenizer: PreTrainedTokenizerBase) -> str:
+    hasher = hashlib.sha256()
+    hasher.update(tokenizer.__class__.__name__.encode('utf-8'))
+    try:
+        vocab = tokenizer.get_vocab()
+    except NotImplementedError:
+        vocab = {}
+    # Some tokenizers (e.g. qwen) use bytes as the key of vocab.
+    for token, token_id in sorted(vocab.items(), key=lambda x: (x[1], repr(x[0]))):
+        hasher.update(f'{token!r}:{token_id}\n'.encode('utf-8'))
+    hasher.update(repr(tokenizer.all_special_tokens).encode('utf-8'))
+    return hasher.hexdigest()
+
+
+def get_template_fingerprint(template: Template) -> str:
+    """The fingerprint of all the states that affect the result of `template.encode`."""
+    from swift.version import __version__
+    prompt = [
+        template.prefix, template.prompt, template.chat_sep, template.suffix, template.system_prefix,
+        template.tool_prompt
+    ]
+    state = {
+        'swift_version': __version__,
+        'template_type': getattr(template, 'template_type', None),
+        'template_cls': template.__class__.__name__,
+        'prompt': prompt,
+        'default_system': template.default_system,
+        'use_default_system': template.use_default_system,
+        'auto_add_bos': template.auto_add_bos,
+        'max_length': template.max_length,
+        'truncation_strategy': template.truncation_strategy,
+        'tools_prompt': template.tools_prompt,
+        'use_loss_scale': template.use_loss_scale,
+        'response_loss_scale_map': template.response_loss_scale_map,
+        'query_loss_scale_map': template.query_loss_scale_map,
+        'rescale_image': template.rescale_image,
+        'tokenizer': _get_tokenizer_fingerprint(template.tokenizer),
+    }
+    return hashlib.sha256(json.dumps(state, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
 
 
-def _map_mp(dataset: HfDataset, map_func: MapFunc, num_proc: int) -> List[Dict[str, Any]]:
-    # Solving the unordered problem
-    data = [None] * len(dataset)
-    num_proc = min(num_proc, len(dataset))
-    for d in tqdm(_map_mp_i(dataset, map_func, num_proc), total=len(dataset)):
-        data[d[0]] = d[1]
-    return data
+def _get_shard_fingerprint(dataset: HfDataset, start: int, end: int) -> str:
+    """Content hash of dataset[start:end], independent of how the dataset was built."""
+    table = dataset.with_format('arrow')[start:end]
+    # `take` makes the buffers contiguous; a zero-copy slice would serialize the buffers of the whole table.
+    table = table.take(pa.array(range(table.num_rows)))
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return hashlib.sha256(sink.getvalue()).hexdigest()
+
+
+def _cached_map(dataset: HfDataset,
+                batch_map: Callable,
+                num_proc: int,
+                cache_dir: str,
+                shard_size: int = 100000) -> List[Union[Block, List[Tuple[Dict[str, Any], Dict[str, Any]]]]]:
+    """Map the dataset with an on-disk cache split into shards.
+
+    Each shard is keyed by the content hash of its raw rows, so only the stale shards are re-encoded.
+    The manifest (keyed by the dataset fingerprint) allows a rerun to skip the hashing.
+    """
+    shard_root = os.path.join(cache_dir, 'shards')
+    os.makedirs(shard_root, exist_ok=True)
+    shard_ranges = [(i, min(i + shard_size, len(dataset))) for i in range(0, len(dataset), shard_size)]
+
+    manifest_path = None
+    fingerprint = getattr(dataset, '_fingerprint', None)
+    if fingerprint is not None:
+        manifest_path = os.path.join(cache_dir, f'manifest-{fingerprint}-{shard_size}.json')
+    shard_hashes = None
+    if manifest_path is not None and os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            shard_hashes = json.load(f)['shards']
+        if len(shard_hashes) != len(shard_ranges):
+            shard_hashes = None
+    if shard_hashes is None:
+        shard_hashes = [
+            _get_shard_fingerprint(dataset, start, end)
+            for start, end in tqdm(shard_ranges, desc='Fingerprinting the dataset')
+        ]
+    shard_dirs = [os.path.join(shard_root, shard_hash) for shard_hash in shard_hashes]
+    stale_shards = [i for i, shard_dir in enumerate(shard_dirs) if not os.path.exists(shard_dir)]
+    logger.info(f'Tokenized dataset cache: {len(shard_ranges) - len(stale_shards)}/{len(shard_ranges)} shards hit, '
+                f'cache_dir: {cache_dir}')
+
+    uncached_parts = {}
+    if len(stale_shards) > 0:
+        chunks = [(i, chunk) for i in stale_shards for chunk in _split_chunks(*shard_ranges[i], num_proc)]
+        shard_parts = {i: [] for i in stale_shards}
+        for (i, _), part in zip(chunks, _map_chunks(dataset, batch_map, num_proc, [chunk for _, chunk in chunks])):
+            shard_parts[i].append(part)
+        for i in stale_shards:
+            parts = shard_parts.pop(i)
+            if len(uncached_parts) == 0 and all(isinstance(part, dict) for part in parts):
+                _save_block(shard_dirs[i], _concat_blocks(parts))
+            else:
+                if len(uncached_parts) == 0:
+                    logger.warning('The encoded rows cannot be cached (e.g. multimodal inputs), skip the cache.')
+                uncached_parts[i] = parts
+
+    if len(uncached_parts) == 0 and manifest_path is not None:
+        tmp_path = f'{manifest_path}.tmp-{os.getpid()}'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'shards': shard_hashes, 'num_rows': len(dataset)}, f)
+        os.replace(tmp_path, manifest_path)
+    res = []
+    for i, shard_dir in enumerate(shard_dirs):
+        if i in uncached_parts:
+            res += uncached_parts[i]
+        elif os.path.exists(shard_dir):
+            res.append(_load_block(shard_dir))
+    return res
 
 
 def dataset_map(dataset: DATASET_TYPE,
                 map_func: MapFunc,
                 num_proc: int = 1,
-                streaming: bool = False) -> Optional[Union[LLMDataset, DATASET_TYPE]]:
+                streaming: bool = False,
+                *,
+                cache_dir: Optional[str] = None,
+                cache_key: Optional[str] = None,
+                batched: bool = False) -> Optional[Union[LLMDataset, PackedLLMDataset, DATASET_TYPE]]:
+    """
+    cache_dir: If not None, the encoded rows are cached on disk in `cache_dir/cache_key`,
+        and reused across runs. The `cache_key` should identify the `map_func`, e.g. `get_template_fingerprint`.
+    batched: If True, the `map_func` takes a list of rows and returns a list of results, e.g. `Template.encode_batch`.
+    return: PackedLLMDataset if the encoded rows can be packed (e.g. text-only), otherwise LLMDataset.
+    """
     if streaming:
+        if batched:
+            map_func = partial(_single_from_batch_map, map_func=map_func)
         return LLMIterableDataset(dataset.map(map_func))  # num_proc is not supported for IterableDataset
 
-    single_map = partial(_single_map, map_func=map_func)
-    if num_proc == 1:
-        data = []
-        for d in tqdm(dataset):
-            d = single_map(d)
-            data.append(d)
+    batch_map = partial(_batch_map, map_func=map_func, batched=batched)
+    num_proc = max(min(num_proc, len(dataset)), 1)
+    if cache_dir is not None and len(dataset) > 0:
+        assert cache_key is not None, 'Please specify the `cache_key` when using `cache_dir`.'
+        with safe_ddp_context():
+            parts = _cached_map(dataset, batch_map, num_proc, os.path.join(cache_dir, cache_key))
     else:
-        assert num_proc > 1
-        data = _map_mp(dataset, single_map, num_proc)
-    data = [d for d in data if d is not None]
-    if len(data) == 0:
+        parts = list(_map_chunks(dataset, batch_map, num_proc, _split_chunks(0, len(dataset), num_proc)))
+    if all(isinstance(part, dict) for part in parts):
+        res = PackedLLMDataset(parts)
+    else:
+        data = []
+        for part in parts:
+            data += _unpack_block(part) if isinstance(part, dict) else part
+        res = LLMDataset(data)
+    if len(res) == 0:
         logger.warning('len(dataset): 0')
         return None
-    return LLMDataset(data)
+    return res
 
 
 def stat_dataset(llm_dataset: Dataset) -> str:
     """Statistical analysis was performed on the dataset"""
     _token_len = []
-    if isinstance(llm_dataset, HfDataset):
+    if isinstance(llm_dataset, PackedLLMDataset):
+        _token_len = llm_dataset.get_lengths()
+    elif isinstance(llm_dataset, HfDataset):
         input_ids = llm_dataset['input_ids']
         for ii in input_ids:
             _token_len.append(len(ii))
@@ -496,7 +938,10 @@ def find_all_linears(model: Module, quantization_bit: int, model_type: str, quan
 
 def sort_by_max_length(llm_dataset: LLMDataset, num_dataset: int) -> LLMDataset:
     logger.info('sort by max length...')
-    dataset_len = [len(d['input_ids']) for d in llm_dataset]
+    if isinstance(llm_dataset, PackedLLMDataset):
+        dataset_len = llm_dataset.get_lengths().tolist()
+    else:
+        dataset_len = [len(d['input_ids']) for d in llm_dataset]
     idx = heapq.nlargest(num_dataset, range(len(dataset_len)), key=lambda i: dataset_len[i])
     return llm_dataset.select(idx)
 
@@ -547,6 +992,84 @@ class TokenListIteratorStreamer(BaseStreamer):
             return value
 
 
+def _prepare_generation_config(model: PreTrainedModel, tokenizer: PreTrainedTokenizerBase,
+                               generation_config: GenerationConfig, token_len: int) -> None:
+    """Set the special tokens of the generation_config, and limit the max_new_tokens by the model max_length."""
+    if tokenizer.eos_token_id is not None:
+        generation_config.eos_token_id = tokenizer.eos_token_id
+    if tokenizer.pad_token_id is not None:
+        generation_config.pad_token_id = tokenizer.pad_token_id
+    if tokenizer.bos_token_id is not None:
+        generation_config.bos_token_id = tokenizer.bos_token_id
+    if generation_config.max_new_tokens is not None:
+        generation_config.max_length = 20  # fix max_length, max_new_tokens warning
+        max_length = get_max_model_len(model.config)
+        if max_length and token_len + generation_config.max_new_tokens > max_length:
+            generation_config.max_new_tokens = max_length - token_len
+            if generation_config.max_new_tokens <= 0:
+                raise AssertionError(f'Current sentence length exceeds the model max_length: {max_length}')
+
+
+def _prepare_speculative_decoding(model: PreTrainedModel, inputs: Dict[str, Any], generation_config: GenerationConfig,
+                                  adapter_names: Optional[List[str]]) -> bool:
+    """Whether the speculative decoding is used (see `InferArguments.speculative_model`, `prompt_lookup_num_tokens`),
+    the draft model is passed to `model.generate` as the `assistant_model`."""
+    speculative_model = getattr(model, 'speculative_model', None)
+    prompt_lookup_num_tokens = getattr(generation_config, 'prompt_lookup_num_tokens', None)
+    if speculative_model is None and prompt_lookup_num_tokens is None:
+        return False
+    is_supported = ('input_ids' in inputs and not set(inputs.keys()) - {'input_ids', 'attention_mask'}
+                    and generation_config.num_beams == 1 and not getattr(model.config, 'is_encoder_decoder', False))
+    if prompt_lookup_num_tokens is None:
+        # The draft model does not support the `adapter_names` of the model_kwargs.
+        is_supported = is_supported and adapter_names is None
+        if is_supported:
+            inputs['assistant_model'] = speculative_model
+    elif not is_supported:  # e.g. multimodal, beam search
+        generation_config.prompt_lookup_num_tokens = None
+    return is_supported
+
+
+_generate_local = local()
+
+
+def _get_candidate_generator(self: PreTrainedModel, *args, **kwargs) -> Any:
+    """Record the number of the draft tokens and the accepted ones of the speculative decoding."""
+    candidate_generator = self._get_candidate_generator_origin(*args, **kwargs)
+    generation_info = getattr(_generate_local, 'generation_info', None)
+    if generation_info is None:
+        return candidate_generator
+    update_candidate_strategy = candidate_generator.update_candidate_strategy
+
+    def _update_candidate_strategy(input_ids: torch.Tensor, scores: torch.Tensor, num_matches: int) -> None:
+        # scores: [batch_size, num_draft_tokens + 1, vocab_size]
+        generation_info['num_draft_tokens'] += scores.shape[1] - 1
+        generation_info['num_accepted_tokens'] += int(num_matches)
+        generation_info['acceptance_rate'] = (
+            generation_info['num_accepted_tokens'] / max(generation_info['num_draft_tokens'], 1))
+        return update_candidate_strategy(input_ids, scores, num_matches)
+
+    candidate_generator.update_candidate_strategy = _update_candidate_strategy
+    return candidate_generator
+
+
+def _generate(model: PreTrainedModel, generation_info: Dict[str, Any], **kwargs) -> torch.Tensor:
+    """`model.generate`, the acceptance rate of the speculative decoding (if used) is recorded in generation_info."""
+    if 'num_draft_tokens' not in generation_info:
+        return model.generate(**kwargs)
+    hf_model = next((m for m in model.modules() if isinstance(m, PreTrainedModel)), None)
+    if not hasattr(hf_model, '_get_candidate_generator'):
+        return model.generate(**kwargs)
+    if not hasattr(hf_model, '_get_candidate_generator_origin'):
+        hf_model._get_candidate_generator_origin = hf_model._get_candidate_generator
+        hf_model._get_candidate_generator = MethodType(_get_candidate_generator, hf_model)
+    _generate_local.generation_info = generation_info
+    try:
+        return model.generate(**kwargs)
+    finally:
+        _generate_local.generation_info = None
+
+
 def _prepare_inputs(model: PreTrainedModel,
                     template: Template,
                     query: str,
@@ -597,28 +1120,25 @@ def _prepare_inputs(model: PreTrainedModel,
         inputs['token_type_ids'] = torch.tensor(inputs['token_type_ids'])[None]
     model.eval()
 
-    if tokenizer.eos_token_id is not None:
-        generation_config.eos_token_id = tokenizer.eos_token_id
-    if tokenizer.pad_token_id is not None:
-        generation_config.pad_token_id = tokenizer.pad_token_id
-    if tokenizer.bos_token_id is not None:
-        generation_config.bos_token_id = tokenizer.bos_token_id
-    if generation_config.max_new_tokens is not None:
-        generation_config.max_length = 20  # fix max_length, max_new_tokens warning
-        max_length = get_max_model_len(model.config)
-        if max_length and token_len + generation_config.max_new_tokens > max_length:
-            generation_config.max_new_tokens = max_length - token_len
-            if generation_config.max_new_tokens <= 0:
-                raise AssertionError(f'Current sentence length exceeds the model max_length: {max_length}')
+    _prepare_generation_config(model, tokenizer, generation_config, token_len)
     if template.suffix[-1] not in stop_words:
         stop_words.append(template.suffix[-1])
     inputs = to_device(inputs, device)
     if 'inputs_embeds' in inputs:
         inputs.pop('input_ids', None)
+    start_idx = -1
+    if _prepare_speculative_decoding(model, inputs, generation_config, adapter_names):
+        generation_info.update({'num_draft_tokens': 0, 'num_accepted_tokens': 0})
+        start_idx = token_len
+    prefix_cache = get_prefix_cache(model, inputs, generation_config)
+    if prefix_cache is not None:
+        # Only prefill the tokens after the cached prefix.
+        inputs['past_key_values'] = prefix_cache.get_past_key_values(inputs['input_ids'][0].tolist(), adapter_names)
     if adapter_names is not None:
         inputs['adapter_names'] = adapter_names
 
-    stopping_criteria = StoppingCriteriaList([StopWordsCriteria(tokenizer, stop_words, **tokenizer_kwargs)])
+    stopping_criteria = StoppingCriteriaList(
+        [StopWordsCriteria(tokenizer, stop_words, start_idx=start_idx, **tokenizer_kwargs)])
     inputs['stopping_criteria'] = stopping_criteria
     generation_info['num_prompt_tokens'] = token_len
     return inputs, tokenizer_kwargs, token_len, example
@@ -680,12 +1200,12 @@ def inference_stream(model: PreTrainedModel,
 
     streamer = TokenListIteratorStreamer()
     generation_kwargs = {'streamer': streamer, 'generation_config': generation_config, **inputs}
-    _model_generate = model.generate
+    _model_generate = partial(_generate, model, generation_info)
     if is_torch_npu_available():
 
-        def _model_generate(*args, **kwargs):
+        def _model_generate(**kwargs):
             torch.npu.set_device(model.device)
-            return model.generate(*args, **kwargs)
+            return _generate(model, generation_info, **kwargs)
 
     thread = Thread(target=_model_generate, kwargs=generation_kwargs)
     thread.start()
@@ -696,6 +1216,8 @@ def inference_stream(model: PreTrainedModel,
 
     print_idx = [0]
     first_num_space = [-1]
+    detokenizer = IncrementalDetokenizer(template.tokenizer, **tokenizer_kwargs)
+    num_prompt_tokens = None
 
     is_finished = False
     while not is_finished:
@@ -704,19 +1226,29 @@ def inference_stream(model: PreTrainedModel,
             raw_generate_ids += token_list
         except StopIteration:
             is_finished = True
-        generate_ids = template.get_generate_ids(torch.tensor(raw_generate_ids)[None], token_len)
+        if num_prompt_tokens is None:
+            # The streamer may or may not put the prompt (see `get_generate_ids`).
+            generate_ids = template.get_generate_ids(torch.tensor(raw_generate_ids)[None], token_len)
+            num_prompt_tokens = len(raw_generate_ids) - len(generate_ids)
+        else:
+            generate_ids = raw_generate_ids[num_prompt_tokens:]
         generation_info['num_generated_tokens'] = len(generate_ids)
         response = template.generate_ids_to_response(
             generate_ids,
             is_finished,
             tokenizer_kwargs=tokenizer_kwargs,
             print_idx=print_idx,
-            first_num_space=first_num_space)
+            first_num_space=first_num_space,
+            detokenizer=detokenizer)
         if not is_observation:
             history[-1] = [query, response]
         else:
             history[-1][-1] = history[-1][-1][:act_length] + response
 
+        if is_finished and 'past_key_values' in inputs:
+            thread.join()
+            model.prefix_cache.update(raw_generate_ids, inputs['past_key_values'], adapter_names)
+
         runtime = time.perf_counter() - start_runtime
         generation_info['runtime'] = runtime
         generation_info['samples/s'] = 1 / runtime
@@ -793,7 +1325,9 @@ def inference(model: PreTrainedModel,
         else:
             print(f'[QUERY]{query}\n{output_prefix}', end='')
 
-    generate_ids = model.generate(streamer=streamer, generation_config=generation_config, **inputs)
+    generate_ids = _generate(model, generation_info, streamer=streamer, generation_config=generation_config, **inputs)
+    if 'past_key_values' in inputs:
+        model.prefix_cache.update(generate_ids[0].tolist(), inputs['past_key_values'], adapter_names)
     generate_ids = template.get_generate_ids(generate_ids, token_len)
     generation_info['num_generated_tokens'] = len(generate_ids)
     if verbose and stream is False:
@@ -814,7 +1348,11 @@ def inference(model: PreTrainedModel,
 
 def limit_history_length(template: Template, query: str, history: Optional[History],
                          max_length: Optional[int]) -> Tuple[History, History]:
-    """binary search"""
+    """Keep the longest suffix of the history within max_length.
+
+    The history_length is estimated from the token lengths of the rounds and checked with two encodes,
+    with a fallback to the binary search.
+    """
     if history is None:
         history = []
     if max_length is None:
@@ -826,7 +1364,23 @@ def limit_history_length(template: Template, query: str, history: Optional[Histo
         input_ids = template.encode(example)[0]['input_ids']
         return len(input_ids)
 
-    history_length = upper_bound(0, len(history), lambda mid: compute_token_length(mid) <= max_length)
+    def cond(history_length: int) -> bool:
+        return history_length == 0 or compute_token_length(history_length) <= max_length
+
+    history_length = None
+    round_tokens = template.encode_rounds({'query': query, 'history': history}) if len(history) > 0 else None
+    if round_tokens is not None:
+        n_tokens = len(round_tokens[0]) + len(round_tokens[-1])
+        history_length = 0
+        for token_list in reversed(round_tokens[1:-1]):
+            n_tokens += len(token_list)
+            if n_tokens > max_length:
+                break
+            history_length += 1
+        if not cond(history_length) or (history_length < len(history) and cond(history_length + 1)):
+            history_length = None
+    if history_length is None:
+        history_length = upper_bound(0, len(history), cond)
     old_history = history[:len(history) - history_length]
     history = history[len(history) - history_length:]
     return old_history, history
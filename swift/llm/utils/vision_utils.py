@@ -1,9 +1,13 @@
 import base64
 import binascii
+import hashlib
 import math
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import Callable, List, TypeVar, Union
+from typing import Any, Callable, Hashable, List, Optional, TypeVar, Union
 
 import numpy as np
 import requests
@@ -12,6 +16,95 @@ import torch
 IMAGENET_MEAN = (0.485, 0.456, 0.406)
 IMAGENET_STD = (0.229, 0.224, 0.225)
 
+# The number of threads to load the medias of an example.
+media_num_threads = int(os.environ.get('MEDIA_NUM_THREADS', '8'))
+# The timeout (seconds) of the http requests.
+media_timeout = float(os.environ.get('MEDIA_TIMEOUT', '60'))
+# The directory to cache the downloaded http files. Disabled by default.
+media_url_cache_dir = os.environ.get('MEDIA_URL_CACHE_DIR')
+# The memory budget (MiB) of the LRU cache of the decoded images. Disabled (0) by default.
+# The cache is per process, so the host memory is up to IMAGE_CACHE_SIZE * (the number of the dataloader workers + 1)
+# on each rank.
+image_cache_size = int(os.environ.get('IMAGE_CACHE_SIZE', '0'))
+
+
+class _LRUCache:
+    """A thread-safe LRU cache bounded by the total size of the values."""
+
+    def __init__(self, max_size: int, get_size: Callable[[Any], int]) -> None:
+        self.max_size = max_size
+        self.get_size = get_size
+        self.size = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            value = self._cache.get(key)
+            if value is not None:
+                self._cache.move_to_end(key)
+            return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.get_size(value)
+        if size > self.max_size:
+            return
+        with self._lock:
+            old_value = self._cache.pop(key, None)
+            if old_value is not None:
+                self.size -= self.get_size(old_value)
+            self._cache[key] = value
+            self.size += size
+            while self.size > self.max_size:
+                _, old_value = self._cache.popitem(last=False)
+                self.size -= self.get_size(old_value)
+
+
+_image_cache = _LRUCache(image_cache_size * 1024**2, lambda img: img.width * img.height * len(img.getbands()))
+
+# The session and the executor are created lazily per process (e.g. the dataloader workers).
+_session: Optional[requests.Session] = None
+_executor: Optional[ThreadPoolExecutor] = None
+_pid: Optional[int] = None
+_init_lock = threading.Lock()
+
+
+def _init_process_resources() -> None:
+    global _session, _executor, _pid
+    if _pid == os.getpid():
+        return
+    with _init_lock:
+        if _pid == os.getpid():
+            return
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(media_num_threads, 10))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session = session
+        _executor = ThreadPoolExecutor(max(media_num_threads, 1), thread_name_prefix='swift-media')
+        _pid = os.getpid()
+
+
+def _download(url: str) -> bytes:
+    """Download the url with the persistent session, and cache the file if `MEDIA_URL_CACHE_DIR` is set."""
+    cache_path = None
+    if media_url_cache_dir:
+        cache_path = os.path.join(media_url_cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                return f.read()
+    _init_process_resources()
+    response = _session.get(url, timeout=media_timeout)
+    response.raise_for_status()
+    content = response.content
+    if cache_path is not None:
+        os.makedirs(media_url_cache_dir, exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, cache_path)
+    return content
+
 
 def build_transform(input_size):
     import torchvision.transforms as T
@@ -55,7 +148,7 @@ def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_
     return best_ratio
 
 
-def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False):
+def _get_target_aspect_ratio(image, min_num=1, max_num=6, image_size=448):
     orig_width, orig_height = image.size
     aspect_ratio = orig_width / orig_height
 
@@ -65,7 +158,11 @@ def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnai
     target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
 
     # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+    return find_closest_aspect_ratio(aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+
+
+def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False):
+    target_aspect_ratio = _get_target_aspect_ratio(image, min_num, max_num, image_size)
 
     # calculate the target width and height
     target_width = image_size * target_aspect_ratio[0]
@@ -89,14 +186,58 @@ def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnai
     return processed_images
 
 
+def _dynamic_preprocess_array(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False) -> np.ndarray:
+    """The same tiles as `dynamic_preprocess` (converted to RGB), cut from the resized image as numpy views.
+
+    return: uint8 array of [num_tiles, image_size, image_size, 3]
+    """
+    num_cols, num_rows = _get_target_aspect_ratio(image, min_num, max_num, image_size)
+    resized_img = image.resize((image_size * num_cols, image_size * num_rows))
+    if resized_img.mode != 'RGB':
+        resized_img = resized_img.convert('RGB')
+    res = np.asarray(resized_img).reshape(num_rows, image_size, num_cols, image_size, 3).swapaxes(1, 2)
+    res = res.reshape(-1, image_size, image_size, 3)
+    if use_thumbnail and res.shape[0] != 1:
+        thumbnail_img = image.resize((image_size, image_size))
+        if thumbnail_img.mode != 'RGB':
+            thumbnail_img = thumbnail_img.convert('RGB')
+        res = np.concatenate([res, np.asarray(thumbnail_img)[None]])
+    return res
+
+
+def _normalize_batch(images: np.ndarray) -> torch.Tensor:
+    """The batched version of `build_transform` for the tiles of the same size.
+
+    images: uint8 array of [N, H, W, 3]. return: float32 tensor of [N, 3, H, W]
+    """
+    pixel_values = torch.from_numpy(images.transpose(0, 3, 1, 2).copy())
+    pixel_values = pixel_values.to(torch.get_default_dtype()).div(255)
+    mean = torch.tensor(IMAGENET_MEAN, dtype=pixel_values.dtype)[:, None, None]
+    std = torch.tensor(IMAGENET_STD, dtype=pixel_values.dtype)[:, None, None]
+    return pixel_values.sub_(mean).div_(std)
+
+
 def load_image(img_path: Union[str, 'PIL.Image.Image']) -> 'PIL.Image.Image':
+    """Load the image from the url, path or base64 string.
+
+    The decoded images of the urls and paths (keyed by the mtime) can be cached in a per-process LRU cache, see
+    `IMAGE_CACHE_SIZE` (disabled by default). A copy is returned, so the cached images are not modified by the callers.
+    """
     from PIL import Image, UnidentifiedImageError
     if isinstance(img_path, str):
         img_path = img_path.strip()
+        cache_key = None
         if img_path.startswith('http'):
-            content = requests.get(img_path).content
-            image = Image.open(BytesIO(content))
+            cache_key = (img_path, None)
         elif os.path.exists(img_path):
+            cache_key = (img_path, os.path.getmtime(img_path))
+        if cache_key is not None and image_cache_size > 0:
+            image = _image_cache.get(cache_key)
+            if image is not None:
+                return image.copy()
+        if img_path.startswith('http'):
+            image = Image.open(BytesIO(_download(img_path)))
+        elif cache_key is not None:
             image = Image.open(img_path)
         else:  # base64_str
             try:
@@ -107,10 +248,15 @@ def load_image(img_path: Union[str, 'PIL.Image.Image']) -> 'PIL.Image.Image':
                     raise ValueError(f'invalid image: "{img_path}"')
                 else:
                     raise ValueError(f'invalid image: {error}')
+        image.load()  # decode in the thread of `_read_batch`
     else:
         image = img_path
+        cache_key = None
     if image.mode != 'RGB':
         image = image.convert('RGB')
+    if cache_key is not None and image_cache_size > 0:
+        _image_cache.put(cache_key, image)
+        image = image.copy()
     return image
 
 
@@ -119,20 +265,17 @@ _T = TypeVar('_T')
 
 def _read_batch(path_list: List[Union[str, 'PIL.Image.Image', None]],
                 load_func: Callable[[str], _T] = load_image) -> List[_T]:
-    res = []
-    for path in path_list:
-        if path is None:  # ignore None
-            continue
-        res.append(load_func(path))
-    return res
+    """Load the medias in a thread pool (see `MEDIA_NUM_THREADS`), the order is kept."""
+    path_list = [path for path in path_list if path is not None]  # ignore None
+    if len(path_list) <= 1 or media_num_threads <= 1:
+        return [load_func(path) for path in path_list]
+    _init_process_resources()
+    return list(_executor.map(load_func, path_list))
 
 
 def transform_image(image, input_size=448, max_num=6):
-    transform = build_transform(input_size=input_size)
-    images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=True, max_num=max_num)
-    pixel_values = [transform(image) for image in images]
-    pixel_values = torch.stack(pixel_values)
-    return pixel_values
+    images = _dynamic_preprocess_array(image, image_size=input_size, use_thumbnail=True, max_num=max_num)
+    return _normalize_batch(images)
 
 
 def get_index(bound, fps, max_frame, first_idx=0, num_segments=32):
@@ -151,8 +294,7 @@ def get_index(bound, fps, max_frame, first_idx=0, num_segments=32):
 def _load_file(video_path: str) -> BytesIO:
     video_path = video_path.strip()
     if video_path.startswith('http'):
-        content = requests.get(video_path).content
-        mp4_stream = BytesIO(content)
+        mp4_stream = BytesIO(_download(video_path))
     else:
         with open(video_path, 'rb') as f:
             mp4_stream = BytesIO(f.read())
@@ -162,21 +304,21 @@ def _load_file(video_path: str) -> BytesIO:
 def load_video(video_path, bound=None, input_size=448, max_num=1, num_segments=32):
     from decord import VideoReader, cpu
     from PIL import Image
-    vr = VideoReader(_load_file(video_path), ctx=cpu(0), num_threads=1)
+    video_path = video_path.strip()
+    # The local file is read by decord directly, without loading the whole file into memory.
+    video_file = _load_file(video_path) if video_path.startswith('http') else video_path
+    vr = VideoReader(video_file, ctx=cpu(0), num_threads=1)
     max_frame = len(vr) - 1
     fps = float(vr.get_avg_fps())
 
-    pixel_values_list, num_patches_list = [], []
-    transform = build_transform(input_size=input_size)
     frame_indices = get_index(bound, fps, max_frame, first_idx=0, num_segments=num_segments)
-    for frame_index in frame_indices:
-        img = Image.fromarray(vr[frame_index].asnumpy()).convert('RGB')
-        img = dynamic_preprocess(img, image_size=input_size, use_thumbnail=True, max_num=max_num)
-        pixel_values = [transform(tile) for tile in img]
-        pixel_values = torch.stack(pixel_values)
-        num_patches_list.append(pixel_values.shape[0])
-        pixel_values_list.append(pixel_values)
-    pixel_values = torch.cat(pixel_values_list)
+    frames = vr.get_batch(frame_indices).asnumpy()
+    tiles_list = [
+        _dynamic_preprocess_array(Image.fromarray(frame), image_size=input_size, use_thumbnail=True, max_num=max_num)
+        for frame in frames
+    ]
+    num_patches_list = [tiles.shape[0] for tiles in tiles_list]
+    pixel_values = _normalize_batch(np.concatenate(tiles_list))
     return pixel_values, num_patches_list
 
 
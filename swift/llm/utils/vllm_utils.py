@@ -3,9 +3,10 @@ import concurrent.futures
 import inspect
 import os
 import time
+from collections import deque
 from contextlib import contextmanager
 from copy import deepcopy
-from typing import Any, Dict, Iterator, List, Optional, Tuple
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
 
 import torch
 import vllm
@@ -20,7 +21,7 @@ from vllm import AsyncEngineArgs, AsyncLLMEngine, EngineArgs, LLMEngine, Samplin
 from swift.utils import get_logger
 from .argument import InferArguments
 from .model import MODEL_MAPPING, get_model_tokenizer
-from .template import Template, get_template
+from .template import IncrementalDetokenizer, Template, get_template
 
 try:
     from vllm.lora.request import LoRARequest
@@ -245,19 +246,11 @@ def _add_vllm_request(llm_engine: LLMEngine, inputs: Dict[str, Any], *, request_
         llm_engine.add_request(request_id, None, generation_config, input_ids, **kwargs)
 
 
-def _prepare_vllm_request(llm_engine: LLMEngine,
-                          template: Template,
-                          request_list: List[Dict[str, Any]],
-                          *,
-                          generation_config: VllmGenerationConfig,
-                          generation_info: Dict[str, Any],
-                          lora_request: Optional['LoRARequest'] = None,
-                          use_tqdm: bool = False,
-                          **kwargs) -> Tuple[List[Optional[Dict[str, Any]]], List[Tuple[bool, int]]]:
-    for key in ['num_prompt_tokens', 'num_generated_tokens', 'num_samples']:
-        if key not in generation_info:
-            generation_info[key] = 0
-
+def _prepare_vllm_generation_config(llm_engine: LLMEngine,
+                                    template: Template,
+                                    generation_config: VllmGenerationConfig,
+                                    lora_request: Optional['LoRARequest'] = None) -> Dict[str, Any]:
+    """Add the stop words to the generation_config, and return the kwargs of `llm_engine.add_request`."""
     template.model = llm_engine
     tokenizer = template.tokenizer
     if tokenizer.eos_token is not None and tokenizer.eos_token not in generation_config.stop:
@@ -276,9 +269,39 @@ def _prepare_vllm_request(llm_engine: LLMEngine,
     else:
         assert lora_request is None, (
             'The current version of VLLM does not support `lora_request`. Please upgrade VLLM.')
+    return add_request_kwargs
+
 
+def _preprocess_vllm_request(request: Dict[str, Any]) -> Tuple[bool, Optional[int]]:
+    """return: The agent state (is_observation, act_length) of the request."""
+    history = request.get('history') or []
+    # agent support
+    is_observation = history[-1][-1].endswith('Observation:') if history and history[-1][-1] else False
+    act_length = None
+    if is_observation:
+        history[-1][-1] = history[-1][-1] + request['query']
+        act_length = len(history[-1][-1])
+        request['query'] = None
+    request['history'] = history
+    return is_observation, act_length
+
+
+def _prepare_vllm_request(llm_engine: LLMEngine,
+                          template: Template,
+                          request_list: List[Dict[str, Any]],
+                          *,
+                          generation_config: VllmGenerationConfig,
+                          generation_info: Dict[str, Any],
+                          lora_request: Optional['LoRARequest'] = None,
+                          use_tqdm: bool = False,
+                          **kwargs) -> Tuple[List[Optional[Dict[str, Any]]], List[Tuple[bool, int]]]:
+    for key in ['num_prompt_tokens', 'num_generated_tokens', 'num_samples']:
+        if key not in generation_info:
+            generation_info[key] = 0
+
+    add_request_kwargs = _prepare_vllm_generation_config(llm_engine, template, generation_config, lora_request)
     resp_list: List[Optional[Dict[str, Any]]] = [None] * len(request_list)
-    agent_state = []
+    agent_state = [_preprocess_vllm_request(request) for request in request_list]
     is_multimodal = getattr(llm_engine, 'is_multimodal', False)
     max_workers = os.cpu_count()
     if not is_multimodal:
@@ -288,30 +311,24 @@ def _prepare_vllm_request(llm_engine: LLMEngine,
     prog_bar = tqdm(request_list, dynamic_ncols=True, disable=not use_tqdm)
 
     def _prepare_inputs(request: Dict[str, Any]) -> Dict[str, Any]:
-        history = request.get('history') or []
-        # agent support
-        is_observation = history[-1][-1].endswith('Observation:') if history and history[-1][-1] else False
-        act_length = None
-        if is_observation:
-            history[-1][-1] = history[-1][-1] + request['query']
-            act_length = len(history[-1][-1])
-            request['query'] = None
-        agent_state.append((is_observation, act_length))
-        request['history'] = history
-
         inputs = template.encode(request)[0]
         prog_bar.update()
         return inputs
 
-    with vllm_context(template), concurrent.futures.ThreadPoolExecutor(
-            max_workers=min(max_workers, len(request_list))) as executor:
-        futures = [executor.submit(_prepare_inputs, request) for request in request_list]
-        concurrent.futures.wait(futures)
-        inputs_list = [future.result() for future in futures]
+    if is_multimodal:
+        with vllm_context(template), concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(max_workers, len(request_list))) as executor:
+            futures = [executor.submit(_prepare_inputs, request) for request in request_list]
+            concurrent.futures.wait(futures)
+            inputs_list = [future.result() for future in futures]
+    else:
+        # Tokenize the texts of all the requests by one tokenizer call
+        with vllm_context(template):
+            inputs_list = [inputs for inputs, _ in template.encode_batch(request_list)]
     prog_bar.close()
 
+    truncation_strategy = kwargs.pop('truncation_strategy', 'delete')
     for i, (inputs, request) in enumerate(zip(inputs_list, request_list)):
-        truncation_strategy = kwargs.pop('truncation_strategy', 'delete')
         if len(inputs) == 0 and truncation_strategy == 'delete':
             # input_ids exceeds `max_length`. Please increase the value of `max_length`.
             resp_list[i] = {'response': '', 'history': request['history']}
@@ -374,6 +391,7 @@ def inference_stream_vllm(
     if flush_steps is None:
         flush_steps = min(10, generation_info['num_samples'])
     print_idx_list = [[0] for _ in range(len(request_list))]
+    detokenizer_list = [IncrementalDetokenizer(template.tokenizer) for _ in range(len(request_list))]
     num_generated_tokens = [0] * len(request_list)
     prog_bar = tqdm(total=generation_info['num_samples'], dynamic_ncols=True, disable=not use_tqdm)
     while llm_engine.has_unfinished_requests():
@@ -388,7 +406,7 @@ def inference_stream_vllm(
             request = request_list[i]
             generate_ids = output.outputs[0].token_ids
             safe_response = template.generate_ids_to_response(
-                generate_ids, output.finished, print_idx=print_idx_list[i])
+                generate_ids, output.finished, print_idx=print_idx_list[i], detokenizer=detokenizer_list[i])
             query = request['query']
             history = request['history']
             if resp_list[i] is None and not agent_state[i][0]:
@@ -434,6 +452,8 @@ def inference_vllm(llm_engine: LLMEngine,
     request_list: e.g. [{'query': 'hello!'}].
         The keys that can be included are: 'query', 'history', 'system', 'images'.
     generation_config: Priority: generation_config > model.generation_config.
+    max_batch_size: The max number of the requests in the engine at the same time.
+        The requests are encoded in the background (at most `max_batch_size` ahead) while the engine is generating.
     return: e.g. [{'response': 'hi!', 'history': [('hello!', 'hi!')]}].
         The keys to be included will be: 'response', 'history'.
     """
@@ -442,68 +462,94 @@ def inference_vllm(llm_engine: LLMEngine,
     runtime = time.perf_counter()
 
     is_multimodal = getattr(llm_engine, 'is_multimodal', False)
-    if is_multimodal and max_batch_size is None:
-        max_batch_size = 512
-
-    _inner_call = kwargs.get('_inner_call', False)
+    if max_batch_size is None:
+        max_batch_size = 512 if is_multimodal else len(request_list)
     if generation_info is None:
         generation_info = {}
-    elif not _inner_call:
+    else:
         generation_info.clear()
-    if max_batch_size is not None and len(request_list) > max_batch_size:
-        i = 0
-        resp_list = []
-        kwargs['_inner_call'] = True
-        while i < len(request_list):
-            resp_list += inference_vllm(
-                llm_engine,
-                template,
-                request_list[i:i + max_batch_size],
-                generation_config=generation_config,
-                generation_info=generation_info,
-                max_batch_size=max_batch_size,
-                lora_request=lora_request,
-                use_tqdm=use_tqdm,
-                verbose=verbose,
-                prompt_prefix=prompt_prefix,
-                output_prefix=output_prefix,
-                **kwargs)
-            i += max_batch_size
-        runtime = time.perf_counter() - runtime
-        generation_info['runtime'] = runtime
-        generation_info['samples/s'] = generation_info['num_samples'] / runtime
-        generation_info['tokens/s'] = generation_info['num_generated_tokens'] / runtime
-        return resp_list
+    for key in ['num_prompt_tokens', 'num_generated_tokens', 'num_samples']:
+        generation_info[key] = 0
 
     if generation_config is None:
         generation_config = getattr(llm_engine, 'generation_config', VllmGenerationConfig())
     assert isinstance(generation_config, VllmGenerationConfig)
     request_list = deepcopy(request_list)
     generation_config = deepcopy(generation_config)
-
-    old_num_samples = generation_info.get('num_samples', 0)
-    resp_list, agent_state = _prepare_vllm_request(
-        llm_engine,
-        template,
-        request_list,
-        generation_config=generation_config,
-        generation_info=generation_info,
-        lora_request=lora_request,
-        use_tqdm=use_tqdm,
-        **kwargs)
+    add_request_kwargs = _prepare_vllm_generation_config(llm_engine, template, generation_config, lora_request)
+    truncation_strategy = kwargs.pop('truncation_strategy', 'delete')
 
     tokenizer = template.tokenizer
     if use_tqdm:
         assert verbose is False
-    prog_bar = tqdm(total=generation_info['num_samples'] - old_num_samples, dynamic_ncols=True, disable=not use_tqdm)
+    resp_list: List[Optional[Dict[str, Any]]] = [None] * len(request_list)
+    agent_state: List[Optional[Tuple[bool, Optional[int]]]] = [None] * len(request_list)
+    if is_multimodal:
+        # The images are loaded and processed request by request in the thread pool.
+        max_workers, chunk_size = os.cpu_count(), 1
+    else:
+        # Tokenize the texts of a chunk of the requests by one tokenizer call
+        max_workers, chunk_size = 1, min(max_batch_size, 256)
+
+    def _encode(idx_list: List[int]) -> List[Dict[str, Any]]:
+        chunk = [request_list[i] for i in idx_list]
+        for i, request in zip(idx_list, chunk):
+            agent_state[i] = _preprocess_vllm_request(request)
+        if is_multimodal:
+            return [template.encode(chunk[0])[0]]
+        return [inputs for inputs, _ in template.encode_batch(chunk)]
+
+    prog_bar = tqdm(total=len(request_list), dynamic_ncols=True, disable=not use_tqdm)
+    # pipeline: encode (in the background) -> add_request -> step, the results are collected by the request_id.
+    pending: Deque[Tuple[List[int], concurrent.futures.Future]] = deque()  # submitted to the executor
+    ready: Deque[Tuple[int, Dict[str, Any]]] = deque()  # encoded, waiting for the free slots of the engine
+    next_idx, num_prefetched, num_running = 0, 0, 0
     outputs = []
-    while llm_engine.has_unfinished_requests():
-        step_outputs = llm_engine.step()
-        for output in step_outputs:
-            if output.finished:
-                outputs.append(output)
-                prog_bar.update()
-    prog_bar.close()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        with vllm_context(template):
+            while True:
+                while next_idx < len(request_list) and num_prefetched < max_batch_size:
+                    idx_list = list(range(next_idx, min(next_idx + chunk_size, len(request_list))))
+                    pending.append((idx_list, executor.submit(_encode, idx_list)))
+                    next_idx += len(idx_list)
+                    num_prefetched += len(idx_list)
+                # Wait for the encoding only if the engine is idle; keep the order of the requests.
+                while pending and (pending[0][1].done() or num_running == 0 and not ready):
+                    idx_list, future = pending.popleft()
+                    ready.extend(zip(idx_list, future.result()))
+                while ready and num_running < max_batch_size:
+                    i, inputs = ready.popleft()
+                    num_prefetched -= 1
+                    if len(inputs) == 0 and truncation_strategy == 'delete':
+                        # input_ids exceeds `max_length`. Please increase the value of `max_length`.
+                        resp_list[i] = {'response': '', 'history': request_list[i]['history']}
+                        prog_bar.update()
+                        continue
+                    generation_info['num_prompt_tokens'] += len(inputs['input_ids'])
+                    generation_info['num_samples'] += 1
+                    _add_vllm_request(
+                        llm_engine,
+                        inputs,
+                        request_id=str(i),
+                        generation_config=generation_config,
+                        **add_request_kwargs)
+                    num_running += 1
+                if num_running == 0:
+                    if next_idx < len(request_list) or pending or ready:
+                        continue
+                    break
+                step_outputs = llm_engine.step()
+                for output in step_outputs:
+                    if output.finished:
+                        outputs.append(output)
+                        num_running -= 1
+                        prog_bar.update()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+        prog_bar.close()
 
     for output in outputs:
         i = int(output.request_id)
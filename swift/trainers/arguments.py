@@ -16,10 +16,16 @@ from swift.utils import is_dist, use_torchacc
 class SwiftArgumentsMixin:
     # ckpt only save model
     save_only_model: bool = False
+    # write the checkpoints in the background thread (staged in `tmp-checkpoint-xxx`)
+    async_save: bool = False
     train_sampler_random: bool = True
+    # dynamic batch size with group_by_length: the max number of tokens (including padding) per device
+    max_tokens_per_batch: Optional[int] = None
     push_hub_strategy: str = field(
         default='push_best', metadata={'choices': {'end', 'push_best', 'push_last', 'checkpoint', 'all_checkpoints'}})
     acc_strategy: str = field(default='token', metadata={'choices': ['token', 'sentence']})
+    # > 0: the number of tokens per chunk of the loss computed from the hidden states and the lm_head
+    loss_chunk_size: int = 0
     additional_saved_files: Optional[List[str]] = None
     metric_warmup_step: Optional[float] = 0
     train_dataset_sample: Optional[int] = -1
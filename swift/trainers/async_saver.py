@@ -0,0 +1,69 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+import os
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+from torch import Tensor, nn
+
+from swift.utils import get_logger
+
+logger = get_logger()
+
+
+class AsyncCheckpointSaver:
+    """Write the checkpoints in a background thread, so the training loop is not blocked by the disk I/O.
+
+    The weights are first copied to the (pinned) CPU buffers, which are reused by the following checkpoints. The frozen
+    parameters (e.g. the base model of LoRA) are not copied since they do not change during the training.
+    The jobs are executed one by one in the order of submission.
+    """
+
+    def __init__(self) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='async_saver')
+        self._futures: List[Future] = []
+        self._buffers: Dict[str, Tensor] = {}
+
+    def snapshot(self, model: nn.Module, state_dict: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Copy the state_dict (default: the state_dict of the model) to the CPU memory."""
+        if state_dict is None:
+            state_dict = model.state_dict()
+        frozen_ptrs = {p.data_ptr() for p in model.parameters() if not p.requires_grad}
+        copied: Dict[int, Tensor] = {}  # data_ptr -> buffer, the tied weights share the buffer.
+        res = {}
+        for key, value in state_dict.items():
+            if not isinstance(value, Tensor) or value.data_ptr() in frozen_ptrs:
+                res[key] = value
+                continue
+            buffer = copied.get(value.data_ptr())
+            if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                buffer = self._buffers.get(key)
+                if buffer is None or buffer.shape != value.shape or buffer.dtype != value.dtype:
+                    pin_memory = value.device.type == 'cuda'
+                    buffer = torch.empty(value.shape, dtype=value.dtype, device='cpu', pin_memory=pin_memory)
+                    self._buffers[key] = buffer
+                buffer.copy_(value.detach(), non_blocking=True)
+                copied[value.data_ptr()] = buffer
+            res[key] = buffer
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return res
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        future = self._executor.submit(fn, *args, **kwargs)
+        self._futures.append(future)
+        return future
+
+    def wait(self) -> None:
+        """Wait for the submitted jobs, the exception of the jobs is raised."""
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    @staticmethod
+    def commit(staging_dir: str, output_dir: str) -> None:
+        """Move the completed checkpoint to its final directory atomically."""
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.replace(staging_dir, output_dir)
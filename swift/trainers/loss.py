@@ -0,0 +1,109 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor, nn
+from torch.utils.checkpoint import checkpoint
+
+from swift.utils import get_logger
+
+logger = get_logger()
+
+# The config keys of the models that transform the logits after the lm_head (e.g. gemma2, cohere).
+_LOGITS_TRANSFORM_KEYS = ['final_logit_softcapping', 'logit_scale', 'logits_scaling']
+
+
+def get_chunked_loss_lm_head(model: nn.Module) -> Optional[nn.Module]:
+    """The lm_head whose input is used as the hidden states of the chunked loss, None if not supported."""
+    get_output_embeddings = getattr(model, 'get_output_embeddings', None)
+    lm_head = get_output_embeddings() if get_output_embeddings is not None else None
+    if not isinstance(lm_head, nn.Module):
+        return None
+    config = getattr(model, 'config', None)
+    for key in _LOGITS_TRANSFORM_KEYS:
+        if getattr(config, key, None) not in {None, 1, 1.}:
+            return None
+    return lm_head
+
+
+@contextmanager
+def skip_lm_head(lm_head: nn.Module) -> Iterator[Tuple[Callable[[Tensor], Tensor], Dict[str, Tensor]]]:
+    """Replace the forward of the lm_head with the identity, so the [bs, seq, vocab] logits are not materialized.
+
+    yield: The original forward of the lm_head, the dict which records its input (`hidden_states`).
+    """
+    forward = lm_head.forward
+    is_patched = 'forward' in lm_head.__dict__  # e.g. the hooks of accelerate
+    inputs = {}
+
+    def _forward(hidden_states: Tensor, *args: Any, **kwargs: Any) -> Tensor:
+        inputs['hidden_states'] = hidden_states
+        return hidden_states
+
+    lm_head.forward = _forward
+    try:
+        yield forward, inputs
+    finally:
+        if is_patched:
+            lm_head.forward = forward
+        else:
+            del lm_head.forward
+
+
+def _chunk_loss(lm_head: Callable[[Tensor], Tensor], hidden_states: Tensor, labels: Tensor,
+                loss_scale: Optional[Tensor], label_smoothing: float) -> Tuple[Tensor, Tensor]:
+    logits = lm_head(hidden_states).float()
+    loss = F.cross_entropy(logits, labels, reduction='none', label_smoothing=label_smoothing)
+    if loss_scale is not None:
+        loss = loss * loss_scale
+    return loss.sum(), logits.argmax(dim=-1)
+
+
+def chunked_causal_lm_loss(lm_head: Callable[[Tensor], Tensor],
+                           hidden_states: Tensor,
+                           labels: Tensor,
+                           loss_scale: Optional[Tensor] = None,
+                           label_smoothing: float = 0.,
+                           chunk_size: int = 1024) -> Tuple[Tensor, Tensor]:
+    """The shifted cross entropy loss of the causal lm, computed from the hidden states in chunks of tokens.
+
+    Only the tokens with labels are projected by the lm_head, and the logits of each chunk are recomputed in the
+    backward (activation checkpointing), so at most [chunk_size, vocab] logits are alive at any time.
+
+    Args:
+        lm_head: The (original) forward of the lm_head.
+        hidden_states: The input of the lm_head, [bs, seq, hidden_size].
+        labels: [bs, seq], -100 is ignored.
+        loss_scale: The weight of each token, [bs, seq].
+        label_smoothing: The label_smoothing_factor, same as the `LabelSmoother` of transformers.
+        chunk_size: The number of tokens per chunk.
+    return: The loss averaged over the tokens with labels, the predictions of the shifted labels
+        ([bs, seq - 1], -100 for the ignored tokens).
+    """
+    device = hidden_states.device
+    shift_labels = labels[..., 1:].to(device)
+    masks = shift_labels != -100
+    hidden_states = hidden_states[..., :-1, :][masks]
+    target = shift_labels[masks]
+    if loss_scale is not None:
+        loss_scale = loss_scale[..., 1:].to(device)[masks]
+    if target.shape[0] == 0:
+        # No labelled tokens, the zero loss is kept in the graph, so the backward works (and DDP does not hang).
+        return lm_head(hidden_states).float().sum(), torch.full_like(shift_labels, -100)
+    loss = hidden_states.new_zeros((), dtype=torch.float32)
+    preds_list = []
+    for i in range(0, target.shape[0], chunk_size):
+        chunk_scale = None if loss_scale is None else loss_scale[i:i + chunk_size]
+        args = (lm_head, hidden_states[i:i + chunk_size], target[i:i + chunk_size], chunk_scale, label_smoothing)
+        if torch.is_grad_enabled():
+            chunk_loss, chunk_preds = checkpoint(_chunk_loss, *args, use_reentrant=False)
+        else:
+            chunk_loss, chunk_preds = _chunk_loss(*args)
+        loss = loss + chunk_loss
+        preds_list.append(chunk_preds)
+    loss = loss / target.shape[0]
+    preds = torch.full_like(shift_labels, -100)
+    preds[masks] = torch.concat(preds_list).to(preds.dtype)
+    return loss, preds
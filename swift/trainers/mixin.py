@@ -17,6 +17,7 @@ from datasets import Dataset as HfDataset
 from packaging import version
 from peft import PeftModel
 from torch.nn import Module
+from torch.utils.data import DataLoader
 from transformers import PreTrainedModel, PreTrainedTokenizerBase
 from transformers.data.data_collator import DataCollator
 from transformers.integrations import is_deepspeed_zero3_enabled
@@ -24,7 +25,7 @@ from transformers.modeling_utils import unwrap_model
 from transformers.trainer import (ADAPTER_CONFIG_NAME, ADAPTER_SAFE_WEIGHTS_NAME, ADAPTER_WEIGHTS_NAME, CONFIG_NAME,
                                   PREFIX_CHECKPOINT_DIR, SAFE_WEIGHTS_NAME, TRAINER_STATE_NAME, TRAINING_ARGS_NAME,
                                   WEIGHTS_NAME, IntervalStrategy, Trainer, TrainerCallback, is_peft_available)
-from transformers.trainer_utils import EvalPrediction
+from transformers.trainer_utils import EvalPrediction, seed_worker
 from transformers.training_args import TrainingArguments
 from transformers.utils import is_sagemaker_mp_enabled, is_torch_npu_available
 
@@ -33,9 +34,12 @@ from swift.hub.check_model import check_local_model_is_latest
 from swift.torchacc_utils import (save_ta_ddp_checkpoint, save_ta_fsdp_checkpoint, ta_load_optimizer_and_scheduler,
                                   ta_save_optimizer_and_scheduler, ta_trim_graph)
 from swift.tuners import SwiftModel
-from swift.utils import check_json_format, create_ms_repo, get_logger, use_torchacc
+from swift.utils import (check_json_format, create_ms_repo, get_device_peak_flops, get_logger, get_n_params_grads,
+                         use_torchacc)
 from swift.utils.constants import Invoke
-from .optimizers.galore import create_optimizer_and_scheduler
+from .async_saver import AsyncCheckpointSaver
+from .optimizers.galore import GaloreOptimizerWrapper, create_optimizer_and_scheduler, pop_galore_svd_time
+from .sampler import LengthGroupedSampler, MaxTokensBatchSampler
 from .utils import can_return_loss, find_labels, get_function, is_instance_of_ms_model
 
 logger = get_logger()
@@ -206,6 +210,54 @@ class PushToMsHubMixin:
                 shutil.move(tmp_checkpoint, checkpoint_folder)
 
 
+class _TimedDataLoader:
+    """Accumulate the time of fetching the batches into `trainer._data_time`.
+
+    The other attributes (and the class, for `isinstance`) are those of the wrapped dataloader,
+    e.g. accelerate's `DataLoaderShard`.
+    """
+
+    def __init__(self, dataloader: DataLoader, trainer: 'SwiftMixin') -> None:
+        self.dataloader = dataloader
+        self.trainer = trainer
+
+    @property
+    def __class__(self):
+        return self.dataloader.__class__
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.dataloader, name)
+
+    def __len__(self) -> int:
+        return len(self.dataloader)
+
+    def __iter__(self):
+        iterator = iter(self.dataloader)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.trainer._data_time += time.perf_counter() - start_time
+            yield batch
+
+
+def _patch_skip_first_batches() -> None:
+    """Keep the timing of the dataloader that skips the trained batches when resuming from a checkpoint."""
+    skip_first_batches = transformers.trainer.skip_first_batches
+    if getattr(skip_first_batches, '_is_timed', False):
+        return
+
+    def _skip_first_batches(dataloader, num_batches=0):
+        if isinstance(dataloader, _TimedDataLoader):
+            return _TimedDataLoader(skip_first_batches(dataloader.dataloader, num_batches), dataloader.trainer)
+        return skip_first_batches(dataloader, num_batches)
+
+    _skip_first_batches._is_timed = True
+    transformers.trainer.skip_first_batches = _skip_first_batches
+
+
 class SwiftMixin:
 
     def __init__(self,
@@ -264,6 +316,20 @@ class SwiftMixin:
         self.start_time = time.time()
         self._resume_from_checkpoint = None
         self._resume_only_model = False
+        self._async_saver = None
+        self._async_saving = False
+        if getattr(self.args, 'async_save', False):
+            if isinstance(unwrap_model(self.model), SwiftModel) or use_torchacc():
+                logger.warning('async_save is not supported with the swift tuners or torchacc, ignored.')
+            else:
+                self._async_saver = AsyncCheckpointSaver()
+        # throughput
+        self._num_tokens = torch.tensor(0, device=self.args.device)
+        self._data_time = 0.
+        self._excluded_time = 0.
+        self._log_start_time: Optional[float] = None
+        self._last_log_time = time.time()
+        self._flops_per_token: Optional[float] = None
         # performance
         self.perf: Dict[str, Any] = {'memory': {}}
         if hasattr(self.model, 'get_trainable_parameters'):
@@ -360,6 +426,14 @@ class SwiftMixin:
         # If we are executing this function, we are the process zero, so we don't check for that.
         output_dir = output_dir if output_dir is not None else self.args.output_dir
         os.makedirs(output_dir, exist_ok=True)
+        if self._async_saving:
+            # Snapshot the weights to the CPU memory, the files are written in the background.
+            state_dict = self._async_saver.snapshot(self.model, state_dict)
+            self._async_saver.submit(self._save_files, output_dir, state_dict)
+        else:
+            self._save_files(output_dir, state_dict)
+
+    def _save_files(self, output_dir: str, state_dict=None):
         # configuration.json
         model_dir = getattr(self.model, 'model_dir', None)
         if model_dir is not None:
@@ -434,7 +508,9 @@ class SwiftMixin:
                 self.deepspeed._zero3_consolidated_16bit_state_dict)
             self.deepspeed._zero3_consolidated_16bit_state_dict = MethodType(_zero3_consolidated_16bit_state_dict,
                                                                              self.deepspeed)
-        if version.parse(transformers.__version__) >= version.parse('4.36') or not self.args.save_only_model:
+        if self._async_saver is not None:
+            result = self._save_checkpoint_async(model, trial, metrics)
+        elif version.parse(transformers.__version__) >= version.parse('4.36') or not self.args.save_only_model:
             result = super()._save_checkpoint(model, trial, metrics)
         else:
             result = self._save_only_model(model, trial, metrics)
@@ -477,13 +553,119 @@ class SwiftMixin:
         if self.args.should_save:
             self._rotate_checkpoints(use_mtime=True, output_dir=run_dir)
 
+    def _save_checkpoint_async(self, model, trial, metrics=None):
+        """The checkpoint is written to `tmp-checkpoint-xxx`, and renamed to `checkpoint-xxx` after all the files are
+        written, so `_sorted_checkpoints` never sees a half-written checkpoint. The model files are written in the
+        background, while the optimizer, scheduler, rng and trainer states are written before returning."""
+        checkpoint_folder = f'{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}'
+
+        if self.hp_search_backend is None and trial is None:
+            self.store_flos()
+
+        run_dir = self._get_output_dir(trial=trial)
+        output_dir = os.path.join(run_dir, checkpoint_folder)
+        staging_dir = os.path.join(run_dir, f'tmp-{checkpoint_folder}')
+        # At most one checkpoint in flight, which bounds the CPU memory of the snapshot.
+        self._async_saver.wait()
+        self._async_saving = True
+        try:
+            self.save_model(staging_dir, _internal_call=True)
+        finally:
+            self._async_saving = False
+        if not self.args.save_only_model:
+            self._save_optimizer_and_scheduler(staging_dir)
+            self._save_rng_state(staging_dir)
+
+        # Determine the new best metric / best model checkpoint
+        if metrics is not None and self.args.metric_for_best_model is not None:
+            metric_to_check = self.args.metric_for_best_model
+            if not metric_to_check.startswith('eval_'):
+                metric_to_check = f'eval_{metric_to_check}'
+            metric_value = metrics[metric_to_check]
+
+            operator = np.greater if self.args.greater_is_better else np.less
+            if (self.state.best_metric is None or self.state.best_model_checkpoint is None
+                    or operator(metric_value, self.state.best_metric)):
+                self.state.best_metric = metric_value
+                self.state.best_model_checkpoint = output_dir
+
+        # Save the Trainer state
+        if self.args.should_save:
+            if hasattr(self.state, 'stateful_callbacks'):
+                self.state.stateful_callbacks['TrainerControl'] = self.control.state()
+            os.makedirs(staging_dir, exist_ok=True)
+            self.state.save_to_json(os.path.join(staging_dir, TRAINER_STATE_NAME))
+
+        # The other processes write the rng states (and the deepspeed shards) to the staging dir.
+        self.accelerator.wait_for_everyone()
+        if self.args.should_save:
+            self._async_saver.submit(self._commit_checkpoint, staging_dir, output_dir, run_dir)
+
+    def _commit_checkpoint(self, staging_dir: str, output_dir: str, run_dir: str) -> None:
+        AsyncCheckpointSaver.commit(staging_dir, output_dir)
+        logger.info(f'The checkpoint has been saved asynchronously: {output_dir}')
+        # push to hub
+        if self.args.push_to_hub:
+            self._push_from_checkpoint(output_dir)
+
+        # Maybe delete some older checkpoints.
+        self._rotate_checkpoints(use_mtime=False, output_dir=run_dir)
+
+    def wait_async_save(self) -> None:
+        """Wait for the checkpoints being saved in the background."""
+        if self._async_saver is not None:
+            self._async_saver.wait()
+
+    def _get_length_grouped_sampler(self) -> Optional[LengthGroupedSampler]:
+        args = self.args
+        if not args.group_by_length or use_torchacc() or self.train_dataset is None:
+            return None
+        if not hasattr(self.train_dataset, 'get_lengths'):
+            logger.warning(f'The lengths of {self.train_dataset.__class__.__name__} are not precomputed, '
+                           'use the length grouped sampler of transformers.')
+            return None
+        seed = args.data_seed if args.data_seed is not None else args.seed
+        return LengthGroupedSampler(
+            self.train_dataset.get_lengths(),
+            self._train_batch_size,
+            getattr(args, 'max_tokens_per_batch', None),
+            seed=seed,
+            drop_last=args.dataloader_drop_last)
+
     def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
         train_sampler_random = self.args.train_sampler_random
         if train_sampler_random:
+            sampler = self._get_length_grouped_sampler()
+            if sampler is not None:
+                return sampler
             return super()._get_train_sampler()
         else:
             return self._get_eval_sampler(self.train_dataset)
 
+    def get_train_dataloader(self) -> DataLoader:
+        _patch_skip_first_batches()
+        return _TimedDataLoader(self._get_train_dataloader(), self)
+
+    def _get_train_dataloader(self) -> DataLoader:
+        if getattr(self.args, 'max_tokens_per_batch', None) is None or not self.args.train_sampler_random:
+            return super().get_train_dataloader()
+        sampler = self._get_length_grouped_sampler()
+        if sampler is None:
+            return super().get_train_dataloader()
+        # The batch size is decided by the sampler.
+        data_collator = self._get_collator_with_removed_columns(self.data_collator, description='training')
+        dataloader_params = {
+            'batch_sampler': MaxTokensBatchSampler(sampler),
+            'collate_fn': data_collator,
+            'num_workers': self.args.dataloader_num_workers,
+            'pin_memory': self.args.dataloader_pin_memory,
+            'worker_init_fn': seed_worker,
+        }
+        if self.args.dataloader_num_workers > 0:
+            dataloader_params['persistent_workers'] = getattr(self.args, 'dataloader_persistent_workers', False)
+            dataloader_params['prefetch_factor'] = getattr(self.args, 'dataloader_prefetch_factor', None)
+        return self.accelerator.prepare(DataLoader(self.train_dataset, **dataloader_params))
+
     def _load_from_checkpoint(self, resume_from_checkpoint: str, model=None) -> None:
         if model is None:
             model = self.model
@@ -526,6 +708,58 @@ class SwiftMixin:
                 checkpoints_sorted[i], checkpoints_sorted[i + 1] = checkpoints_sorted[i + 1], checkpoints_sorted[i]
         return checkpoints_sorted
 
+    def training_step(self, model, inputs, *args, **kwargs):
+        if self._log_start_time is None:
+            # Exclude the time of preparing the training (e.g. starting the dataloader workers).
+            self._last_log_time = time.time()
+            self._log_start_time = time.perf_counter()
+            self._data_time = self._excluded_time = 0.
+        attention_mask = inputs.get('attention_mask')
+        if isinstance(attention_mask, torch.Tensor) and attention_mask.dim() == 2:
+            self._num_tokens = self._num_tokens + attention_mask.sum()
+        elif isinstance(inputs.get('input_ids'), torch.Tensor):
+            self._num_tokens = self._num_tokens + inputs['input_ids'].numel()
+        return super().training_step(model, inputs, *args, **kwargs)
+
+    def _get_flops_per_token(self) -> float:
+        if self._flops_per_token is None:
+            n_params, n_grads = get_n_params_grads(self.model)
+            # forward: 2N, backward: 2N (activations) + 2N_trainable (weights)
+            self._flops_per_token = 4 * sum(n_params) + 2 * sum(n_grads)
+        return self._flops_per_token
+
+    def _get_throughput_logs(self, num_steps: int) -> Dict[str, float]:
+        """The non-padding tokens per second, MFU and the dataloader/compute time per step since the last log."""
+        time_now = time.time()
+        elapse_time = time_now - self._last_log_time
+        self._last_log_time = time_now
+        # `item()` waits for the queued kernels, so the compute time is the time the device takes.
+        num_tokens = self._nested_gather(self._num_tokens).sum().item()
+        log_start_time, self._log_start_time = self._log_start_time, time.perf_counter()
+        compute_time = 0.
+        if log_start_time is not None:
+            compute_time = self._log_start_time - log_start_time - self._data_time - self._excluded_time
+        step_time = torch.tensor([self._data_time, compute_time], device=self.args.device)
+        data_time, compute_time = self._nested_gather(step_time[None]).mean(dim=0).tolist()
+        self._num_tokens = torch.tensor(0, device=self.args.device)
+        self._data_time = self._excluded_time = 0.
+        logs = {}
+        if num_tokens > 0 and elapse_time > 0:
+            tokens_per_second = num_tokens / elapse_time
+            logs['train_speed(tokens/s)'] = round(tokens_per_second, 2)
+            tokens_per_device = tokens_per_second / self.args.world_size
+            logs['train_speed_per_device(tokens/s)'] = round(tokens_per_device, 2)
+            peak_flops = get_device_peak_flops(self.args.device)
+            if peak_flops is not None:
+                logs['mfu'] = round(tokens_per_device * self._get_flops_per_token() / peak_flops, 4)
+        if num_steps > 0:
+            logs['data_time(s)'] = round(data_time / num_steps, 6)
+            logs['compute_time(s)'] = round(compute_time / num_steps, 6)
+            if hasattr(self.args, 'galore_config') and self.optimizer is not None:
+                # The svd of the projection updates, to tune `update_proj_gap`.
+                logs['galore_svd_time(s)'] = round(pop_galore_svd_time(self.optimizer) / num_steps, 6)
+        return logs
+
     def train(self, resume_from_checkpoint: Optional[Union[str, bool]] = None, *args, **kwargs) -> torch.Tensor:
         sft_args = getattr(self, 'sft_args', None)
         self._resume_only_model = getattr(sft_args, 'resume_only_model', False)
@@ -535,13 +769,21 @@ class SwiftMixin:
             resume_from_checkpoint = None
         if self._resume_from_checkpoint is not None and not is_sagemaker_mp_enabled() and not self.is_fsdp_enabled:
             self._load_from_checkpoint(self._resume_from_checkpoint)
-        res = super().train(resume_from_checkpoint, *args, **kwargs)
+        self._last_log_time = time.time()
+        self._log_start_time = None
+        try:
+            res = super().train(resume_from_checkpoint, *args, **kwargs)
+        finally:
+            self.wait_async_save()
         self._resume_from_checkpoint = None
         if self.max_memory != 0:
             self.perf['memory']['cuda'] = f'{self.max_memory:.2f}GiB'
         return res
 
     def _load_best_model(self):
+        if self._async_saver is not None:
+            self.wait_async_save()
+            self.accelerator.wait_for_everyone()
         # Compatible with transformers>=4.35 (deepspeed)
         try:
             model = self.model
@@ -603,15 +845,23 @@ class SwiftMixin:
             logs['learning_rate'] = self._get_learning_rate()
             if not is_torch_npu_available():
                 logs['memory(GiB)'] = round(self.get_max_cuda_memory(), 2)
-            import time
             time_now = time.time()
             elapse_time = time_now - self.start_time
             logs['train_speed(iter/s)'] = round(self.state.global_step / elapse_time, 6)
+            logs.update(self._get_throughput_logs(self.state.global_step - self._globalstep_last_logged))
             tr_loss -= tr_loss
             self._globalstep_last_logged = self.state.global_step
             self.store_flos()
             self.log(logs)
+        start_time = time.perf_counter()
         super()._maybe_log_save_evaluate(tr_loss, *args, **kwargs)
+        if self._async_saver is not None and self.control.should_training_stop:
+            # The checkpoints must be committed and rotated on all the processes before the end of the training
+            # loop, which loads the best model and deletes the checkpoints (`save_total_limit == 1`).
+            self.wait_async_save()
+            self.accelerator.wait_for_everyone()
+        # The evaluation and saving are not counted as the compute time.
+        self._excluded_time += time.perf_counter() - start_time
 
     def create_optimizer_and_scheduler(self, num_training_steps: int):
         if hasattr(self.args, 'galore_config'):
@@ -622,12 +872,29 @@ class SwiftMixin:
                 num_training_steps,
                 lr=self.args.learning_rate,
                 weight_decay=self.args.weight_decay)
+            if isinstance(optimizer, GaloreOptimizerWrapper):
+                self._register_galore_layerwise_hooks(optimizer)
             self.optimizer = optimizer
             self.lr_scheduler = lr_scheduler
         else:
             self.create_optimizer()
             self.create_scheduler(num_training_steps=num_training_steps, optimizer=self.optimizer)
 
+    def _register_galore_layerwise_hooks(self, optimizer: GaloreOptimizerWrapper) -> None:
+        # The gradients are used before the all-reduce of ddp/deepspeed and the unscaling of fp16.
+        if self.args.world_size > 1 or self.is_deepspeed_enabled or self.args.fp16:
+            logger.warning('The layer-wise stepping of GaLore (optim_per_parameter) does not support the distributed '
+                           'training and fp16, the parameters are stepped after the backward.')
+            return
+        if not hasattr(torch.Tensor, 'register_post_accumulate_grad_hook'):
+            logger.warning('The layer-wise stepping of GaLore (optim_per_parameter) requires torch>=2.1, '
+                           'the parameters are stepped after the backward.')
+            return
+        if self.args.max_grad_norm:
+            logger.warning('The gradients are freed in the backward with the layer-wise stepping of GaLore, '
+                           'max_grad_norm is ignored.')
+        optimizer.register_layerwise_hooks(lambda: self.accelerator.sync_gradients)
+
     def create_optimizer(self):
         opt_model = self.model
 
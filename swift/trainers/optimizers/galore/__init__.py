@@ -5,13 +5,13 @@ from typing import TYPE_CHECKING
 from swift.utils.import_utils import _LazyModule
 
 if TYPE_CHECKING:
-    from .utils import create_optimizer_and_scheduler, GaLoreConfig
+    from .utils import create_optimizer_and_scheduler, GaLoreConfig, GaloreOptimizerWrapper, pop_galore_svd_time
     from .adafactor import GaLoreAdafactor
     from .adamw8bit import GaLoreAdamW8bit
     from .adamw import GaLoreAdamW
 else:
     _import_structure = {
-        'utils': ['GaLoreConfig', 'create_optimizer_and_scheduler'],
+        'utils': ['GaLoreConfig', 'create_optimizer_and_scheduler', 'GaloreOptimizerWrapper', 'pop_galore_svd_time'],
         'adafactor': ['GaLoreAdafactor'],
         'adamw8bit': ['GaLoreAdamW8bit'],
         'adamw': ['GaLoreAdamW'],
@@ -6,7 +6,7 @@ import torch
 from torch.optim import Optimizer
 from transformers.utils.versions import require_version
 
-from .galore_projector import GaLoreProjector
+from .galore_projector import GaLoreProjector, get_projector_kwargs
 
 
 class Adafactor(Optimizer):
@@ -190,7 +190,8 @@ class Adafactor(Optimizer):
                             group['rank'],
                             update_proj_gap=group['update_proj_gap'],
                             scale=group['scale'],
-                            proj_type=group['proj_type'])
+                            proj_type=group['proj_type'],
+                            **get_projector_kwargs(group, p))
 
                     grad = state['projector'].project(grad, state['step'])
 
@@ -9,7 +9,7 @@ from torch import nn
 from torch.optim import Optimizer
 from transformers.utils.versions import require_version
 
-from .galore_projector import GaLoreProjector
+from .galore_projector import GaLoreProjector, get_projector_kwargs
 
 
 class AdamW(Optimizer):
@@ -88,7 +88,8 @@ class AdamW(Optimizer):
                             group['rank'],
                             update_proj_gap=group['update_proj_gap'],
                             scale=group['scale'],
-                            proj_type=group['proj_type'])
+                            proj_type=group['proj_type'],
+                            **get_projector_kwargs(group, p))
 
                     grad = state['projector'].project(grad, state['step'])
 
@@ -2,7 +2,7 @@
 import torch
 from bitsandbytes.optim.optimizer import Optimizer2State
 
-from .galore_projector import GaLoreProjector
+from .galore_projector import GaLoreProjector, get_projector_kwargs
 
 
 class AdamW8bit(Optimizer2State):
@@ -69,7 +69,8 @@ class AdamW8bit(Optimizer2State):
                             group['rank'],
                             update_proj_gap=group['update_proj_gap'],
                             scale=group['scale'],
-                            proj_type=group['proj_type'])
+                            proj_type=group['proj_type'],
+                            **get_projector_kwargs(group, p))
 
                     if 'weight_decay' in group and group['weight_decay'] > 0:
                         # ensure that the weight decay is not applied to the norm grad
@@ -1,48 +1,124 @@
 # code borrowed from https://github.com/jiaweizzhao/GaLore
 
+import time
+
 import torch
 
 
 class GaLoreProjector:
+    """
+    Args:
+        svd_type: `full`: the full svd, `randomized`: the randomized range finder, only the top `rank` singular vectors
+            are computed.
+        svd_niter: The number of the power iterations of the randomized svd.
+        svd_oversampling: The number of the extra random vectors of the randomized svd.
+        svd_warm_start: Start the randomized svd from the previous projection, instead of the random vectors only.
+        update_offset: The projection is updated when `(iter + update_offset) % update_proj_gap == 0`, the projectors
+            with different offsets do not update at the same step.
+
+    The time of the svd is recorded in `svd_time` (the last one), `total_svd_time`, `num_svd` and `pending_svd_time`
+    (not collected by `pop_pending_svd_time` yet). On cuda, the svd is timed by the cuda events without synchronizing
+    the device, and the time is added when the events have completed (at the latest in `pop_pending_svd_time`).
+    """
+    # The defaults of the projectors pickled before these attributes are added.
+    svd_type = 'full'
+    svd_niter = 2
+    svd_oversampling = 8
+    svd_warm_start = False
+    update_offset = 0
+    svd_time = 0.
+    total_svd_time = 0.
+    pending_svd_time = 0.
+    num_svd = 0
 
-    def __init__(self, rank, verbose=False, update_proj_gap=200, scale=1.0, proj_type='std'):
+    def __init__(self,
+                 rank,
+                 verbose=False,
+                 update_proj_gap=200,
+                 scale=1.0,
+                 proj_type='std',
+                 svd_type='full',
+                 svd_niter=2,
+                 svd_oversampling=8,
+                 svd_warm_start=False,
+                 update_offset=0):
         self.rank = rank
         self.verbose = verbose
         self.update_proj_gap = update_proj_gap
         self.scale = scale
         self.ortho_matrix = None
         self.proj_type = proj_type
+        if svd_type not in ('full', 'randomized'):
+            raise ValueError(f'svd_type should be full or randomized, got {svd_type}')
+        self.svd_type = svd_type
+        self.svd_niter = svd_niter
+        self.svd_oversampling = svd_oversampling
+        self.svd_warm_start = svd_warm_start
+        self.update_offset = update_offset
+        self._svd_events = []
+
+    def __getstate__(self):
+        # The cuda events cannot be pickled (e.g. the checkpoint of the optimizer).
+        self._update_svd_time(blocking=True)
+        state = self.__dict__.copy()
+        state.pop('_svd_events', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._svd_events = []
+
+    def _add_svd_time(self, svd_time):
+        self.svd_time = svd_time
+        self.total_svd_time += svd_time
+        self.pending_svd_time += svd_time
+
+    def _update_svd_time(self, blocking=False):
+        events = []
+        for start_event, end_event in self._svd_events:
+            if blocking:
+                end_event.synchronize()
+            elif not end_event.query():
+                events.append((start_event, end_event))
+                continue
+            self._add_svd_time(start_event.elapsed_time(end_event) / 1000)
+        self._svd_events = events
+
+    def pop_pending_svd_time(self):
+        self._update_svd_time(blocking=True)
+        pending_svd_time, self.pending_svd_time = self.pending_svd_time, 0.
+        return pending_svd_time
 
     def project(self, full_rank_grad, iter):
 
         if self.proj_type == 'std':
             if full_rank_grad.shape[0] >= full_rank_grad.shape[1]:
-                if self.ortho_matrix is None or iter % self.update_proj_gap == 0:
+                if self.ortho_matrix is None or (iter + self.update_offset) % self.update_proj_gap == 0:
                     self.ortho_matrix = self.get_orthogonal_matrix(full_rank_grad, self.rank, type='right')
                 low_rank_grad = torch.matmul(full_rank_grad, self.ortho_matrix.t())
             else:
-                if self.ortho_matrix is None or iter % self.update_proj_gap == 0:
+                if self.ortho_matrix is None or (iter + self.update_offset) % self.update_proj_gap == 0:
                     self.ortho_matrix = self.get_orthogonal_matrix(full_rank_grad, self.rank, type='left')
                 low_rank_grad = torch.matmul(self.ortho_matrix.t(), full_rank_grad)
         elif self.proj_type == 'reverse_std':
             if full_rank_grad.shape[0] >= full_rank_grad.shape[1]:
-                if self.ortho_matrix is None or iter % self.update_proj_gap == 0:
+                if self.ortho_matrix is None or (iter + self.update_offset) % self.update_proj_gap == 0:
                     self.ortho_matrix = self.get_orthogonal_matrix(full_rank_grad, self.rank, type='left')
                 low_rank_grad = torch.matmul(self.ortho_matrix.t(), full_rank_grad)
             else:
-                if self.ortho_matrix is None or iter % self.update_proj_gap == 0:
+                if self.ortho_matrix is None or (iter + self.update_offset) % self.update_proj_gap == 0:
                     self.ortho_matrix = self.get_orthogonal_matrix(full_rank_grad, self.rank, type='right')
                 low_rank_grad = torch.matmul(full_rank_grad, self.ortho_matrix.t())
         elif self.proj_type == 'right':
-            if self.ortho_matrix is None or iter % self.update_proj_gap == 0:
+            if self.ortho_matrix is None or (iter + self.update_offset) % self.update_proj_gap == 0:
                 self.ortho_matrix = self.get_orthogonal_matrix(full_rank_grad, self.rank, type='right')
             low_rank_grad = torch.matmul(full_rank_grad, self.ortho_matrix.t())
         elif self.proj_type == 'left':
-            if self.ortho_matrix is None or iter % self.update_proj_gap == 0:
+            if self.ortho_matrix is None or (iter + self.update_offset) % self.update_proj_gap == 0:
                 self.ortho_matrix = self.get_orthogonal_matrix(full_rank_grad, self.rank, type='left')
             low_rank_grad = torch.matmul(self.ortho_matrix.t(), full_rank_grad)
         elif self.proj_type == 'full':
-            if self.ortho_matrix is None or iter % self.update_proj_gap == 0:
+            if self.ortho_matrix is None or (iter + self.update_offset) % self.update_proj_gap == 0:
                 self.ortho_matrix = self.get_orthogonal_matrix(full_rank_grad, self.rank, type='full')
             low_rank_grad = torch.matmul(self.ortho_matrix[0].t(), full_rank_grad) @ self.ortho_matrix[1].t()
 
@@ -82,7 +158,24 @@ class GaLoreProjector:
             float_data = True
             matrix = module_params.data
 
-        U, s, Vh = torch.linalg.svd(matrix, full_matrices=False)
+        if matrix.is_cuda:
+            stream = torch.cuda.current_stream(matrix.device)
+            start_event = torch.cuda.Event(enable_timing=True)
+            start_event.record(stream)
+        else:
+            start_time = time.perf_counter()
+        if self.svd_type == 'randomized':
+            U, s, Vh = self.randomized_svd(matrix, rank, type)
+        else:
+            U, s, Vh = torch.linalg.svd(matrix, full_matrices=False)
+        if matrix.is_cuda:
+            end_event = torch.cuda.Event(enable_timing=True)
+            end_event.record(stream)
+            self._svd_events.append((start_event, end_event))
+            self._update_svd_time()
+        else:
+            self._add_svd_time(time.perf_counter() - start_time)
+        self.num_svd += 1
 
         # make the smaller matrix always to be orthogonal matrix
         if type == 'right':
@@ -107,3 +200,48 @@ class GaLoreProjector:
             return [A, B]
         else:
             raise ValueError('type should be left, right or full')
+
+    def randomized_svd(self, matrix, rank, type):
+        """The top singular vectors by the randomized range finder, see https://arxiv.org/abs/0909.4061
+
+        The side kept by the projection is sketched, so the previous projection can be used as the start vectors.
+        """
+        transpose = type == 'left'
+        if transpose:
+            matrix = matrix.t()
+        m, n = matrix.shape
+        k = min(rank + self.svd_oversampling, m, n)
+        omega = torch.randn(n, k, device=matrix.device, dtype=matrix.dtype)
+        if self.svd_warm_start and self.ortho_matrix is not None:
+            if type == 'left':
+                previous = self.ortho_matrix
+            elif type == 'right':
+                previous = self.ortho_matrix.t()
+            else:
+                previous = self.ortho_matrix[1].t()
+            previous = previous[:, :k]
+            omega[:, :previous.shape[1]] = previous.to(omega.device, omega.dtype)
+        Q = torch.linalg.qr(matrix @ omega).Q
+        for _ in range(self.svd_niter):
+            Q = torch.linalg.qr(matrix.t() @ Q).Q
+            Q = torch.linalg.qr(matrix @ Q).Q
+        U, s, Vh = torch.linalg.svd(Q.t() @ matrix, full_matrices=False)
+        U = Q @ U
+        if transpose:
+            return Vh.t(), s, U.t()
+        return U, s, Vh
+
+
+def get_projector_kwargs(group, param):
+    """The kwargs of the `GaLoreProjector` of the param, from the param group.
+
+    With `stagger_update`, the `update_offset` of the projectors is spread over `update_proj_gap` in the order of the
+    params. `stagger_index` / `num_stagger` of the group give the position of its params among all the GaLore params
+    when the params are split into groups (e.g. `optim_per_parameter`).
+    """
+    kwargs = {key: group[key] for key in ('svd_type', 'svd_niter', 'svd_warm_start') if key in group}
+    if group.get('stagger_update'):
+        index = next(i for i, p in enumerate(group['params']) if p is param) + group.get('stagger_index', 0)
+        num_stagger = group.get('num_stagger', len(group['params']))
+        kwargs['update_offset'] = index * group['update_proj_gap'] // num_stagger
+    return kwargs
@@ -1,7 +1,7 @@
 # Copyright (c) Alibaba, Inc. and its affiliates.
 import importlib
 from dataclasses import dataclass
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import torch
 from torch import nn
@@ -34,7 +34,13 @@ class GaLoreConfig:
         proj_type(`str`) The project type of Galore, valid values are `std`,
             `reverse_std`, `right`, `left`, `full`
         galore_scale(float): the scale of gradient
-        optim_per_parameter(bool): Gives one optimizer per parameter
+        optim_per_parameter(bool): Gives one optimizer per parameter, which can step each parameter in the backward
+            (see `GaloreOptimizerWrapper.register_layerwise_hooks`)
+        svd_type(str): The svd of the projection update, `full` or `randomized` (only the top `rank` singular vectors)
+        svd_niter(int): The number of the power iterations of the randomized svd
+        svd_warm_start(bool): Start the randomized svd from the previous projection
+        stagger_update(bool): Spread the projection updates of the weights over `update_proj_gap` steps, instead of
+            updating all the weights at the same step
     """
     rank: int = 128
     target_modules: Union[str, List[str]] = None
@@ -42,6 +48,10 @@ class GaLoreConfig:
     galore_scale: float = 1.0
     proj_type: str = 'std'
     optim_per_parameter: bool = False
+    svd_type: str = 'full'
+    svd_niter: int = 2
+    svd_warm_start: bool = False
+    stagger_update: bool = False
     quantize: bool = False
     proj_quant: bool = False
     proj_bits: int = 4
@@ -55,6 +65,7 @@ class GaloreOptimizerWrapper(Optimizer):
 
     def __init__(self, optimizers: Dict[Any, Optimizer]):
         self.optimizers = optimizers
+        self.layerwise = False
         super().__init__([torch.tensor([1., 2., 3.])], {'lr': 1.})
 
     def zero_grad(self, *args, **kwargs) -> None:
@@ -62,20 +73,64 @@ class GaloreOptimizerWrapper(Optimizer):
             optim.zero_grad(*args, **kwargs)
 
     def step(self, *args, **kwargs) -> None:
-        for optim in self.optimizers.values():
-            optim.step(*args, **kwargs)
+        for param, optim in self.optimizers.items():
+            if self.layerwise:
+                # The parameters have been stepped in the backward, except the gradients accumulated while
+                # `sync_gradients` is False (e.g. it is set after the backward of the last partial accumulation window).
+                if param.grad is None:
+                    continue
+                optim.step(*args, **kwargs)
+                optim.zero_grad(set_to_none=True)
+            else:
+                optim.step(*args, **kwargs)
+
+    def register_layerwise_hooks(self, sync_gradients: Optional[Callable[[], bool]] = None) -> None:
+        """Step each parameter as soon as its gradient is accumulated in the backward, and free the gradient,
+        so the full-rank gradients of all the parameters are never alive at the same time.
+
+        Args:
+            sync_gradients: Whether the current backward is the last one of the gradient accumulation,
+                the gradients are accumulated as usual until then.
+        """
+
+        def _hook(param: torch.Tensor) -> None:
+            if param.grad is None or sync_gradients is not None and not sync_gradients():
+                return
+            optim = self.optimizers[param]
+            optim.step()
+            optim.zero_grad(set_to_none=True)
+
+        for param in self.optimizers.keys():
+            param.register_post_accumulate_grad_hook(_hook)
+        self.layerwise = True
+
+    def state_dict(self) -> Dict[str, Any]:
+        return {'optimizers': [optim.state_dict() for optim in self.optimizers.values()]}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        for optim, optim_state_dict in zip(self.optimizers.values(), state_dict['optimizers']):
+            optim.load_state_dict(optim_state_dict)
 
 
 class GaloreSchedulerWrapper(LRScheduler):
 
     def __init__(self, lr_schedulers: Dict[Any, LRScheduler]):
         self.lr_schedulers = lr_schedulers
+        self._last_lr = next(iter(lr_schedulers.values())).get_last_lr()
 
     def step(self, *args, **kwargs) -> None:
         for lr_scheduler in self.lr_schedulers.values():
             lr_scheduler.step(*args, **kwargs)
         self._last_lr = lr_scheduler.get_last_lr()
 
+    def state_dict(self) -> Dict[str, Any]:
+        return {'lr_schedulers': [lr_scheduler.state_dict() for lr_scheduler in self.lr_schedulers.values()]}
+
+    def load_state_dict(self, state_dict: Dict[str, Any]) -> None:
+        for lr_scheduler, lr_scheduler_state_dict in zip(self.lr_schedulers.values(), state_dict['lr_schedulers']):
+            lr_scheduler.load_state_dict(lr_scheduler_state_dict)
+        self._last_lr = lr_scheduler.get_last_lr()
+
 
 def create_optimizer_and_scheduler(model: nn.Module, args: TrainingArguments, config: GaLoreConfig, max_steps,
                                    **defaults):
@@ -99,6 +154,12 @@ def create_optimizer_and_scheduler(model: nn.Module, args: TrainingArguments, co
         'proj_type': config.proj_type,
         **defaults
     }
+    if config.svd_type != 'full':
+        galore_defaults['svd_type'] = config.svd_type
+        galore_defaults['svd_niter'] = config.svd_niter
+        galore_defaults['svd_warm_start'] = config.svd_warm_start
+    if config.stagger_update:
+        galore_defaults['stagger_update'] = True
     if config.quantize:
         galore_defaults['quant'] = config.proj_quant
         galore_defaults['quant_n_bit'] = config.proj_bits
@@ -111,11 +172,14 @@ def create_optimizer_and_scheduler(model: nn.Module, args: TrainingArguments, co
     if config.optim_per_parameter and not config.quantize:
         # q-galore does not support optim_per_parameter
         optimizer_dict = {}
-        galore_defaults['update_proj_gap'] = galore_defaults['update_proj_gap'] * 2
         for p in model.parameters():
             if p.requires_grad:
                 if id(p) in id_galore_params:
-                    optimizer_dict[p] = optim_cls([{'params': [p], **galore_defaults}], **optim_kwargs)
+                    group = {'params': [p], **galore_defaults}
+                    if config.stagger_update:
+                        group['stagger_index'] = id_galore_params.index(id(p))
+                        group['num_stagger'] = len(id_galore_params)
+                    optimizer_dict[p] = optim_cls([group], **optim_kwargs)
                 else:
                     optimizer_dict[p] = optim_cls([{'params': [p], **defaults}], **optim_kwargs)
 
@@ -126,8 +190,8 @@ def create_optimizer_and_scheduler(model: nn.Module, args: TrainingArguments, co
                 scheduler_dict[p] = get_scheduler(
                     optimizer=optimizer_dict[p],
                     name=args.lr_scheduler_type,
-                    num_training_steps=max_steps * 2,
-                    num_warmup_steps=args.warmup_steps * 2,
+                    num_training_steps=max_steps,
+                    num_warmup_steps=args.warmup_steps,
                     scheduler_specific_kwargs=args.lr_scheduler_kwargs,
                 )
 
@@ -167,6 +231,22 @@ def create_optimizer_and_scheduler(model: nn.Module, args: TrainingArguments, co
         return optim, scheduler
 
 
+def pop_galore_svd_time(optimizer: Optimizer) -> float:
+    """The time of the svd of the GaLore projectors since the last call."""
+    optimizer = getattr(optimizer, 'optimizer', optimizer)  # AcceleratedOptimizer
+    if isinstance(optimizer, GaloreOptimizerWrapper):
+        optimizers = list(optimizer.optimizers.values())
+    else:
+        optimizers = [optimizer]
+    svd_time = 0.
+    for optim in optimizers:
+        for state in optim.state.values():
+            projector = state.get('projector')
+            if projector is not None and hasattr(projector, 'pop_pending_svd_time'):
+                svd_time += projector.pop_pending_svd_time()
+    return svd_time
+
+
 def get_optimizer(args: TrainingArguments, config: GaLoreConfig) -> Tuple[Any, Any]:
     # parse args.optim_args
     optim_args = {}
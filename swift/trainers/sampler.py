@@ -0,0 +1,109 @@
+# Copyright (c) Alibaba, Inc. and its affiliates.
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+from torch.utils.data import BatchSampler, Sampler
+
+from swift.utils import get_logger
+
+logger = get_logger()
+
+
+class LengthGroupedSampler(Sampler):
+    """Group the samples of similar lengths into the same batch to reduce the padding.
+
+    The samples are sorted by length (the ties are shuffled per epoch) and cut into batches, either of `batch_size`
+    samples, or of at most `max_tokens` tokens after padding. The order of the batches is shuffled per epoch
+    with the same seed on all processes, so that the batches can be sharded by accelerate (DDP/DeepSpeed).
+    The longest batch comes first to expose the OOM error as early as possible.
+    """
+
+    def __init__(self,
+                 lengths: np.ndarray,
+                 batch_size: int = 1,
+                 max_tokens: Optional[int] = None,
+                 *,
+                 shuffle: bool = True,
+                 seed: int = 42,
+                 drop_last: bool = False) -> None:
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        # The batch boundaries only depend on the sorted lengths, so the number of batches is fixed.
+        lengths = np.sort(self.lengths)[::-1]
+        batch_ranges = self._split_batches(lengths)
+        self.num_batches = len(batch_ranges)
+        padded_tokens = sum(int(lengths[start]) * (end - start) for start, end in batch_ranges)
+        if padded_tokens > 0:
+            logger.info(f'LengthGroupedSampler: num_batches: {self.num_batches}, '
+                        f'padding_ratio: {1 - lengths.sum() / padded_tokens:.4f}')
+
+    def _split_batches(self, lengths: np.ndarray) -> List[Tuple[int, int]]:
+        """lengths: The lengths in descending order. return: [start, end) of each batch."""
+        if self.max_tokens is None:
+            starts = range(0, len(lengths), self.batch_size)
+            res = [(start, min(start + self.batch_size, len(lengths))) for start in starts]
+            if self.drop_last and len(res) > 0 and res[-1][1] - res[-1][0] < self.batch_size:
+                res.pop()
+            return res
+        res = []
+        start = 0
+        while start < len(lengths):
+            # The first sample is the longest one in the batch.
+            end = start + max(self.max_tokens // max(int(lengths[start]), 1), 1)
+            end = min(end, len(lengths))
+            res.append((start, end))
+            start = end
+        return res
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def get_batches(self) -> List[List[int]]:
+        rng = np.random.default_rng(self.seed + self.epoch)
+        if self.shuffle:
+            perm = rng.permutation(len(self.lengths))
+        else:
+            perm = np.arange(len(self.lengths))
+        # stable sort in descending order of length
+        idx_list = perm[np.argsort(-self.lengths[perm], kind='stable')]
+        batches = [idx_list[start:end].tolist() for start, end in self._split_batches(self.lengths[idx_list])]
+        last_batch = []
+        if self.max_tokens is None and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            # Keep the incomplete batch at the end, so that the batches stay aligned with the DataLoader.
+            last_batch = batches.pop()
+        if self.shuffle and len(batches) > 1:
+            order = rng.permutation(len(batches) - 1) + 1
+            batches = [batches[0]] + [batches[i] for i in order]
+        if len(last_batch) > 0:
+            batches.append(last_batch)
+        return batches
+
+    def __iter__(self) -> Iterator[int]:
+        for batch in self.get_batches():
+            yield from batch
+
+    def __len__(self) -> int:
+        if self.max_tokens is None and self.drop_last:
+            return self.num_batches * self.batch_size
+        return len(self.lengths)
+
+
+class MaxTokensBatchSampler(BatchSampler):
+    """The batch sampler with a dynamic batch size, sized by `LengthGroupedSampler.max_tokens`."""
+
+    def __init__(self, sampler: LengthGroupedSampler) -> None:
+        assert sampler.max_tokens is not None
+        self.sampler = sampler
+        self.batch_size = None
+        self.drop_last = False
+
+    def __iter__(self) -> Iterator[List[int]]:
+        yield from self.sampler.get_batches()
+
+    def __len__(self) -> int:
+        return self.sampler.num_batches
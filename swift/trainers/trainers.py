@@ -16,10 +16,13 @@ from transformers.models.auto.modeling_auto import MODEL_FOR_CAUSAL_LM_MAPPING_N
 from transformers.utils import is_peft_available
 
 from swift.torchacc_utils import ta_eval_dataloader, ta_test_dataloader, ta_train_dataloader, ta_trim_graph
-from swift.utils import use_torchacc
+from swift.utils import get_logger, use_torchacc
 from .callback import DefaultFlowCallbackNew, PrinterCallbackNew, ProgressCallbackNew
+from .loss import chunked_causal_lm_loss, get_chunked_loss_lm_head, skip_lm_head
 from .mixin import PushToMsHubMixin, SwiftMixin
 
+logger = get_logger()
+
 
 class Trainer(PushToMsHubMixin, SwiftMixin, HfTrainer):
     pass
@@ -176,6 +179,20 @@ class Seq2SeqTrainer(PushToMsHubMixin, SwiftMixin, HfSeq2SeqTrainer):
         if self.label_smoother is not None and 'labels' in inputs:
             labels = inputs.pop('labels')
 
+        attention_mask = inputs.get('attention_mask')
+        if model.training and attention_mask is not None and attention_mask.dim() == 2:
+            padding_ratio = 1 - attention_mask.sum() / attention_mask.numel()
+            if 'padding_ratio' not in self._custom_metrics:
+                self._custom_metrics['padding_ratio'] = self._acc
+            self._custom_metrics['padding_ratio'] = (
+                self._custom_metrics['padding_ratio'] + padding_ratio / self.args.gradient_accumulation_steps)
+
+        lm_head = self._get_chunked_loss_lm_head(model) if model.training and not return_outputs else None
+        if lm_head is not None:
+            loss = self._compute_chunked_loss(model, inputs, lm_head, labels, loss_scale)
+            if loss is not None:
+                return loss
+
         outputs = model(**inputs)
         if loss_scale is not None:
             outputs['loss'] = self.compute_scaled_loss(labels, outputs.logits, loss_scale)
@@ -211,7 +228,57 @@ class Seq2SeqTrainer(PushToMsHubMixin, SwiftMixin, HfSeq2SeqTrainer):
         else:
             preds = outputs.logits.argmax(dim=2)[..., :-1]
             labels = labels[..., 1:]
+        self._compute_acc(model, preds, labels)
+        return (loss, outputs) if return_outputs else loss
+
+    def _get_chunked_loss_lm_head(self, model) -> Optional[nn.Module]:
+        loss_chunk_size = getattr(self.args, 'loss_chunk_size', 0)
+        if not loss_chunk_size or self.is_encoder_decoder:
+            return None
+        if not hasattr(self, '_chunked_loss_lm_head'):
+            lm_head = None
+            if is_deepspeed_zero3_enabled() or self.is_fsdp_enabled or use_torchacc():
+                logger.warning('loss_chunk_size is not supported with zero3, fsdp or torchacc, ignored.')
+            else:
+                lm_head = get_chunked_loss_lm_head(unwrap_model(model))
+                if lm_head is None:
+                    logger.warning('loss_chunk_size is not supported by the model (no lm_head or the logits are '
+                                   'transformed after the lm_head), ignored.')
+            self._chunked_loss_lm_head = lm_head
+        return self._chunked_loss_lm_head
+
+    def _compute_chunked_loss(self, model, inputs, lm_head: nn.Module, labels: Optional[Tensor],
+                              loss_scale: Optional[Tensor]) -> Optional[Tensor]:
+        """Compute the loss and the token accuracy from the hidden states and the lm_head in chunks of tokens,
+        the full [bs, seq, vocab] logits are never materialized.
+
+        return: None if the hidden states are not aligned with the labels (e.g. sequence first), the chunked loss is
+            disabled and the caller falls back to the full logits.
+        """
+        if labels is None:
+            labels = inputs['labels']
+        with skip_lm_head(lm_head) as (lm_head_forward, lm_head_inputs):
+            model(**{k: v for k, v in inputs.items() if k != 'labels'})
+        hidden_states = lm_head_inputs.get('hidden_states')
+        if hidden_states is None or hidden_states.shape[:2] != labels.shape:
+            logger.warning('The input of the lm_head is not [batch_size, seq_len, hidden_size], '
+                           'loss_chunk_size is ignored.')
+            self._chunked_loss_lm_head = None
+            return None
+        loss, preds = chunked_causal_lm_loss(
+            lm_head_forward,
+            hidden_states,
+            labels,
+            loss_scale,
+            label_smoothing=self.args.label_smoothing_factor,
+            chunk_size=self.args.loss_chunk_size)
+        if self.sequence_parallel_size > 1:
+            from swift.trainers.xtuner import reduce_xtuner_sequence_parallel_loss
+            loss = reduce_xtuner_sequence_parallel_loss(loss, labels)
+        self._compute_acc(model, preds, labels[..., 1:].to(preds.device))
+        return loss
 
+    def _compute_acc(self, model, preds: Tensor, labels: Tensor) -> None:
         masks = labels != -100
         acc_strategy = getattr(self.args, 'acc_strategy', 'token')
         acc: Optional[Tensor] = None
@@ -236,7 +303,6 @@ class Seq2SeqTrainer(PushToMsHubMixin, SwiftMixin, HfSeq2SeqTrainer):
                 if 'acc' not in self._custom_metrics:
                     self._custom_metrics['acc'] = self._acc
                 self._custom_metrics['acc'] = self._custom_metrics['acc'] + acc / self.args.gradient_accumulation_steps
-        return (loss, outputs) if return_outputs else loss
 
     def get_train_dataloader(self):
         if self.sequence_parallel_size > 1:
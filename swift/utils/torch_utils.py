@@ -211,3 +211,36 @@ def broadcast_string(string: Optional[str], buffer_size: int = 1024) -> str:
 def time_synchronize() -> float:
     torch.cuda.synchronize()
     return time.perf_counter()  # second
+
+
+# The dense bf16/fp16 tensor core peak FLOPS of the devices, the first matched name is used.
+_DEVICE_PEAK_FLOPS = [
+    ('H100 PCIe', 756e12),
+    ('H100', 989e12),
+    ('H800', 989e12),
+    ('H20', 148e12),
+    ('A100', 312e12),
+    ('A800', 312e12),
+    ('A30', 165e12),
+    ('A10', 125e12),
+    ('L40S', 362e12),
+    ('L40', 181e12),
+    ('L20', 119.5e12),
+    ('L4', 121e12),
+    ('RTX A6000', 154.8e12),
+    ('4090', 165.2e12),
+    ('3090', 71e12),
+    ('V100', 125e12),
+    ('T4', 65e12),
+]
+
+
+def get_device_peak_flops(device: Optional[torch.device] = None) -> Optional[float]:
+    """The peak FLOPS of the cuda device (used to estimate the MFU), None if unknown."""
+    if not torch.cuda.is_available():
+        return None
+    device_name = torch.cuda.get_device_name(device)
+    for name, peak_flops in _DEVICE_PEAK_FLOPS:
+        if name in device_name:
+            return peak_flops
+    return None
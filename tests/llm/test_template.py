@@ -13,6 +13,31 @@ from swift.llm import (ModelType, get_default_template_type, get_model_tokenizer
 SKPT_TEST = True
 
 
+def _get_local_chatml_tokenizer():
+    """A local byte-level BPE tokenizer with the special tokens of chatml, so no model is downloaded."""
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=400,
+        special_tokens=['<|endoftext|>', '<|im_start|>', '<|im_end|>'],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    corpus = ['system\nYou are a helpful assistant.\nuser\nassistant\n浙江的省会在哪？浙江的省会是杭州。你好，你是谁？'] * 10
+    tokenizer.train_from_iterator(corpus, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token='<|im_end|>', pad_token='<|endoftext|>')
+
+
+def _get_examples(n: int):
+    return [{
+        'system': None if i % 3 == 0 else f'system{i % 2}',
+        'query': f'浙江的省会在哪？{i}' * (i % 17 + 1),
+        'response': f'浙江的省会是杭州。{i}' * (i % 13 + 1),
+        'history': [(f'你好，你是谁？{i}', '我是来自达摩院的大规模语言模型，我叫通义千问。')] * (i % 3)
+    } for i in range(n)]
+
+
 class TestTemplate(unittest.TestCase):
 
     def test_template(self):
@@ -533,6 +558,142 @@ Assistant:""")
         print(f'official response: {response}')
         self.assertTrue(input_ids_swift == input_ids_official)
 
+    def test_packed_data_collator(self):
+        from types import SimpleNamespace
+        from swift.llm import TemplateType
+        template = get_template(TemplateType.qwen, _get_local_chatml_tokenizer())
+        batch = [{'input_ids': [1, 2, 3, 4, 5], 'labels': [1, 2, 3, 4, 5], 'position_ids': [0, 1, 2, 0, 1]}]
+        # without flash attention, same as the unpacked samples (contiguous positions, the attention_mask is kept).
+        res = template.data_collator(batch)
+        self.assertTrue('position_ids' not in res and res['attention_mask'].tolist() == [[1] * 5])
+        template.model = SimpleNamespace(config=SimpleNamespace(_attn_implementation='flash_attention_2'))
+        res = template.data_collator(batch)
+        self.assertTrue(res['position_ids'].tolist() == [[0, 1, 2, 0, 1]] and 'attention_mask' not in res)
+
+    def test_fragment_cache(self):
+        from swift.llm import TemplateType
+        template = get_template(TemplateType.qwen, _get_local_chatml_tokenizer())
+        fragment_cache = template._fragment_cache.copy()
+        self.assertTrue('assistant\n' in fragment_cache and 'system\nYou are a helpful assistant.' in fragment_cache)
+        self.assertTrue('user\n' in template._fragment_prefixes)
+        examples = _get_examples(200)
+        res = [template.encode(example)[0] for example in examples]
+        self.assertTrue(template._fragment_cache == fragment_cache)  # the text of the examples is not cached
+        template._fragment_pattern = None
+        self.assertTrue(res == [template.encode(example)[0] for example in examples])
+
+    @unittest.skipIf(SKPT_TEST, 'To avoid excessive testing time caused by downloading models and '
+                     'to prevent OOM (Out of Memory) errors.')
+    def test_fragment_cache_benchmark(self):
+        import time
+        model_types = [ModelType.qwen2_7b_instruct, ModelType.llama3_8b_instruct, ModelType.glm4_9b_chat]
+        examples = _get_examples(2000)  # distinct rows, only the template fragments are shared
+        for model_type in model_types:
+            _, tokenizer = get_model_tokenizer(model_type, load_model=False)
+            template_type = get_default_template_type(model_type)
+            template = get_template(template_type, tokenizer)
+            fragment_pattern = template._fragment_pattern
+            time_list = []
+            for pattern in [None, fragment_pattern]:
+                template._fragment_pattern = pattern
+                t_start = time.perf_counter()
+                res = [template.encode(example)[0] for example in examples]
+                time_list.append(time.perf_counter() - t_start)
+                if pattern is None:
+                    res_no_cache = res
+                else:
+                    self.assertTrue(res == res_no_cache)
+            print(f'model_type: {model_type}, fragment_pattern: {fragment_pattern}, '
+                  f'time(no cache): {time_list[0]:.3f}s, time(cache): {time_list[1]:.3f}s, '
+                  f'speedup: {time_list[0] / time_list[1]:.2f}x')
+
+    def test_encode_batch(self):
+        import time
+        from unittest import mock
+        from swift.llm import TemplateType
+
+        tokenizer = _get_local_chatml_tokenizer()
+        template = get_template(TemplateType.qwen, tokenizer)
+        self.assertTrue(template._fragment_pattern is not None)
+        examples = _get_examples(2000)
+        t_start = time.perf_counter()
+        res = [template.encode(example) for example in examples]
+        t_encode = time.perf_counter() - t_start
+        tokenizer_call = type(tokenizer).__call__
+        with mock.patch.object(type(tokenizer), '__call__', autospec=True, side_effect=tokenizer_call) as mock_call:
+            t_start = time.perf_counter()
+            res2 = template.encode_batch(examples)
+            t_encode_batch = time.perf_counter() - t_start
+        print(f'time(encode): {t_encode:.3f}s, time(encode_batch): {t_encode_batch:.3f}s')
+        self.assertTrue(res == res2)
+        self.assertTrue(mock_call.call_count == 1)
+        # inference
+        examples = [{**example, 'response': None} for example in examples[:100]]
+        res = [template.encode(example) for example in examples]
+        template._round_cache.clear()
+        with mock.patch.object(type(tokenizer), '__call__', autospec=True, side_effect=tokenizer_call) as mock_call:
+            res2 = template.encode_batch(examples)
+        self.assertTrue(res == res2)
+        self.assertTrue(mock_call.call_count == 1)
+
+    @unittest.skipIf(SKPT_TEST, 'To avoid excessive testing time caused by downloading models and '
+                     'to prevent OOM (Out of Memory) errors.')
+    def test_round_cache(self):
+        from swift.llm import limit_history_length
+        _, tokenizer = get_model_tokenizer(ModelType.qwen2_7b_instruct, load_model=False)
+        template = get_template(get_default_template_type(ModelType.qwen2_7b_instruct), tokenizer)
+        history = []
+        for i in range(20):
+            query = f'浙江的省会在哪？{i}' * (i % 7 + 1)
+            inputs = template.encode({'query': query, 'history': history})[0]
+            template.round_cache_size = 0
+            self.assertTrue(inputs == template.encode({'query': query, 'history': history})[0])
+            template.round_cache_size = 1024
+            old_history, new_history = limit_history_length(template, query, history, 200)
+            self.assertTrue(old_history + new_history == history)
+            self.assertTrue(len(template.encode({'query': query, 'history': new_history})[0]['input_ids']) <= 200)
+            history.append([query, f'浙江的省会是杭州。{i}' * (i % 5 + 1)])
+        self.assertTrue(len(template._round_cache) > 0)
+
+    @unittest.skipIf(SKPT_TEST, 'To avoid excessive testing time caused by downloading models and '
+                     'to prevent OOM (Out of Memory) errors.')
+    def test_incremental_detokenizer(self):
+        from swift.llm import IncrementalDetokenizer, StopWordsMatcher
+        _, tokenizer = get_model_tokenizer(ModelType.qwen2_7b_instruct, load_model=False)
+        input_ids = tokenizer.encode('浙江的省会是杭州。 The capital of Zhejiang is Hangzhou. 😀' * 10)
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        for i in range(1, len(input_ids) + 1):
+            text = detokenizer.decode(input_ids[:i], i == len(input_ids))
+            self.assertTrue(tokenizer.decode(input_ids[:i]).startswith(text))
+        self.assertTrue(text == tokenizer.decode(input_ids))
+        for stop_word in ['Hangzhou', tokenizer.encode(' of')]:
+            matcher = StopWordsMatcher(tokenizer, [stop_word])
+            idx = next(i for i, token in enumerate(input_ids) if matcher.update([token]))
+            if isinstance(stop_word, str):
+                self.assertTrue(stop_word in tokenizer.decode(input_ids[:idx + 1]))
+                self.assertTrue(stop_word not in tokenizer.decode(input_ids[:idx]))
+            else:
+                self.assertTrue(input_ids[idx + 1 - len(stop_word):idx + 1] == stop_word)
+
+    @unittest.skipIf(SKPT_TEST, 'To avoid excessive testing time caused by downloading models and '
+                     'to prevent OOM (Out of Memory) errors.')
+    def test_stop_words_criteria_speculative(self):
+        from swift.llm.utils.template import StopWordsCriteria
+        _, tokenizer = get_model_tokenizer(ModelType.qwen2_7b_instruct, load_model=False)
+        prompt_ids = tokenizer.encode('Where is the capital of Zhejiang?')
+        generate_ids = tokenizer.encode('The capital of Zhejiang is Hangzhou. The capital of Jiangsu is Nanjing.')
+        stop_idx = next(i for i in range(len(generate_ids)) if 'Hangzhou' in tokenizer.decode(generate_ids[:i + 1]))
+        criteria = StopWordsCriteria(tokenizer, ['Hangzhou'], start_idx=len(prompt_ids))
+        num_tokens = 0
+        while True:
+            # The candidate tokens (with a wrong token) are rejected after the stop word.
+            candidate_ids = generate_ids[:num_tokens + 3] + tokenizer.encode(' Hangzhou')
+            criteria(torch.tensor([prompt_ids + candidate_ids]), None)
+            num_tokens += 2
+            if criteria(torch.tensor([prompt_ids + generate_ids[:num_tokens]]), None):
+                break
+        self.assertTrue(num_tokens - 2 <= stop_idx < num_tokens)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,11 +1,34 @@
 import os
 import unittest
+from functools import partial
 
 from swift.llm import (ModelType, get_default_template_type, get_model_tokenizer, get_template, inference,
                        inference_stream, limit_history_length, print_example)
 from swift.utils import lower_bound, seed_everything
 
 
+def _get_tiny_llama_template():
+    """A random tiny llama with the local chatml tokenizer (see `test_template.py`), so no model is downloaded."""
+    import torch
+    from transformers import GenerationConfig, LlamaConfig, LlamaForCausalLM
+    from swift.llm import TemplateType
+    from .test_template import _get_local_chatml_tokenizer
+    tokenizer = _get_local_chatml_tokenizer()
+    torch.manual_seed(42)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        initializer_range=0.5)
+    model = LlamaForCausalLM(config).eval()
+    model.generation_config = GenerationConfig(
+        max_new_tokens=12, do_sample=False, eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id)
+    return model, get_template(TemplateType.qwen, tokenizer, model=model)
+
+
 class TestLlmUtils(unittest.TestCase):
 
     def test_count_startswith(self):
@@ -82,6 +105,503 @@ class TestLlmUtils(unittest.TestCase):
                                                         600)
         self.assertTrue(len(old_history) == 3 and len(new_history) == 2)
 
+    def test_dataset_map_mp(self):
+        from datasets import Dataset as HfDataset
+        from swift.llm import dataset_map
+
+        def _encode(example):
+            if example['query'].startswith('skip'):
+                return {}, {}
+            input_ids = [ord(c) for c in example['query']]
+            return {'input_ids': input_ids, 'labels': input_ids, 'loss_scale': [1.] * len(input_ids)}, {}
+
+        dataset = HfDataset.from_dict({'query': [f'skip{i}' if i % 7 == 0 else f'query{i}' for i in range(100)]})
+        res = dataset_map(dataset, _encode, 1)
+        res2 = dataset_map(dataset, _encode, 4)
+        self.assertTrue(len(res) == len(res2) == 85)
+        for k in ['input_ids', 'labels', 'loss_scale']:
+            self.assertTrue(res[k] == res2[k])
+
+    def test_packed_dataset(self):
+        from datasets import Dataset as HfDataset
+        from swift.llm import PackedLLMDataset, dataset_map
+
+        def _encode(example):
+            input_ids = [ord(c) for c in example['query']]
+            return {'input_ids': input_ids, 'labels': input_ids}, {}
+
+        queries = [f'query{i}' * (i % 5 + 1) for i in range(50)]
+        dataset = HfDataset.from_dict({'query': queries})
+        res = dataset_map(dataset, _encode, 2)
+        self.assertTrue(isinstance(res, PackedLLMDataset))
+        self.assertTrue(res['input_ids'] == [_encode({'query': q})[0]['input_ids'] for q in queries])
+        subset = res.select([40, 3, 3, 17]).select([3, 0])
+        self.assertTrue([d['labels'] for d in subset] == [res[17]['labels'], res[40]['labels']])
+        self.assertTrue(subset.get_lengths().tolist() == [len(queries[17]), len(queries[40])])
+        batch = subset.__getitems__([1, 0])
+        self.assertTrue([d['input_ids'].tolist() for d in batch] == [res[40]['input_ids'], res[17]['input_ids']])
+        with self.assertRaises(IndexError):
+            subset[2]
+
+    def test_pack_rows_dtype(self):
+        from swift.llm.utils.utils import _pack_rows, _unpack_block
+
+        data = [({'input_ids': [1, 2], 'loss_scale': [1, 2]}, {}), ({'input_ids': [3], 'loss_scale': [2.5, 0.5]}, {})]
+        block = _pack_rows(data)
+        self.assertTrue(block['input_ids'][0].dtype.kind == 'i' and block['loss_scale'][0].dtype.kind == 'f')
+        self.assertTrue([d['loss_scale'] for d, _ in _unpack_block(block)] == [[1., 2.], [2.5, 0.5]])
+        self.assertTrue(_pack_rows([({'input_ids': [1, 'a']}, {})]) is None)
+
+    def test_packing(self):
+        from types import SimpleNamespace
+        from datasets import Dataset as HfDataset
+        from swift.llm.utils.utils import ConstantLengthDataset
+
+        def _encode(example):
+            input_ids = list(range(1, len(example['query']) + 1))
+            return {'input_ids': input_ids, 'labels': input_ids}, {}
+
+        template = SimpleNamespace(
+            encode=_encode,
+            encode_batch=lambda rows: [_encode(row) for row in rows],
+            tokenizer=SimpleNamespace(eos_token_id=0))
+        queries = ['a' * (i % 13 + 1) for i in range(100)]
+        dataset = HfDataset.from_dict({'query': queries})
+        res = ConstantLengthDataset.get_packed_dataset(template, dataset, 16, num_proc=2)
+        lengths = res.get_lengths()
+        self.assertTrue(lengths.max() <= 16 and lengths.sum() == sum(len(q) for q in queries))
+        self.assertTrue(len(res) == (lengths.sum() + 15) // 16)
+        for d in res:
+            # position_ids restart at the beginning of each sample
+            self.assertTrue(d['position_ids'] == [i - 1 for i in d['input_ids']])
+        res2 = list(
+            ConstantLengthDataset.get_packed_dataset(template, dataset, 16, num_of_sequences=10, lazy_tokenize=True))
+        self.assertTrue(sum(len(d['input_ids']) for d in res2) == lengths.sum())
+
+    def test_length_grouped_sampler(self):
+        import numpy as np
+        from swift.trainers.sampler import LengthGroupedSampler, MaxTokensBatchSampler
+        lengths = np.random.RandomState(42).randint(1, 1000, 1001)
+        sampler = LengthGroupedSampler(lengths, 8)
+        idx_list = list(sampler)
+        self.assertTrue(sorted(idx_list) == list(range(len(lengths))))
+        self.assertTrue(lengths[idx_list[:8]].min() == np.sort(lengths)[-8])  # longest batch first
+        sampler.set_epoch(1)
+        self.assertTrue(list(sampler) != idx_list)
+        batch_sampler = MaxTokensBatchSampler(LengthGroupedSampler(lengths, max_tokens=4096))
+        batches = list(batch_sampler)
+        self.assertTrue(len(batches) == len(batch_sampler))
+        self.assertTrue(sorted(sum(batches, [])) == list(range(len(lengths))))
+        self.assertTrue(all(lengths[b].max() * len(b) <= 4096 for b in batches))
+
+    def test_dataset_map_cache(self):
+        import tempfile
+        from datasets import Dataset as HfDataset
+        from swift.llm import dataset_map
+        from swift.llm import PackedLLMDataset
+        from swift.llm.utils.utils import _batch_map, _cached_map
+
+        def _encode(example):
+            if example['query'] == 'skip':
+                return {}, {}
+            input_ids = [ord(c) for c in example['query']]
+            return {'input_ids': input_ids, 'labels': [-100] + input_ids[1:]}, {}
+
+        dataset = HfDataset.from_dict({'query': ['hello', 'skip', 'world', 'swift', 'a']})
+        with tempfile.TemporaryDirectory() as cache_dir:
+            res = dataset_map(dataset, _encode, cache_dir=cache_dir, cache_key='test')
+            res2 = dataset_map(dataset, _encode, cache_dir=cache_dir, cache_key='test')
+            self.assertTrue(len(res) == len(res2) == 4)
+            self.assertTrue(res['input_ids'] == res2['input_ids'] ==
+                            [_encode(d)[0]['input_ids'] for d in dataset if d['query'] != 'skip'])
+            # Only the modified shard is re-encoded.
+            batch_map = partial(_batch_map, map_func=_encode)
+            _cached_map(dataset, batch_map, 1, cache_dir, shard_size=2)
+            new_dataset = HfDataset.from_dict({'query': ['hello', 'skip', 'world', 'swift', 'b']})
+            count = [0]
+
+            def _count_encode(example):
+                count[0] += 1
+                return _encode(example)
+
+            res = _cached_map(new_dataset, partial(_batch_map, map_func=_count_encode), 1, cache_dir, shard_size=2)
+            self.assertTrue(count[0] == 1)
+            self.assertTrue(PackedLLMDataset(res)[-1]['input_ids'] == [ord('b')])
+
+    def test_prefix_cache(self):
+        import torch
+        from swift.llm import PrefixCache
+
+        def _get_kv(token_ids):
+            t = torch.tensor(token_ids, dtype=torch.float32)[None, None, :, None]
+            return ((t, t.clone()), )
+
+        # The KV cache of n tokens takes 8 * n bytes.
+        prefix_cache = PrefixCache(max_size=8 * 14, min_prefix_len=2)
+        prefix_cache.insert([1, 2, 3, 4], _get_kv([1, 2, 3, 4]))
+        prefix_cache.insert([1, 2, 5, 6, 7], _get_kv([1, 2, 5, 6, 7]))
+        self.assertTrue(prefix_cache.match([1, 2, 5, 9])[0][0].flatten().tolist() == [1, 2, 5])
+        self.assertTrue(prefix_cache.match([1, 2, 3, 4])[0][0].flatten().tolist() == [1, 2, 3])  # keep one token
+        self.assertTrue(prefix_cache.match([1, 3, 4]) is None)  # shorter than min_prefix_len
+        self.assertTrue(prefix_cache.match([1, 2, 3], adapter_names=['lora']) is None)
+        # The prefix is covered by the longer sequence.
+        prefix_cache.insert([1, 2, 5, 6, 7, 8], _get_kv([1, 2, 5, 6, 7, 8]))
+        self.assertTrue(len(prefix_cache._lru) == 2)
+        # LRU eviction
+        prefix_cache.match([1, 2, 3, 9])
+        prefix_cache.insert([9] * 8, _get_kv([9] * 8))
+        self.assertTrue(prefix_cache.size <= prefix_cache.max_size)
+        self.assertTrue(prefix_cache.match([1, 2, 3, 9]) is not None)
+        self.assertTrue(prefix_cache.match([1, 2, 5, 6, 9])[0][0].shape[2] == 2)  # [1, 2, 5, 6, 7, 8] is evicted
+
+    def test_metrics_registry(self):
+        from swift.llm import MetricsRegistry
+        registry = MetricsRegistry()
+        counter = registry.counter('requests_total', 'The number of the requests.', ['model'])
+        gauge = registry.gauge('requests_running', 'The number of the running requests.')
+        histogram = registry.histogram('latency_seconds', 'The latency.', ['model'], buckets=[0.1, 1.])
+        counter.inc(model='qwen')
+        counter.inc(2, model='qwen')
+        counter.inc(model='a"b')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        histogram.observe(0.1, model='qwen')
+        histogram.observe(0.5, count=2, model='qwen')
+        histogram.observe(5, model='qwen')
+        lines = registry.render().splitlines()
+        self.assertTrue('# TYPE requests_total counter' in lines)
+        self.assertTrue('requests_total{model="qwen"} 3' in lines)
+        self.assertTrue('requests_total{model="a\\"b"} 1' in lines)
+        self.assertTrue('requests_running 1' in lines)
+        self.assertTrue('latency_seconds_bucket{model="qwen",le="0.1"} 1' in lines)
+        self.assertTrue('latency_seconds_bucket{model="qwen",le="1"} 3' in lines)
+        self.assertTrue('latency_seconds_bucket{model="qwen",le="+Inf"} 4' in lines)
+        self.assertTrue('latency_seconds_sum{model="qwen"} 6.1' in lines)
+        self.assertTrue('latency_seconds_count{model="qwen"} 4' in lines)
+
+    def test_lora_adapter_cache(self):
+        import torch
+        from peft import LoraConfig, PeftModel, get_peft_model
+        from torch import nn
+        from swift.llm import LoRAAdapterCache
+
+        torch.manual_seed(42)
+
+        class _Model(nn.Module):
+
+            def __init__(self):
+                super().__init__()
+                self.fc1 = nn.Linear(8, 16)
+                self.fc2 = nn.Linear(16, 4)
+
+            def forward(self, x):
+                return self.fc2(self.fc1(x).relu())
+
+        base_model = _Model()
+        model = get_peft_model(base_model, LoraConfig(r=2, target_modules=['fc1'], init_lora_weights=False), 'a')
+        model.add_adapter('b', LoraConfig(r=4, target_modules=['fc1', 'fc2'], init_lora_weights=False))
+        model.add_adapter('c', LoraConfig(r=8, target_modules=['fc2'], init_lora_weights=False))
+        model = model.eval()
+        x = torch.randn(4, 3, 8)
+        adapter_names = ['a', 'b', '-', 'c']
+        with torch.no_grad():
+            expected = model(x, adapter_names=adapter_names)
+            lora_cache = LoRAAdapterCache(model, max_loras=2)
+            self.assertTrue(torch.allclose(model(x[:3], adapter_names=adapter_names[:3]), expected[:3], atol=1e-6))
+            self.assertTrue(torch.allclose(model(x[3:], adapter_names=adapter_names[3:]), expected[3:], atol=1e-6))
+            self.assertTrue(lora_cache.num_swaps == 1)  # `a` is evicted
+            with self.assertRaises(ValueError):
+                model(x, adapter_names=adapter_names)
+
+    def test_chunked_causal_lm_loss(self):
+        import torch
+        import torch.nn.functional as F
+        from torch import nn
+        from swift.trainers.loss import chunked_causal_lm_loss
+
+        torch.manual_seed(42)
+        lm_head = nn.Linear(16, 100, bias=False)
+        hidden_states = torch.randn(2, 10, 16, requires_grad=True)
+        labels = torch.randint(0, 100, (2, 10))
+        labels[:, :3] = -100
+        loss_scale = torch.rand(2, 10)
+        logits = lm_head(hidden_states)[:, :-1]
+        masks = labels[:, 1:] != -100
+        expected = F.cross_entropy(logits[masks], labels[:, 1:][masks], reduction='none', label_smoothing=0.1)
+        expected = (expected * loss_scale[:, 1:][masks]).mean()
+        expected.backward()
+        expected_grad = hidden_states.grad.clone()
+        hidden_states.grad = None
+        loss, preds = chunked_causal_lm_loss(lm_head, hidden_states, labels, loss_scale, 0.1, chunk_size=5)
+        loss.backward()
+        self.assertTrue(torch.allclose(loss, expected, atol=1e-6))
+        self.assertTrue(torch.allclose(hidden_states.grad, expected_grad, atol=1e-6))
+        self.assertTrue(torch.equal(preds[masks], logits.argmax(dim=-1)[masks]))
+        self.assertTrue((preds[~masks] == -100).all())
+        # no labelled tokens
+        loss, preds = chunked_causal_lm_loss(lm_head, hidden_states, torch.full_like(labels, -100), chunk_size=5)
+        loss.backward()
+        self.assertTrue(loss.item() == 0 and (preds == -100).all())
+        self.assertTrue(lm_head.weight.grad is not None)
+
+    def test_async_checkpoint_saver(self):
+        import tempfile
+        import torch
+        from torch import nn
+        from swift.trainers.async_saver import AsyncCheckpointSaver
+
+        model = nn.Sequential(nn.Linear(4, 4), nn.Linear(4, 4))
+        model[0].requires_grad_(False)
+        saver = AsyncCheckpointSaver()
+        state_dict = saver.snapshot(model)
+        self.assertTrue(state_dict['0.weight'].data_ptr() == model[0].weight.data_ptr())  # frozen
+        expected = model[1].weight.clone()
+        with torch.no_grad():
+            model[1].weight.add_(1)
+        self.assertTrue(torch.equal(state_dict['1.weight'], expected))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            staging_dir, output_dir = os.path.join(tmp_dir, 'tmp-checkpoint-1'), os.path.join(tmp_dir, 'checkpoint-1')
+            os.makedirs(staging_dir)
+            saver.submit(torch.save, state_dict, os.path.join(staging_dir, 'model.bin'))
+            saver.submit(saver.commit, staging_dir, output_dir)
+            saver.wait()
+            self.assertTrue(os.listdir(tmp_dir) == ['checkpoint-1'])
+            self.assertTrue(torch.equal(torch.load(os.path.join(output_dir, 'model.bin'))['1.weight'], expected))
+
+    def test_async_save_load_best_model(self):
+        import tempfile
+        import time
+        import torch
+        from transformers import LlamaConfig, LlamaForCausalLM
+        from swift.trainers import Seq2SeqTrainer, Seq2SeqTrainingArguments
+
+        class _Dataset(torch.utils.data.Dataset):
+
+            def __len__(self):
+                return 8
+
+            def __getitem__(self, i):
+                input_ids = torch.randint(0, 100, (8, ), generator=torch.Generator().manual_seed(i))
+                return {'input_ids': input_ids, 'attention_mask': torch.ones_like(input_ids), 'labels': input_ids}
+
+        config = LlamaConfig(
+            vocab_size=100, hidden_size=16, intermediate_size=32, num_hidden_layers=1, num_attention_heads=2)
+        for load_best_model_at_end in [True, False]:
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                args = Seq2SeqTrainingArguments(
+                    output_dir=tmp_dir,
+                    async_save=True,
+                    max_steps=6,
+                    save_steps=2,
+                    eval_steps=2,
+                    eval_strategy='steps',
+                    save_total_limit=1,
+                    load_best_model_at_end=load_best_model_at_end,
+                    metric_for_best_model='loss',
+                    per_device_train_batch_size=2,
+                    use_cpu=True,
+                    report_to=[])
+                trainer = Seq2SeqTrainer(
+                    model=LlamaForCausalLM(config), args=args, train_dataset=_Dataset(), eval_dataset=_Dataset())
+                save_files = trainer._save_files
+
+                def _slow_save_files(*args, **kwargs):
+                    time.sleep(0.5)  # the commit is still pending at the end of the training loop
+                    return save_files(*args, **kwargs)
+
+                trainer._save_files = _slow_save_files
+                trainer.train()
+                checkpoints = [d for d in os.listdir(tmp_dir) if os.path.isdir(os.path.join(tmp_dir, d))]
+                self.assertTrue(checkpoints == [os.path.basename(trainer.state.best_model_checkpoint)])
+
+    def test_galore_layerwise(self):
+        import torch
+        from torch import nn
+        from swift.trainers.optimizers.galore import GaLoreAdamW, GaloreOptimizerWrapper
+
+        def _train(layerwise: bool, gradient_accumulation_steps: int):
+            torch.manual_seed(42)
+            model = nn.Sequential(nn.Linear(16, 32), nn.ReLU(), nn.Linear(32, 4))
+            optimizer = GaloreOptimizerWrapper({
+                p: GaLoreAdamW([{
+                    'params': [p],
+                    'rank': 2,
+                    'update_proj_gap': 2,
+                    'scale': 1.,
+                    'proj_type': 'std'
+                }] if p.dim() == 2 else [p])
+                for p in model.parameters()
+            })
+            num_steps = 5
+            step = 0
+            if layerwise:
+                # Like accelerate, the last partial accumulation window is not synced in the backward.
+                optimizer.register_layerwise_hooks(lambda: (step + 1) % gradient_accumulation_steps == 0)
+            for step in range(num_steps):
+                model(torch.randn(8, 16)).sum().backward()
+                if (step + 1) % gradient_accumulation_steps == 0 or step + 1 == num_steps:
+                    if layerwise and (step + 1) % gradient_accumulation_steps == 0:
+                        self.assertTrue(all(p.grad is None for p in model.parameters()))
+                    optimizer.step()
+                    optimizer.zero_grad()
+            return model.state_dict(), optimizer.state_dict()
+
+        for gradient_accumulation_steps in [1, 2]:
+            state_dict, optimizer_state_dict = _train(False, gradient_accumulation_steps)
+            state_dict2, optimizer_state_dict2 = _train(True, gradient_accumulation_steps)
+            self.assertTrue(all(torch.allclose(state_dict[k], state_dict2[k]) for k in state_dict))
+            self.assertTrue(len(optimizer_state_dict2['optimizers']) == 4)
+
+    def test_galore_randomized_svd(self):
+        import torch
+        from swift.trainers.optimizers.galore.galore_projector import GaLoreProjector, get_projector_kwargs
+
+        torch.manual_seed(42)
+        # low rank + noise
+        grad = torch.randn(64, 8) @ torch.randn(8, 32) + 0.01 * torch.randn(64, 32)
+        for proj_type in ['std', 'reverse_std', 'full']:
+            projector = GaLoreProjector(8, proj_type=proj_type)
+            projector2 = GaLoreProjector(
+                8, update_proj_gap=1, proj_type=proj_type, svd_type='randomized', svd_warm_start=True)
+            low_rank_grad = projector.project_back(projector.project(grad, 0))
+            for step in range(2):  # warm start at the second step
+                low_rank_grad2 = projector2.project_back(projector2.project(grad, step))
+                self.assertTrue(torch.allclose(low_rank_grad, low_rank_grad2, atol=1e-3))
+            self.assertTrue(projector2.num_svd == 2 and projector2.total_svd_time > 0)
+        params = [torch.zeros(4, 4) for _ in range(4)]
+        group = {'params': params, 'update_proj_gap': 10, 'stagger_update': True}
+        offsets = [get_projector_kwargs(group, p)['update_offset'] for p in params]
+        self.assertTrue(offsets == [0, 2, 5, 7])
+
+    def test_pt_engine(self):
+        import asyncio
+        import time
+        from swift.llm.utils.pt_engine import PtEngine
+
+        model, template = _get_tiny_llama_template()
+        generation_config = model.generation_config
+        queries = [f'浙江的省会在哪？{i}' * (i % 4 + 1) for i in range(10)]
+        serial_res = [inference(model, template, query)[0] for query in queries]
+        engine = PtEngine(model, template, max_batch_size=3)
+        self.assertTrue(engine.supports_batching)
+
+        async def _generate(query, started=None, **kwargs):
+            input_ids = template.encode({'query': query})[0]['input_ids']
+            generate_ids = []
+            async for generate_ids, _ in engine.generate(input_ids, generation_config, **kwargs):
+                if started is not None:
+                    started.set()
+            return generate_ids
+
+        async def _generate_all(queries):
+            return await asyncio.gather(*[_generate(query) for query in queries])
+
+        # greedy parity with `inference`, the requests (of different lengths) wait for the free slots
+        generate_ids_list = asyncio.run(_generate_all(queries))
+        self.assertTrue([template.generate_ids_to_response(ids) for ids in generate_ids_list] == serial_res)
+        self.assertTrue(len(set(len(ids) for ids in generate_ids_list)) > 1)  # finished at different steps
+        long_idx = [len(ids) for ids in generate_ids_list].index(generation_config.max_new_tokens)
+
+        # stop words of token ids
+        generate_ids = generate_ids_list[long_idx]
+        stop_idx = generate_ids.index(generate_ids[4])
+        res = asyncio.run(_generate(queries[long_idx], stop_words=[[generate_ids[4]]]))
+        self.assertTrue(res == generate_ids[:stop_idx + 1])
+
+        # slow down the decoding, so that the requests overlap
+        num_forwards = [0]
+
+        def _slow_forward(*args):
+            num_forwards[0] += 1
+            time.sleep(0.02)
+
+        model.register_forward_pre_hook(_slow_forward)
+        merged_batch_sizes = []
+        merge_batch = engine._merge_batch
+
+        def _merge_batch(*args):
+            merged_batch_sizes.append(len(engine._requests))
+            return merge_batch(*args)
+
+        engine._merge_batch = _merge_batch
+
+        async def _join_mid_decode():
+            started = asyncio.Event()
+            task = asyncio.create_task(_generate(queries[long_idx], started))
+            await started.wait()
+            res = await _generate(queries[0])
+            return await task, res
+
+        res = asyncio.run(_join_mid_decode())
+        self.assertTrue(merged_batch_sizes == [0, 1])  # the second request joins the running batch
+        self.assertTrue(res == (generate_ids_list[long_idx], generate_ids_list[0]))
+
+        async def _abort():
+            started = asyncio.Event()
+            task = asyncio.create_task(_generate(queries[long_idx], started))
+            await started.wait()
+            task.cancel()
+            while len(engine._requests) > 0:
+                await asyncio.sleep(0.01)
+
+        num_forwards[0] = 0
+        asyncio.run(_abort())
+        self.assertTrue(num_forwards[0] < generation_config.max_new_tokens)  # the aborted request leaves the batch
+        self.assertTrue(asyncio.run(_generate(queries[long_idx])) == generate_ids_list[long_idx])
+
+    def test_inference_pt(self):
+        import json
+        import tempfile
+        from unittest import mock
+        from swift.llm import InferArguments, ModelType, infer_main, inference_pt
+        from swift.llm.utils import pt_engine as pt_engine_module
+        from swift.llm.utils.pt_engine import PtEngine
+
+        model, template = _get_tiny_llama_template()
+        template.max_length = 44
+        request_list = [{
+            'query': f'浙江的省会在哪？{i}' * (i % 5 + 1),
+            'history': [['你好', '你好！']] * (i % 2)
+        } for i in range(12)]
+        serial_res = [inference(model, template, **request) for request in request_list]
+        self.assertTrue(any(response == '' for response, _ in serial_res))  # longer than max_length
+        pt_engine = PtEngine(model, template, max_batch_size=3)
+        is_batchable = pt_engine.is_batchable
+        pt_engine.is_batchable = lambda inputs, *args: len(inputs['input_ids']) < 36 and is_batchable(inputs, *args)
+        with mock.patch.object(pt_engine_module, 'inference', wraps=inference) as mock_inference:
+            resp_list = inference_pt(pt_engine, template, request_list)
+        # in the original order, the rows longer than max_length get an empty response
+        self.assertTrue([(resp['response'], resp['history']) for resp in resp_list] == serial_res)
+        num_unbatchable = sum(36 <= len(inputs['input_ids']) for inputs, _ in template.encode_batch(request_list)
+                              if len(inputs) > 0)
+        self.assertTrue(num_unbatchable > 0 and mock_inference.call_count == num_unbatchable)
+
+        # `swift infer --infer_batch_size 3` gives the same results as the serial infer
+        # (`prepare_model_template` is patched to keep the tiny model on cpu)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            model_dir = os.path.join(tmp_dir, 'model')
+            model.save_pretrained(model_dir)
+            template.tokenizer.save_pretrained(model_dir)
+            dataset_path = os.path.join(tmp_dir, 'val.jsonl')
+            with open(dataset_path, 'w') as f:
+                for request in request_list:
+                    f.write(json.dumps({**request, 'response': '杭州'}, ensure_ascii=False) + '\n')
+            result_list = []
+            for infer_batch_size in [1, 3]:
+                args = InferArguments(
+                    model_type=ModelType.qwen2_0_5b_instruct,
+                    model_id_or_path=model_dir,
+                    val_dataset=[dataset_path],
+                    show_dataset_sample=-1,
+                    infer_batch_size=infer_batch_size,
+                    result_dir=os.path.join(tmp_dir, f'result{infer_batch_size}'))
+                with mock.patch('swift.llm.infer.prepare_model_template', return_value=(model, template)):
+                    result_list.append(infer_main(args)['result'])
+        self.assertTrue(result_list[0] == result_list[1] and len(result_list[1]) == len(request_list))
+        serial_responses = {request['query']: response for request, (response, _) in zip(request_list, serial_res)}
+        self.assertTrue(all(obj['response'] == serial_responses[obj['query']] for obj in result_list[1]))
+
 
 if __name__ == '__main__':
     unittest.main()